@@ -0,0 +1,186 @@
+'''Runs the mini benchmarks and compares them with a saved baseline.
+
+Each benchmark runs in a fresh Python process, so that one benchmark's memory
+use can't affect another's. The *.mini files in this directory are evaluated
+like a file passed to mini.py, and `parse` times parse_all on a generated
+source of several megabytes.
+
+Usage: python benchmarks/run.py [--save] [--baseline file-name.json]
+                                [--threshold fraction] [--repeat count]
+                                [benchmark-name ...]
+
+Without --save, the run fails if any benchmark is slower, or uses more peak
+memory, than the baseline by more than the threshold (0.2 by default).
+'''
+
+from __future__ import print_function
+
+import gc
+import json
+import os.path
+import resource
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+MINI_DIRECTORY = os.path.dirname(BENCHMARKS_DIRECTORY)
+DEFAULT_BASELINE_FILENAME = os.path.join(BENCHMARKS_DIRECTORY, 'baseline.json')
+
+# The measurements compared against the baseline
+COMPARED_MEASUREMENTS = ['seconds', 'peak_memory_kb']
+
+PARSE_SOURCE_LENGTH = 4 * 1024 * 1024
+
+def benchmark_names():
+    names = [os.path.splitext(filename)[0]
+        for filename in sorted(os.listdir(BENCHMARKS_DIRECTORY))
+        if filename.endswith('.mini')]
+
+    return names + ['parse']
+
+def parse_source():
+    'Returns a source of at least PARSE_SOURCE_LENGTH characters made of the benchmarks and unit tests'
+    filenames = [os.path.join(BENCHMARKS_DIRECTORY, name + '.mini') for name in benchmark_names() if name != 'parse']
+    filenames.append(os.path.join(MINI_DIRECTORY, 'mini.py-unit-tests.mini'))
+
+    sources = []
+
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            sources.append(f.read())
+
+    source = '\n'.join(sources)
+    return source * (PARSE_SOURCE_LENGTH // len(source) + 1)
+
+def measure(name):
+    '''Runs one benchmark in this process, returning its time, the GC-tracked
+    objects it left alive and the peak memory of the process'''
+    sys.path.insert(0, MINI_DIRECTORY)
+    import mini
+
+    if name == 'parse':
+        source = parse_source()
+
+        def run():
+            mini.parse_all(source)
+
+    else:
+        filename = os.path.join(BENCHMARKS_DIRECTORY, name + '.mini')
+
+        with open(filename, 'r') as f:
+            source = f.read()
+
+        environment = mini.create_file_environment(mini.load_predefineds(), filename, [])
+        expressions = mini.parse_all(source)
+
+        def run():
+            mini.evaluate_expressions(expressions, environment)
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+
+    start = time.time()
+    run()
+    seconds = time.time() - start
+
+    gc.collect()
+
+    return {
+        'seconds'           : seconds,
+        # Python 2 doesn't count allocations, so this counts the objects the
+        # benchmark allocated and kept
+        'retained_objects'  : len(gc.get_objects()) - objects_before,
+        'peak_memory_kb'    : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def run_benchmark(name, repeat):
+    'Runs a benchmark repeat times in separate processes, keeping the best of each measurement'
+    results = []
+
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, os.path.realpath(__file__), '--measure', name])
+        results.append(json.loads(output))
+
+    return dict((key, min(result[key] for result in results)) for key in results[0])
+
+def regressions(name, result, baseline, threshold):
+    'Returns a description of each measurement of result that is worse than baseline by more than threshold'
+    found = []
+
+    for key in COMPARED_MEASUREMENTS:
+        if key in baseline and result[key] > baseline[key] * (1 + threshold):
+            found.append('{} {}: {:.4g} against a baseline of {:.4g}'.format(name, key, result[key], baseline[key]))
+
+    return found
+
+def main(arguments):
+    save = False
+    baseline_filename = DEFAULT_BASELINE_FILENAME
+    threshold = 0.2
+    repeat = 3
+    names = []
+
+    while arguments:
+        argument = arguments.pop(0)
+
+        if argument == '--measure':
+            print(json.dumps(measure(arguments.pop(0))))
+            return 0
+
+        elif argument == '--save':
+            save = True
+
+        elif argument == '--baseline':
+            baseline_filename = arguments.pop(0)
+
+        elif argument == '--threshold':
+            threshold = float(arguments.pop(0))
+
+        elif argument == '--repeat':
+            repeat = int(arguments.pop(0))
+
+        elif argument in benchmark_names():
+            names.append(argument)
+
+        else:
+            sys.exit(__doc__)
+
+    names = names or benchmark_names()
+
+    baselines = {}
+
+    if os.path.exists(baseline_filename):
+        with open(baseline_filename, 'r') as f:
+            baselines = json.load(f)
+
+    results = {}
+    found_regressions = []
+
+    print('{:<24} {:>10} {:>16} {:>16}'.format('benchmark', 'seconds', 'retained objects', 'peak memory kb'))
+
+    for name in names:
+        result = run_benchmark(name, repeat)
+        results[name] = result
+
+        print('{:<24} {:>10.4f} {:>16} {:>16}'.format(name, result['seconds'], result['retained_objects'], result['peak_memory_kb']))
+
+        if not save and name in baselines:
+            found_regressions.extend(regressions(name, result, baselines[name], threshold))
+
+    if save:
+        baselines.update(results)
+
+        with open(baseline_filename, 'w') as f:
+            json.dump(baselines, f, indent = 4, sort_keys = True)
+
+        print('Saved baseline to {}'.format(baseline_filename))
+        return 0
+
+    for regression in found_regressions:
+        print('Regression: {}'.format(regression), file=sys.stderr)
+
+    return 1 if found_regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,25 +1,72 @@
 from __future__ import print_function
 
+import array
+import collections
+import cPickle
+import cStringIO
+import hashlib
+import itertools
+import marshal
+import mmap
+import operator
+import os.path
+import Queue
 import re
+import sys
+import threading
+import time
 import traceback
+import types
+import weakref
+
+from functools import cmp_to_key
+
+# Compiled code can't be pickled, so it is left out and compiled again when
+# the expression is next evaluated. Pair hashes depend on the identities of
+# symbols, so they are computed again too.
+UNPICKLED_SLOTS = ('code', 'hash', '__weakref__')
 
 class MiniObject(object):
-    def __init__(self, py_object, **meta):
+    # code caches the compiled form of an expression and frame_layout the
+    # layout of an operative pattern, see compile_expression and operative_layout
+    __slots__ = ('py_object', 'code', 'frame_layout')
+
+    def __init__(self, py_object):
         (   "The following python types map to the following mini types:\n"
             "   bool -> boolean\n"
             "   str -> string\n"
+            "   Rope -> string\n"
+            "   MappedString -> string\n"
             "   int -> integer\n"
             "   float -> float\n"
             "   tuple -> list (may contain different types)\n"
-            "   list -> vector (may only contain one type)\n"
-            "   dict -> map\n"
+            "   MiniVector -> vector\n"
+            "   MiniMap -> map\n"
+            "   NumericArray -> array\n"
             "   MiniSymbol -> symbol\n"
-            "   Pair -> pair"
+            "   MiniPair -> pair (a MiniObject itself, so a cell is one object)\n"
             "mini vectors and maps should be treated as though immutable"
             "s-expressions should be parsed as tuples"
         )
         self.py_object = py_object
-        self.meta = meta
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name not in UNPICKLED_SLOTS:
+                    try:
+                        state[name] = cls.__dict__[name].__get__(self, cls)
+
+                    except AttributeError:
+                        pass
+
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            object.__setattr__(self, name, value)
 
     def __repr__(self):
         if self.py_object == None:
@@ -34,16 +81,24 @@ class MiniObject(object):
         if isinstance(self.py_object,str):
             return self.py_object
 
+        if isinstance(self.py_object,Rope) or isinstance(self.py_object,MappedString):
+            return str(self.py_object)
+
         return repr(self)
 
 class Identifier(object):
-    def __init__(self,symbol,**kwargs):
+    __slots__ = ('symbol', 'symbol_object', 'address')
+
+    def __init__(self,symbol,symbol_object=None):
         assert isinstance(symbol,str)
 
         self.symbol = symbol
 
-        self.start = kwargs.get('start')
-        self.end = kwargs.get('end')
+        # The interned symbol, resolved once here rather than on every lookup
+        self.symbol_object = symbol_object or create_symbol(symbol)
+
+        # Set by the lexical addressing pass, see resolve_lexical_addresses
+        self.address = None
 
     def __repr__(self):
         return '<identifier {}>'.format(self.symbol)
@@ -57,57 +112,342 @@ def is_identifier(mini_object):
 SYMBOLS = {}
 
 class MiniSymbol(object):
-    def __init__(self,string):
+    __slots__ = ('string', 'ordinal')
+
+    def __init__(self,string,ordinal):
         self.string = string
 
+        # Symbols are numbered densely in the order they are interned, so
+        # comparing symbols never has to compare their strings
+        self.ordinal = ordinal
+
     def __eq__(self,other):
         return self is other
 
     def __repr__(self):
         return '<symbol :{}>'.format(self.string)
 
-class MiniPair(object):
+class MiniPair(MiniObject):
+    '''A pair is its own py_object, so that a cons cell is a single Python
+    object rather than a MiniObject wrapping a separate pair. Pairs are never
+    mutated, so they compare by their contents and cache their hash.'''
+    __slots__ = ('car', 'cdr', 'hash', '__weakref__')
+
     def __init__(self, car, cdr):
         assert isinstance(car, MiniObject)
         assert isinstance(cdr, MiniObject)
 
         self.car = car
         self.cdr = cdr
+        self.hash = None
+
+    @property
+    def py_object(self):
+        return self
+
+    def __eq__(self, other):
+        # Lists are compared iteratively, so only nesting in the cars uses
+        # the Python stack
+        left, right = self, other
+
+        while isinstance(right, MiniPair):
+            if left is right:
+                return True
+
+            if left.hash != None and right.hash != None and left.hash != right.hash:
+                return False
+
+            if not items_equal(left.car, right.car):
+                return False
+
+            if not isinstance(left.cdr, MiniPair) or not isinstance(right.cdr, MiniPair):
+                return items_equal(left.cdr, right.cdr)
+
+            left, right = left.cdr, right.cdr
+
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self.hash != None:
+            return self.hash
+
+        # The pairs of the list without a cached hash are hashed from the
+        # end, so long lists don't recurse
+        pairs = []
+        tail = self
+
+        while isinstance(tail, MiniPair) and tail.hash == None:
+            pairs.append(tail)
+            tail = tail.cdr
+
+        h = item_hash(tail)
+
+        for pair in reversed(pairs):
+            h = hash((item_hash(pair.car), h))
+            pair.hash = h
+
+        return h
+
+    def __reduce__(self):
+        # Lists are pickled as their items, so that pickling a long list
+        # doesn't recurse once for each pair
+        items = [self.car]
+        tail = self.cdr
+
+        while isinstance(tail, MiniPair):
+            items.append(tail.car)
+            tail = tail.cdr
+
+        return (create_cons_collection, (items, tail))
 
     def __repr__(self):
-        return '<pair {}, {}>'.format(self.car, self.cdr)
+        # Built iteratively so that long lists don't exhaust the stack
+        cars = [self.car]
+        tail = self.cdr
+
+        while isinstance(tail.py_object, MiniPair):
+            cars.append(tail.py_object.car)
+            tail = tail.py_object.cdr
+
+        return ''.join('<pair {}, '.format(item) for item in cars) + '{}'.format(tail) + '>' * len(cars)
+
+def items_equal(l, r):
+    '''Compares MiniObjects by value, except environments, which are mutable
+    and only equal themselves'''
+    if l is r:
+        return True
+
+    if isinstance(l, MiniEnvironment) or isinstance(r, MiniEnvironment):
+        return False
+
+    l, r = l.py_object, r.py_object
+
+    # Nothing but nil equals nil, so comparisons with nil, which mostly end
+    # loops over lists, needn't compare pairs
+    if l is None or r is None:
+        return l is r
+
+    return l == r
+
+def item_hash(mini_object):
+    'Returns a hash of a MiniObject which is equal for items_equal objects'
+    if isinstance(mini_object, MiniEnvironment):
+        return id(mini_object)
+
+    try:
+        return hash(mini_object.py_object)
+
+    except TypeError:
+        # Unhashable items only narrow the hash less
+        return 0
+
+class TailCall(object):
+    __slots__ = ('code', 'environment')
+
+    '''Returned by an applicative in place of the value of an expression in tail
+    position. execute runs the compiled code instead of recursing, so mini
+    loops written as tail calls run in constant stack space.'''
+    def __init__(self, code, environment):
+        assert callable(code)
+
+        self.code = code
+        self.environment = environment
+
+    def __repr__(self):
+        return '<tail call {}>'.format(self.code)
 
 def evaluate_arguments(arguments_cons_list, environment):
-    if arguments_cons_list == NIL:
-        return NIL
+    return create_cons_collection([evaluate(argument, environment)
+        for argument in cons_collection_to_py_collection(arguments_cons_list)])
 
-    return cons(
-        evaluate(car(arguments_cons_list), environment),
-        evaluate_arguments(cdr(arguments_cons_list), environment))
+class FrameLayout(object):
+    'The statically known slots of the environments created by an operative'
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.index = dict((symbol, i) for i, symbol in enumerate(symbols))
+
+    def __reduce__(self):
+        # Unpickled layouts are interned again, so identity checks keep working
+        return (create_frame_layout, (self.symbols,))
+
+    def __repr__(self):
+        return '<frame layout {}>'.format(', '.join(symbol.py_object.string for symbol in self.symbols))
+
+FRAME_LAYOUTS = {}
+
+def create_frame_layout(symbols):
+    # Layouts are interned so that frames with the same slot names can be
+    # recognized with an identity check
+    symbols = tuple(symbols)
+
+    if symbols in FRAME_LAYOUTS:
+        return FRAME_LAYOUTS[symbols]
+
+    for symbol in symbols:
+        shadow(symbol)
+
+    layout = FrameLayout(symbols)
+    FRAME_LAYOUTS[symbols] = layout
+    return layout
+
+# Lookups of builtins are cached by the code that makes them, for as long as
+# nothing could have shadowed them. SHADOWED_SYMBOLS holds every symbol that
+# has been bound anywhere but a root environment, including as a slot of a
+# frame layout, and BUILTINS_GENERATION is incremented whenever a builtin is
+# shadowed or rebound, which invalidates the cached lookups.
+SHADOWED_SYMBOLS = set()
+BUILTINS_GENERATION = 0
+
+# Cleared for good if an environment is given a new parent, since the roots of
+# the environments nested in it are no longer known
+CACHED_BUILTIN_LOOKUPS = True
+
+def invalidate_builtin_lookups():
+    global BUILTINS_GENERATION
+    BUILTINS_GENERATION += 1
+
+def shadow(key_symbol):
+    'Records that key_symbol is bound outside a root environment'
+    if key_symbol not in SHADOWED_SYMBOLS:
+        SHADOWED_SYMBOLS.add(key_symbol)
+        invalidate_builtin_lookups()
 
 class MiniEnvironment(MiniObject):
     'This acts like a dict in Python code and a cons-dict in mini code'
-    def __init__(self):
-        super(self.__class__, self).__init__(None)
+    __slots__ = ('parent', 'root', 'bindings', 'cons_dict', 'layout', 'slots')
+
+    def __init__(self, parent=None, layout=None, slots=None):
+        # py_object is computed from the bindings, so MiniObject.__init__ is not called
+        self.parent = parent
+
+        # The outermost environment, or None if one of the ancestors is a
+        # cons-dict
+        if parent is None:
+            self.root = self
+        elif type(parent) is MiniEnvironment:
+            self.root = parent.root
+        else:
+            self.root = None
+
+        # Bindings which aren't in a slot of the layout. The dict is only
+        # created when the first one is set, since most frames have none.
+        self.bindings = None
+        self.cons_dict = None
+
+        # Slots hold the bindings named by the layout, None marks a slot
+        # that has not been defined yet
+        self.layout = layout
+        self.slots = slots
+
+    @property
+    def py_object(self):
+        # The cons-dict view is only built when mini code asks for it, and is
+        # rebuilt after the bindings change
+        if self.cons_dict is None:
+            associations = []
+
+            if self.parent != None:
+                associations.append(cons(PARENT_SYMBOL, self.parent))
+
+            if self.layout != None:
+                for key, value in zip(self.layout.symbols, self.slots):
+                    if value != None:
+                        associations.append(cons(key, value))
+
+            for key, value in (self.bindings or {}).iteritems():
+                associations.append(cons(key, value))
+
+            associations.sort(key = cmp_to_key(lambda l, r: compare_keys(car(l), car(r))))
+            self.cons_dict = cons_dict_from_sorted_associations(associations)
+
+        return self.cons_dict.py_object
+
+    def __getstate__(self):
+        state = super(MiniEnvironment, self).__getstate__()
+
+        # The cons-dict view is rebuilt when it is needed
+        state['cons_dict'] = None
+        return state
+
+    def __setstate__(self, state):
+        super(MiniEnvironment, self).__setstate__(state)
+
+        if self.root is not self:
+            for key_symbol in self.bindings or ():
+                shadow(key_symbol)
+
+    def get_local(self,key_symbol):
+        'Returns the value bound to key_symbol in this frame, or None'
+        if self.bindings is not None and key_symbol in self.bindings:
+            return self.bindings[key_symbol]
+
+        if self.layout != None and key_symbol in self.layout.index:
+            return self.slots[self.layout.index[key_symbol]]
+
+        return None
+
+    def has_binding(self,key_symbol):
+        if key_symbol is PARENT_SYMBOL:
+            return self.parent != None
+
+        return self.get_local(key_symbol) != None
+
+    def get_binding(self,key_symbol):
+        if key_symbol is PARENT_SYMBOL and self.parent != None:
+            return self.parent
+
+        result = self.get_local(key_symbol)
+
+        if result == None:
+            raise Exception('KeyError: Dictionary does not contain key "{}"'.format(key_symbol))
+
+        return result
+
+    def set_binding(self,key_symbol,value):
+        global CACHED_BUILTIN_LOOKUPS
+        assert isinstance(value, MiniObject)
+
+        if self.root is not self:
+            shadow(key_symbol)
+
+        elif self.get_local(key_symbol) != None:
+            invalidate_builtin_lookups()
+
+        if key_symbol is PARENT_SYMBOL:
+            CACHED_BUILTIN_LOOKUPS = False
+            invalidate_builtin_lookups()
+
+            self.parent = value
+            self.root = None
+
+        elif self.layout != None and key_symbol in self.layout.index:
+            self.slots[self.layout.index[key_symbol]] = value
+
+        else:
+            if self.bindings is None:
+                self.bindings = {}
+
+            self.bindings[key_symbol] = value
+
+        self.cons_dict = None
 
     def __getitem__(self,key):
         assert isinstance(key,str)
-        key_symbol = create_symbol(key)
 
-        return cons_dict_get(self,key_symbol)
+        return self.get_binding(create_symbol(key))
 
     def __setitem__(self,key,value):
         assert isinstance(key,str)
-        key_symbol = create_symbol(key)
 
-        assert isinstance(value, MiniObject)
-        self.py_object = cons_dict_set(self,key_symbol,value).py_object
+        self.set_binding(create_symbol(key), value)
 
     def __contains__(self,key):
         assert isinstance(key,str)
-        key_symbol = create_symbol(key)
 
-        return cons_dict_has_key(self,key_symbol) == TRUE
+        return self.has_binding(create_symbol(key))
 
     def get(self,key):
         assert isinstance(key,str)
@@ -117,6 +457,52 @@ class MiniEnvironment(MiniObject):
 
         return None
 
+def lookup(environment, key_symbol):
+    'Returns the value bound to key_symbol in environment or its ancestors, or None'
+    while environment != None:
+        if isinstance(environment, MiniEnvironment):
+            result = environment.get_local(key_symbol)
+
+            if result != None:
+                return result
+
+            environment = environment.parent
+
+        # Environments built in mini code (see `function` in predefineds.mini) are plain cons-dicts
+        else:
+            association = cons_dict_find(environment, key_symbol)
+
+            if association != None:
+                return cdr(association)
+
+            association = cons_dict_find(environment, PARENT_SYMBOL)
+
+            if association == None:
+                return None
+
+            environment = cdr(association)
+
+    return None
+
+def lookup_address(environment, address):
+    'Returns the value at a lexical address, or None if environment does not have the expected frames'
+    layouts, slot, key_symbol = address
+    depth = len(layouts) - 1
+    frame = environment
+
+    for i, layout in enumerate(layouts):
+        if not isinstance(frame, MiniEnvironment) or frame.layout is not layout:
+            return None
+
+        if i == depth:
+            return frame.slots[slot]
+
+        # A binding defined at runtime in an intermediate frame shadows the slot
+        if frame.bindings is not None and key_symbol in frame.bindings:
+            return None
+
+        frame = frame.parent
+
 def dict_to_environment(dictionary):
     result = MiniEnvironment()
 
@@ -126,9 +512,36 @@ def dict_to_environment(dictionary):
     return result
 
 class MiniApplicative(object):
-    def __init__(self, operative):
+    def __init__(self, operative, builtin=None, arity=None):
         assert callable(operative)
         self.operative = operative
+
+        # The compiled body of an applicative created by `operative`
+        self.code = None
+
+        # The Python function of an applicative created by py_to_mini, which
+        # takes evaluated arguments directly, and its number of arguments or
+        # None if it takes a variable number
+        self.builtin = builtin
+        self.arity = arity
+
+        # The pattern and defining environment of an applicative created by
+        # `operative`, from which it can be created again after unpickling
+        self.source = None
+
+        # The identifier the applicative was first defined as, for profiles
+        self.name = None
+
+    def __getstate__(self):
+        if self.source == None:
+            raise cPickle.PicklingError('Only applicatives created by `operative` can be pickled')
+
+        return (self.source, self.name)
+
+    def __setstate__(self, state):
+        (pattern, defining_environment), name = state
+        self.__dict__.update(operative(pattern, defining_environment).py_object.__dict__)
+        self.name = name
         
     def __call__(self, pattern, environment):
         assert isinstance(pattern, MiniObject)
@@ -145,6 +558,12 @@ class MiniWrapper(object):
     def __call__(self, pattern, environment):
         assert isinstance(pattern, MiniObject)
 
+        builtin = self.operative.py_object.builtin if isinstance(self.operative.py_object, MiniApplicative) else None
+
+        if builtin != None:
+            return convert_result(builtin(*[evaluate(argument, environment)
+                for argument in cons_collection_to_py_collection(pattern)]))
+
         return self.operative.py_object(evaluate_arguments(pattern, environment), environment)
 
     def __repr__(self):
@@ -159,24 +578,99 @@ def unwrap(thing):
 
     raise Exception('UnwrapError')
 
-def create_symbol(string,**kwargs):
+def create_symbol(string):
     if string in SYMBOLS:
         return SYMBOLS[string]
 
-    k = MiniObject(MiniSymbol(string), **kwargs)
+    k = MiniObject(MiniSymbol(string, len(SYMBOLS)))
     SYMBOLS[string] = k
     return k
 
-def create_cons_collection(py_collection):
-    result = NIL
+def create_symbols(strings):
+    'Interns many strings at once, returning their symbols in the same order'
+    strings = list(strings)
+    new_strings = []
+
+    for string in strings:
+        if string not in SYMBOLS:
+            SYMBOLS[string] = None
+            new_strings.append(string)
+
+    ordinal = len(SYMBOLS) - len(new_strings)
+
+    for string in new_strings:
+        SYMBOLS[string] = MiniObject(MiniSymbol(string, ordinal))
+        ordinal += 1
+
+    return [SYMBOLS[string] for string in strings]
+
+def symbol_ordinals(strings):
+    'Returns the ordinals create_symbols would give strings, without interning them'
+    next_ordinal = len(SYMBOLS)
+    ordinals = []
+
+    for string in strings:
+        if string in SYMBOLS:
+            ordinals.append(SYMBOLS[string].py_object.ordinal)
+        else:
+            ordinals.append(next_ordinal)
+            next_ordinal += 1
+
+    return ordinals
+
+PARENT_SYMBOL = create_symbol('__parent__')
+
+# While hash-consing is enabled, this maps the contents of each pair to the
+# pair, so that `cons` returns the existing pair for contents it has seen and
+# equal structures are shared. Otherwise it is None.
+CONS_TABLE = None
+
+# Atoms of these types are looked up in CONS_TABLE by value, other items by
+# identity
+HASH_CONSED_TYPES = (str, int, long, float, bool, MiniSymbol)
+
+def set_hash_consing(enabled):
+    global CONS_TABLE
+
+    # Pairs are only kept in the table for as long as they are used elsewhere
+    CONS_TABLE = weakref.WeakValueDictionary() if enabled else None
+
+def cons_table_key(item):
+    # Pairs in the table are already shared, and environments compute their
+    # py_object, so only plain atoms are looked up by value
+    if type(item) is MiniObject and type(item.py_object) in HASH_CONSED_TYPES:
+        return (type(item.py_object), item.py_object)
+
+    # The pair keeps item alive for as long as its entry exists, so the id
+    # can't be reused
+    return id(item)
+
+def hash_cons(car, cdr):
+    key = (cons_table_key(car), cons_table_key(cdr))
+    pair = CONS_TABLE.get(key)
+
+    if pair == None:
+        pair = MiniPair(car, cdr)
+        CONS_TABLE[key] = pair
+
+    return pair
+
+def create_cons_collection(py_collection, tail=None):
+    result = NIL if tail == None else tail
+
+    if CONS_TABLE != None:
+        for item in reversed(py_collection):
+            result = hash_cons(item, result)
+
+        return result
 
     for item in reversed(py_collection):
-        result = MiniObject(MiniPair(item, result))
+        result = MiniPair(item, result)
 
     return result
 
 def cons_collection_to_py_collection(cons_collection):
-    while cons_collection != NIL:
+    while cons_collection is not NIL:
         yield car(cons_collection)
         cons_collection = cdr(cons_collection)
 
@@ -190,77 +684,239 @@ token_regex = re.compile(r'''(?mx)
     (?P<symbol>\:[_A-Za-z\?\-\+\*/=\>\<]*)
     )''')
 
+# Maps parsed objects to their (start, end) offsets in the source. Spans are
+# only recorded when debugging, so normally this is None and parsed numbers
+# and strings can share the cached objects below.
+SOURCE_SPANS = None
+
+def source_span(mini_object):
+    'Returns the (start, end) source offsets of a parsed object, or None'
+    if SOURCE_SPANS == None:
+        return None
+
+    return SOURCE_SPANS.get(mini_object)
+
+def parse_atom(match):
+    kind = match.lastgroup
+
+    if kind == 'number':
+        v = float(match.group('number'))
+        if v.is_integer(): v = int(v)
+
+        result = create_number(v) if SOURCE_SPANS == None else MiniObject(v)
+
+    elif kind == 'string':
+        string = match.group('string')[1:-1]
+        result = create_string(string) if SOURCE_SPANS == None else MiniObject(string)
+
+    elif kind == 'identifier':
+        result = MiniObject(Identifier(
+            match.group('identifier'),
+            symbol_object = SYMBOLS[match.group('identifier')]))
+
+    elif kind == 'symbol':
+        return SYMBOLS[match.group('symbol')[1:]]
+
+    else:
+        assert False, "I'm not sure how this happened"
+
+    if SOURCE_SPANS != None:
+        SOURCE_SPANS[result] = (match.start(kind), match.end(kind))
+
+    return result
+
 def parse_all(source):
-    def parse(matches, index_holder):
-        match = matches[index_holder[0]]
-        index_holder[0] += 1
+    # Source spans need the matches themselves, otherwise the cheaper token
+    # lists are parsed
+    if SOURCE_SPANS == None:
+        return parse_tokens(*tokenize(source))
+
+    matches = list(token_regex.finditer(source))
 
+    create_symbols(match.group('identifier') or match.group('symbol')[1:]
+        for match in matches
+        if match.group('identifier') or match.group('symbol'))
+
+    # Each item on the stack collects the items of a list that is still
+    # open, so nesting depth doesn't use the Python stack
+    stack = [[]]
+
+    for match in matches:
         if match.group('open_parenthese'):
-            r = []
+            stack.append([])
+
+        elif match.group('close_parenthese'):
+            if len(stack) == 1:
+                raise Exception("Unmatched parenthese )")
+
+            items = stack.pop()
+            stack[-1].append(create_cons_collection(items))
 
-            while index_holder[0] < len(matches) and not matches[index_holder[0]].group('close_parenthese'):
-                r.append(parse(matches, index_holder))
+        else:
+            stack[-1].append(parse_atom(match))
+
+    if len(stack) > 1:
+        raise Exception('Unmatched parenthese (')
+
+    return create_cons_collection(stack[0])
+
+# Sources parsed with parse_cached are cached in PARSE_CACHE_DIRECTORY, in
+# files named by the hash of the source. They hold the marshalled tokens of
+# the source, which parse_tokens turns back into cons trees without running
+# token_regex. Short sources are parsed directly, since they parse faster
+# than the cache can be read.
+PARSE_CACHE_DIRECTORY = os.environ.get('MINI_CACHE_DIRECTORY', os.path.join(os.path.expanduser('~'), '.cache', 'mini'))
+PARSE_CACHE_MINIMUM_LENGTH = 4096
+PARSE_CACHE_VERSION = 1
 
-            if index_holder[0] == len(matches):
-                raise Exception('Unmatched parenthese (')
+def tokenize(source):
+    '''Returns a string with a character for the kind of each token in source,
+    and a list of the values of the atoms among them'''
+    kinds = []
+    values = []
 
-            index_holder[0] += 1
-            return create_cons_collection(r)
+    for match in token_regex.finditer(source):
+        kind = match.lastgroup
 
-        if match.group('close_parenthese'):
-            raise Exception("Unmatched parenthese )")
+        if kind == 'open_parenthese':
+            kinds.append('(')
 
-        if match.group('number'):
+        elif kind == 'close_parenthese':
+            kinds.append(')')
+
+        elif kind == 'number':
             v = float(match.group('number'))
             if v.is_integer(): v = int(v)
 
-            return MiniObject(
-                v,
-                start = match.start('number'),
-                end = match.end('number'))
-
-        if match.group('string'):
-            return MiniObject(
-                match.group('string')[1:-1],
-                start = match.start('string'),
-                end = match.end('string'))
-
-        if match.group('identifier'):
-            return MiniObject(Identifier(
-                match.group('identifier'),
-                start = match.start('identifier'),
-                end = match.end('identifier')))
-
-        if match.group('symbol'):
-            return create_symbol(
-                match.group('symbol')[1:],
-                start = match.start('symbol'),
-                end = match.end('symbol'))
+            kinds.append('n')
+            values.append(v)
 
-        assert False, "I'm not sure how this happened"
+        elif kind == 'string':
+            kinds.append('s')
+            values.append(match.group('string')[1:-1])
 
-    def parse_all_internal(matches, index_holder):
-        if index_holder[0] == len(matches):
-            return NIL
+        elif kind == 'identifier':
+            kinds.append('i')
+            values.append(match.group('identifier'))
 
-        parsed_atom = parse(matches, index_holder)
+        elif kind == 'symbol':
+            kinds.append('y')
+            values.append(match.group('symbol')[1:])
 
-        return cons(parsed_atom, parse_all_internal(matches, index_holder))
+    return ''.join(kinds), values
 
-    matches = list(token_regex.finditer(source))
-    match_index_wrapped = [0]
+def parse_tokens(kinds, values):
+    'Builds the cons list of expressions that tokenize returned kinds and values for'
+    atom_kinds = kinds.replace('(', '').replace(')', '')
+    create_symbols(value for kind, value in zip(atom_kinds, values) if kind in 'iy')
+
+    # The atoms are all created up front, so the loop below only has to
+    # follow the parentheses
+    atom_creators = {
+        'n' : create_number,
+        's' : create_string,
+        'i' : lambda identifier: MiniObject(Identifier(identifier, SYMBOLS[identifier])),
+        'y' : SYMBOLS.__getitem__,
+    }
+
+    atoms = [atom_creators[kind](value) for kind, value in zip(atom_kinds, values)]
+
+    atoms.reverse()
+    next_atom = atoms.pop
+
+    items = []
+    stack = []
+
+    for kind in kinds:
+        if kind == '(':
+            stack.append(items)
+            items = []
+
+        elif kind == ')':
+            if len(stack) == 0:
+                raise Exception("Unmatched parenthese )")
+
+            cons_list = create_cons_collection(items)
+            items = stack.pop()
+            items.append(cons_list)
+
+        else:
+            items.append(next_atom())
+
+    if len(stack) > 0:
+        raise Exception('Unmatched parenthese (')
+
+    return create_cons_collection(items)
+
+def parse_cached(source):
+    'Parses source like parse_all, using the parse cache for long sources'
+    if SOURCE_SPANS != None or len(source) < PARSE_CACHE_MINIMUM_LENGTH:
+        return parse_all(source)
+
+    cache_filename = os.path.join(PARSE_CACHE_DIRECTORY, hashlib.sha1(source).hexdigest() + '.minic')
+
+    try:
+        with open(cache_filename, 'rb') as f:
+            version, kinds, values = marshal.load(f)
+
+        if version == PARSE_CACHE_VERSION:
+            return parse_tokens(kinds, values)
 
-    return parse_all_internal(matches, match_index_wrapped)
+    # A missing or damaged cache file is replaced below
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+
+    kinds, values = tokenize(source)
+    result = parse_tokens(kinds, values)
+
+    try:
+        if not os.path.isdir(PARSE_CACHE_DIRECTORY):
+            os.makedirs(PARSE_CACHE_DIRECTORY)
+
+        # Written under a temporary name and renamed, so that other runs never
+        # read a partly written file
+        temporary_filename = '{}.{}'.format(cache_filename, os.getpid())
+
+        with open(temporary_filename, 'wb') as f:
+            marshal.dump((PARSE_CACHE_VERSION, kinds, values), f)
+
+        os.rename(temporary_filename, cache_filename)
+
+    # Parsing works without a cache, for example when it isn't writable
+    except (IOError, OSError):
+        pass
+
+    return result
 
 NIL = MiniObject(None)
 
 class Boolean(MiniObject):
-    def __init__(self, py_object, **kwargs):
-        super(Boolean,self).__init__(py_object, **kwargs)
+    __slots__ = ()
+
+    def __init__(self, py_object):
+        super(Boolean,self).__init__(py_object)
 
 TRUE = Boolean(True)
 FALSE = Boolean(False)
 
+# Values are never mutated, so the most common numbers and strings are
+# shared rather than allocated each time they are parsed or computed
+SMALL_INTEGERS = [MiniObject(i) for i in range(-5, 257)]
+SHORT_STRINGS = dict((chr(i), MiniObject(chr(i))) for i in range(128))
+SHORT_STRINGS[''] = MiniObject('')
+
+def create_number(number):
+    if type(number) is int and -5 <= number < 257:
+        return SMALL_INTEGERS[number + 5]
+
+    return MiniObject(number)
+
+def create_string(string):
+    if len(string) <= 1 and string in SHORT_STRINGS:
+        return SHORT_STRINGS[string]
+
+    return MiniObject(string)
+
 def is_number(arg):
     if isinstance(arg, float):
         return True
@@ -268,628 +924,4251 @@ def is_number(arg):
     # isinstance(True, int) returns True
     return isinstance(arg, int) and not isinstance(arg, bool)
 
+def convert_boolean(result):
+    return TRUE if result else FALSE
+
+def convert_none(result):
+    return NIL
+
+# Converts the Python values returned by builtins to MiniObjects, keyed by
+# type so that each result is converted with a single lookup. Results of other
+# types, such as MiniObjects, are returned unchanged.
+RESULT_CONVERSIONS = {
+    bool        : convert_boolean,
+    int         : create_number,
+    long        : MiniObject,
+    float       : MiniObject,
+    str         : create_string,
+    type(None)  : convert_none,
+}
+
+def convert_result(result):
+    conversion = RESULT_CONVERSIONS.get(type(result))
+
+    if conversion == None:
+        return result
+
+    return conversion(result)
+
 def py_to_mini(py_object):
     assert callable(py_object)
-    
-    def wrapped(pattern, environment):
-        result = py_object(*cons_collection_to_py_collection(pattern))
 
-        if is_number(result) or isinstance(result,MiniPair):
-            return MiniObject(result)
+    # The arity is declared by the Python function's signature, functions
+    # implemented in C are treated as taking any number of arguments
+    arity = None
 
-        if isinstance(result,str):
-            return MiniObject(result)
+    if isinstance(py_object, types.FunctionType):
+        takes_varargs = py_object.func_code.co_flags & 0x04
 
-        return {
-            True    : TRUE,
-            False   : FALSE,
-            None    : NIL,
-        }.get(result, result)
+        if not takes_varargs and py_object.func_defaults == None:
+            arity = py_object.func_code.co_argcount
+
+    def wrapped(pattern, environment):
+        return convert_result(py_object(*cons_collection_to_py_collection(pattern)))
 
-    return MiniObject(MiniWrapper(MiniObject(MiniApplicative(wrapped))))
+    return MiniObject(MiniWrapper(MiniObject(MiniApplicative(wrapped, py_object, arity))))
 
 def apply(applicative, pattern, environment):
     assert isinstance(applicative, MiniObject)
 
-    return applicative.py_object(pattern, environment)
+    return complete(applicative.py_object(pattern, environment))
 
-def evaluate(expression, environment):
+# Expressions are compiled into trees of closures which take an environment
+# and return either a value or a TailCall. Compiled code is cached on the
+# expression it was compiled from, since cons cells are never mutated.
+
+def execute(code, environment):
+    'Runs compiled code, continuing through any tail calls it returns'
+    if PROFILER != None:
+        return execute_profiled(code, environment)
+
+    result = code(environment)
+
+    while isinstance(result, TailCall):
+        result = result.code(result.environment)
+
+    return result
+
+def complete(result):
+    'Returns the value of a result which may be a TailCall'
+    if PROFILER != None:
+        return complete_profiled(result)
+
+    while isinstance(result, TailCall):
+        result = result.code(result.environment)
+
+    return result
+
+def compile_expression(expression):
     assert isinstance(expression, MiniObject)
 
-    if isinstance(expression.py_object, str) or is_number(expression.py_object):
-        return expression
+    code = getattr(expression, 'code', None)
 
-    if isinstance(expression.py_object, MiniSymbol):
-        return expression
+    if code != None:
+        return code
 
-    if isinstance(expression.py_object, MiniPair):
-        applicative = evaluate(car(expression), environment)
-        arguments = cdr(expression)
+    compiler = EXPRESSION_COMPILERS.get(type(expression.py_object))
 
-        assert isinstance(applicative, MiniObject)
-        assert isinstance(arguments, MiniObject)
+    if compiler == None:
+        code = compile_constant(None)
+    else:
+        code = compiler(expression)
 
-        if isinstance(applicative.py_object, MiniApplicative) or isinstance(applicative.py_object, MiniWrapper):
-            return apply(applicative, arguments, environment)
+    expression.code = code
+    return code
 
-        raise Exception("Expected applicative, got {}".format(applicative.py_object))
+def compile_sequence(expressions):
+    'Compiles expressions to run in order, the last one in tail position'
+    codes = [compile_expression(expression) for expression in cons_collection_to_py_collection(expressions)]
 
-    if isinstance(expression.py_object, Identifier):
-        parent_symbol = create_symbol('__parent__')
+    if len(codes) == 0:
+        return compile_constant(NIL)
 
-        while environment != None:
-            if cons_dict_has_key(environment, create_symbol(expression.py_object.symbol)) == TRUE:
-                return cons_dict_get(environment, create_symbol(expression.py_object.symbol))
-    
-            if cons_dict_has_key(environment, parent_symbol) == TRUE:
-                environment = cons_dict_get(environment, create_symbol('__parent__'))
-            else: 
-                raise Exception('UndefinedIdentifierError: Undefined identifier {}'.format(expression.py_object.symbol))
+    if len(codes) == 1:
+        return codes[0]
 
-def length(string):
-    assert isinstance(string, MiniObject)
+    leading_codes = codes[:-1]
+    last_code = codes[-1]
 
-    if isinstance(string.py_object, str):
-        return len(string.py_object)
+    def code(environment):
+        for leading_code in leading_codes:
+            execute(leading_code, environment)
 
-    raise Exception("TypeError")
+        return last_code(environment)
 
-def concatenate(l,r):
-    # TODO Implement ropes: http://citeseer.ist.psu.edu/viewdoc/download?doi=10.1.1.14.9450&rep=rep1&type=pdf
-    # TODO Apply this to other collection types
-    if isinstance(l.py_object,str) and isinstance(r.py_object, str):
-        return MiniObject(l.py_object + r.py_object)
+    return code
 
-    raise Exception('TypeError')
+def compile_constant(value):
+    def code(environment):
+        return value
 
-def is_integer(arg):
-    return isinstance(arg, int) and not isinstance(arg, bool)
+    return code
 
-def slice(string, start, end):
-    if not isinstance(string.py_object, str):
-        raise Exception('TypeError')
+def compile_identifier(expression):
+    identifier = expression.py_object
+    key_symbol = identifier.symbol_object
 
-    py_string = string.py_object
+    def lookup_by_name(environment):
+        return lookup_identifier(environment, identifier)
 
-    if is_integer(start.py_object):
-        py_start = start.py_object
+    # Addresses are assigned when the enclosing operative is created, which
+    # is normally before its body is first compiled
+    if identifier.address == None:
+        # The generation and value of the last lookup, if it found a builtin
+        cached = [(None, None)]
 
-    elif start.py_object == None:
-        py_start = 0
+        def code(environment):
+            generation, value = cached[0]
 
-    else:
-        raise Exception('TypeError')
+            if generation == BUILTINS_GENERATION and type(environment) is MiniEnvironment and environment.root is builtins:
+                return value
 
-    if is_integer(end.py_object):
-        py_end = end.py_object
+            if identifier.address != None:
+                result = lookup_address(environment, identifier.address)
 
-    elif end.py_object == None:
-        py_end = len(py_string)
+                if result != None:
+                    return result
 
-    else:
-        raise Exception('TypeError')
+            generation = BUILTINS_GENERATION
+            result = lookup_by_name(environment)
 
-    return MiniObject(py_string[py_start:py_end])
+            if result is lookup_builtin(environment, key_symbol):
+                cached[0] = (generation, result)
 
-def _assert(pattern, environment):
-    def assert_internal(*arguments):
-        if len(arguments) == 0:
-            raise Exception("ArgumentError: assert expects 1 or more arguments, received none")
-        
-        if len(arguments) == 1:
-            description = 'assertion failed'
-            assertion = arguments
-        
-        else:
-            description = arguments[0].py_object
-            assertion = arguments[1:]
-        
-        if not isinstance(assertion[-1].py_object, bool):
-            raise Exception("TypeError: `assert` expected Boolean assertion but received {} {}".format(type(assertion[-1].py_object), assertion[-1]))
-        
-        if assertion[-1] is TRUE:
-            return None
-        
-        if assertion[-1] is FALSE:
-            raise Exception("AssertionError: {}".format(description))
-        
-        assert False
+            return result
 
-    # Execute in nested scope
-    return py_to_mini(assert_internal).py_object(pattern, nest(environment))
+        return code
 
-def throws(pattern, environment):
-    if cons_collection_len(pattern) != 2:
-        raise Exception("throws? expects 2 argument, received {}".format(len(pattern)))
+    address = identifier.address
+    layouts, slot, _ = address
 
-    expression = car(pattern)
-    exception = evaluate(car(cdr(pattern)), environment)
+    if len(layouts) == 1:
+        layout = layouts[0]
 
-    if not isinstance(exception.py_object, str):
-        raise Exception('throws? expects a string as the second argument')
+        def code(environment):
+            if type(environment) is MiniEnvironment and environment.layout is layout:
+                result = environment.slots[slot]
 
-    try:
-        evaluate(expression, environment)
-        return FALSE
+                if result != None:
+                    return result
 
-    except Exception as e:
-        if ':' in e.message:
-            exception_type, message = e.message.split(':',1)
-        else:
-            exception_type = e.message
+            return lookup_by_name(environment)
 
-        if exception_type == exception.py_object:
-            return TRUE
+        return code
 
-        raise
+    def code(environment):
+        result = lookup_address(environment, address)
 
-def _not(argument):
-    if not isinstance(argument, Boolean):
-        raise Exception('TypeError: Expected Boolean but received {}'.format(type(argument)))
+        if result != None:
+            return result
 
-    if argument == TRUE:
-        return FALSE
+        return lookup_by_name(environment)
 
-    if argument == FALSE:
-        return TRUE
+    return code
 
-    assert False
+def unshadowed_builtin(key_symbol):
+    'Returns the builtin bound to key_symbol if it has never been shadowed, or None'
+    if not CACHED_BUILTIN_LOOKUPS or key_symbol in SHADOWED_SYMBOLS:
+        return None
 
-def evaluate_expressions(expressions, environment):
-    result = NIL
+    return builtins.get_local(key_symbol)
 
-    while expressions != NIL:
-        result = evaluate(car(expressions), environment)
-        expressions = cdr(expressions)
+def lookup_builtin(environment, key_symbol):
+    '''Returns the builtin bound to key_symbol if nothing in environment can
+    shadow it, or None'''
+    if type(environment) is not MiniEnvironment or environment.root is not builtins:
+        return None
 
-    return result
+    return unshadowed_builtin(key_symbol)
 
-def cons_collection_len(cons_collection):
-    result = 0
+def lookup_identifier(environment, identifier):
+    result = lookup(environment, identifier.symbol_object)
 
-    while cons_collection != NIL:
-        result += 1
-        cons_collection = cdr(cons_collection)
+    if result == None:
+        raise Exception('UndefinedIdentifierError: Undefined identifier {}'.format(identifier.symbol))
 
     return result
 
-def define(pattern, environment):
-    if cons_collection_len(pattern) < 2:
-        raise Exception('DefineError: `define` expected two arguments, received {}'.format(cons_collection_len(pattern)))
+def apply_wrapper(wrapper, evaluated_arguments, environment):
+    'Applies a MiniWrapper to a list of arguments which have already been evaluated'
+    operative = wrapper.operative.py_object
+
+    if isinstance(operative, MiniApplicative) and operative.builtin != None:
+        return convert_result(operative.builtin(*evaluated_arguments))
+
+    return operative(create_cons_collection(evaluated_arguments), environment)
+
+def compile_application(expression):
+    head_code = compile_expression(car(expression))
+    arguments = cdr(expression)
+
+    # Argument codes are only compiled once a wrapper is applied, since the
+    # arguments to an operative might not be expressions at all
+    argument_codes = []
+
+    # Calls to builtins and the builtin special forms are compiled the first
+    # time they are seen here, and used for as long as the head keeps
+    # evaluating to the same applicative. The applicative and its code are
+    # replaced together, so that code running in other threads never sees
+    # one without the other.
+    specialized = [(None, None)]
+
+    def code(environment):
+        applicative = execute(head_code, environment)
+
+        if PROFILER != None:
+            return PROFILER.apply(applicative, expression, environment)
+
+        specialized_applicative, specialized_code = specialized[0]
+
+        if applicative is specialized_applicative:
+            return specialized_code(environment)
+
+        py_applicative = applicative.py_object
+
+        if isinstance(py_applicative, MiniWrapper):
+            if len(argument_codes) == 0 and arguments is not NIL:
+                argument_codes[:] = [compile_expression(argument) for argument in cons_collection_to_py_collection(arguments)]
+
+            builtin_code = compile_builtin_call(py_applicative, argument_codes)
+
+            if builtin_code != None:
+                specialized[0] = (applicative, builtin_code)
+                return builtin_code(environment)
+
+            return apply_wrapper(
+                py_applicative,
+                [execute(argument_code, environment) for argument_code in argument_codes],
+                environment)
+
+        if isinstance(py_applicative, MiniApplicative):
+            special_form_code = compile_special_form(py_applicative, arguments)
+
+            if special_form_code != None:
+                specialized[0] = (applicative, special_form_code)
+                return special_form_code(environment)
+
+            return py_applicative(arguments, environment)
+
+        raise Exception("Expected applicative, got {}".format(py_applicative))
+
+    if is_constant_expression(expression):
+        return compile_folding(expression, code)
+
+    return code
+
+# Constant folding: calls to these builtins, with arguments that are literals,
+# builtins or folded calls, are evaluated once and replaced by their value.
+# A folded value is only used while none of the builtins it was computed
+# from have been shadowed, see lookup_builtin.
+
+def foldable_builtin(value):
+    'Returns the Python function of a builtin which can be folded, or None'
+    if value is None or not isinstance(value.py_object, MiniWrapper):
+        return None
+
+    operative = value.py_object.operative.py_object
+
+    if isinstance(operative, MiniApplicative) and operative.builtin in FOLDABLE_BUILTINS:
+        return operative.builtin
+
+    return None
+
+def is_constant_expression(expression):
+    '''Returns whether expression only refers to builtins which have never
+    been shadowed, and only calls those which can be folded'''
+    py_object = expression.py_object
+
+    if isinstance(py_object, Identifier):
+        return unshadowed_builtin(py_object.symbol_object) != None
+
+    if isinstance(py_object, MiniPair):
+        head = car(expression).py_object
+
+        if not isinstance(head, Identifier) or foldable_builtin(unshadowed_builtin(head.symbol_object)) == None:
+            return False
+
+        arguments = cdr(expression)
+
+        while isinstance(arguments.py_object, MiniPair):
+            if not is_constant_expression(car(arguments)):
+                return False
+
+            arguments = cdr(arguments)
+
+        return arguments is NIL
+
+    return EXPRESSION_COMPILERS.get(type(py_object)) is compile_constant
+
+def fold_constant(expression, environment):
+    'Returns the value of a constant expression, or None if it cannot be folded in environment'
+    py_object = expression.py_object
+
+    if isinstance(py_object, Identifier):
+        return lookup_builtin(environment, py_object.symbol_object)
+
+    if not isinstance(py_object, MiniPair):
+        return expression
+
+    builtin = foldable_builtin(fold_constant(car(expression), environment))
+
+    if builtin == None:
+        return None
+
+    arguments = []
+
+    for argument in cons_collection_to_py_collection(cdr(expression)):
+        value = fold_constant(argument, environment)
+
+        if value is None:
+            return None
+
+        arguments.append(value)
+
+    # Errors are left to be raised when the expression is evaluated
+    try:
+        return convert_result(builtin(*arguments))
+
+    except Exception:
+        return None
+
+def compile_folding(expression, application_code):
+    '''Returns code which folds a constant application the first time it
+    runs, and runs application_code if it can't be folded'''
+    # The generation of the last attempt to fold, and the value if it succeeded
+    folded = [(None, None)]
+
+    def code(environment):
+        if PROFILER != None:
+            return application_code(environment)
+
+        generation, value = folded[0]
+
+        if generation != BUILTINS_GENERATION or type(environment) is not MiniEnvironment or environment.root is not builtins:
+            generation = BUILTINS_GENERATION
+            value = fold_constant(expression, environment)
+            folded[0] = (generation, value)
+
+        if value is None:
+            return application_code(environment)
+
+        return value
+
+    return code
+
+def compile_builtin_call(wrapper, argument_codes):
+    '''Returns code which evaluates the arguments straight into a call to the
+    Python function of a wrapped builtin, or None if wrapper isn't one'''
+    operative = wrapper.operative.py_object
+
+    if not isinstance(operative, MiniApplicative) or operative.builtin == None:
+        return None
+
+    # Calls with the wrong number of arguments take the general path, which
+    # raises the error
+    if operative.arity != None and operative.arity != len(argument_codes):
+        return None
+
+    builtin = operative.builtin
+
+    if len(argument_codes) == 0:
+        def code(environment):
+            return convert_result(builtin())
+
+    elif len(argument_codes) == 1:
+        argument_code, = argument_codes
 
+        def code(environment):
+            return convert_result(builtin(execute(argument_code, environment)))
+
+    elif len(argument_codes) == 2:
+        left_code, right_code = argument_codes
+
+        def code(environment):
+            return convert_result(builtin(execute(left_code, environment), execute(right_code, environment)))
+
+    else:
+        def code(environment):
+            return convert_result(builtin(*[execute(argument_code, environment) for argument_code in argument_codes]))
+
+    return code
+
+def compile_special_form(applicative, pattern):
+    'Returns code specialized for applying one of the builtin special forms to pattern, or None'
+    if applicative.operative is _if and cons_collection_len(pattern) == 3:
+        return compile_if(pattern)
+
+    if applicative.operative is cond and is_cons_list(pattern) == TRUE:
+        return compile_cond(pattern)
+
+    if applicative.operative is _and and cons_collection_len(pattern) == 2:
+        return compile_and(pattern)
+
+    if applicative.operative is _or and cons_collection_len(pattern) == 2:
+        return compile_or(pattern)
+
+    if applicative.operative is function and isinstance(pattern.py_object, MiniPair):
+        return compile_function(pattern)
+
+    if applicative.operative is define and cons_collection_len(pattern) >= 2 and isinstance(car(pattern).py_object, Identifier):
+        return compile_define(pattern)
+
+    return None
+
+def compile_if(pattern):
+    condition_code = compile_expression(car(pattern))
+    if_result_true_code = compile_expression(car(cdr(pattern)))
+    if_result_false_code = compile_expression(car(cdr(cdr(pattern))))
+
+    def code(environment):
+        result = execute(condition_code, environment)
+
+        if result is TRUE:
+            return if_result_true_code(environment)
+        if result is FALSE:
+            return if_result_false_code(environment)
+
+        raise Exception("TypeError: `if` expects boolean, received {}".format(type(result)))
+
+    return code
+
+def compile_cond(pattern):
+    cases = [(compile_expression(car(case)), compile_expression(car(cdr(case))))
+        for case in cons_collection_to_py_collection(pattern)]
+
+    def code(environment):
+        for condition_code, result_code in cases:
+            result = execute(condition_code, environment)
+
+            if result is TRUE:
+                return result_code(environment)
+
+            if result is not FALSE:
+                raise Exception("TypeError: `cond` expects boolean, received {}".format(type(result)))
+
+        return NIL
+
+    return code
+
+def compile_and(pattern):
+    left_code = compile_expression(car(pattern))
+    right_code = compile_expression(car(cdr(pattern)))
+
+    def code(environment):
+        result = execute(left_code, environment)
+
+        if result is TRUE:
+            return right_code(environment)
+        if result is FALSE:
+            return FALSE
+
+        raise Exception("TypeError: `and` expects boolean, received {}".format(type(result)))
+
+    return code
+
+def compile_or(pattern):
+    left_code = compile_expression(car(pattern))
+    right_code = compile_expression(car(cdr(pattern)))
+
+    def code(environment):
+        result = execute(left_code, environment)
+
+        if result is TRUE:
+            return TRUE
+        if result is FALSE:
+            return right_code(environment)
+
+        raise Exception("TypeError: `or` expects boolean, received {}".format(type(result)))
+
+    return code
+
+def compile_function(pattern):
+    # The operative pattern is built once, so that its layout and compiled
+    # body are shared by every function this expression creates
+    operative_pattern = function_operative_pattern(pattern)
+
+    def code(environment):
+        return wrap(operative(operative_pattern, environment))
+
+    return code
+
+def compile_define(pattern):
     head = car(pattern)
-    body = cdr(pattern)
+    key_symbol = head.py_object.symbol_object
+    body_code = compile_sequence(cdr(pattern))
 
-    if isinstance(head.py_object, Identifier):
-        identifier = head.py_object.symbol
+    def code(environment):
+        if not isinstance(environment, MiniEnvironment):
+            return define(pattern, environment)
+
+        if lookup(environment, key_symbol) != None:
+            raise Exception('AlreadyDefinedError: the identifier {} is already defined'.format(head.py_object.symbol))
+
+        environment.set_binding(key_symbol, name_applicative(execute(body_code, environment), head.py_object.symbol))
 
-        if is_defined(head, environment) == TRUE:
-            raise Exception('AlreadyDefinedError: the identifier {} is already defined'.format(identifier))
-    
-        environment[identifier] = evaluate_expressions(body, environment)
-    
         return NIL
-    
-    elif isinstance(head.py_object, MiniPair):
-        raise Exception('NotImplementedError: Defining patterns is not yet implemented')
 
-    else:
-        raise Exception("DefineError")
+    return code
+
+def evaluate(expression, environment):
+    return execute(compile_expression(expression), environment)
+
+def evaluate_in_tail_position(expression, environment):
+    'The `evaluate` builtin, which leaves the evaluation to the caller\'s execute loop'
+    return TailCall(compile_expression(expression), environment)
+
+ROPE_LEAF_LENGTH = 256
+
+class Rope(object):
+    '''A string made of two halves, each either a str or another Rope. Ropes
+    are kept balanced by height, so concatenating or slicing them never copies
+    more than the short strings at their ends. A rope is only flattened into
+    one str when it has to leave the interpreter.
+    See http://citeseer.ist.psu.edu/viewdoc/download?doi=10.1.1.14.9450&rep=rep1&type=pdf'''
+    __slots__ = ('left', 'right', 'length', 'height', 'flattened')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.length = len(left) + len(right)
+        self.height = 1 + max(rope_height(left), rope_height(right))
+        self.flattened = None
+
+    def __len__(self):
+        return self.length
+
+    def leaves(self):
+        stack = [self]
+
+        while stack:
+            node = stack.pop()
+
+            if isinstance(node, Rope):
+                stack.append(node.right)
+                stack.append(node.left)
+            else:
+                yield node
+
+    def __str__(self):
+        if self.flattened is None:
+            self.flattened = ''.join(self.leaves())
+
+        return self.flattened
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __eq__(self, other):
+        if not is_string(other):
+            return False
+
+        return len(self) == len(other) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+# MappedStrings are written and compared this many bytes at a time
+MAPPED_CHUNK_LENGTH = 1 << 20
+
+class MappedString(object):
+    '''A string read from a memory mapped file. Slicing a mapped string returns
+    another view of the same mapping, so neither slicing nor taking the length
+    reads the file, and the operating system only pages in what is used.'''
+    __slots__ = ('mapping', 'start', 'end')
+
+    def __init__(self, mapping, start, end):
+        self.mapping = mapping
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def slice(self, start, end):
+        'Returns the view from start to end, where 0 <= start <= end <= len(self)'
+        return MappedString(self.mapping, self.start + start, self.start + end)
+
+    def chunks(self):
+        for start in range(self.start, self.end, MAPPED_CHUNK_LENGTH):
+            yield self.mapping[start:min(start + MAPPED_CHUNK_LENGTH, self.end)]
+
+    def __str__(self):
+        return self.mapping[self.start:self.end]
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __eq__(self, other):
+        if not is_string(other):
+            return False
+
+        if len(self) != len(other):
+            return False
+
+        if isinstance(other, MappedString):
+            return all(l == r for l, r in zip(self.chunks(), other.chunks()))
+
+        return str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+def is_string(py_object):
+    return isinstance(py_object, str) or isinstance(py_object, Rope) or isinstance(py_object, MappedString)
+
+def rope_height(string):
+    if isinstance(string, Rope):
+        return string.height
+
+    return 0
+
+def rope_balance(left, right):
+    'Joins two ropes whose heights differ by at most two, rotating if they differ by two'
+    if rope_height(left) > rope_height(right) + 1:
+        if rope_height(left.left) >= rope_height(left.right):
+            return Rope(left.left, Rope(left.right, right))
+
+        return Rope(Rope(left.left, left.right.left), Rope(left.right.right, right))
+
+    if rope_height(right) > rope_height(left) + 1:
+        if rope_height(right.right) >= rope_height(right.left):
+            return Rope(Rope(left, right.left), right.right)
+
+        return Rope(Rope(left, right.left.left), Rope(right.left.right, right.right))
+
+    return Rope(left, right)
+
+def rope_concatenate(l, r):
+    if len(l) == 0:
+        return r
+
+    if len(r) == 0:
+        return l
+
+    # Short pieces are copied into one leaf rather than getting a node of their own
+    if isinstance(l, str) and isinstance(r, str) and len(l) + len(r) <= ROPE_LEAF_LENGTH:
+        return l + r
+
+    if isinstance(l, Rope) and isinstance(l.right, str) and isinstance(r, str) and len(l.right) + len(r) <= ROPE_LEAF_LENGTH:
+        return rope_balance(l.left, l.right + r)
+
+    if isinstance(r, Rope) and isinstance(r.left, str) and isinstance(l, str) and len(l) + len(r.left) <= ROPE_LEAF_LENGTH:
+        return rope_balance(l + r.left, r.right)
+
+    # Join the shorter rope into the side of the taller one
+    if rope_height(l) > rope_height(r) + 1:
+        return rope_balance(l.left, rope_concatenate(l.right, r))
+
+    if rope_height(r) > rope_height(l) + 1:
+        return rope_balance(rope_concatenate(l, r.left), r.right)
+
+    return Rope(l, r)
+
+def rope_slice(string, start, end):
+    'Slices a str or Rope, where 0 <= start <= end <= len(string)'
+    if isinstance(string, str):
+        return string[start:end]
+
+    if start == 0 and end == string.length:
+        return string
+
+    if string.flattened is not None and end - start <= ROPE_LEAF_LENGTH:
+        return string.flattened[start:end]
+
+    left_length = len(string.left)
+
+    if end <= left_length:
+        return rope_slice(string.left, start, end)
+
+    if start >= left_length:
+        return rope_slice(string.right, start - left_length, end - left_length)
+
+    return rope_concatenate(
+        rope_slice(string.left, start, left_length),
+        rope_slice(string.right, 0, end - left_length))
+
+def length(string):
+    assert isinstance(string, MiniObject)
+
+    if is_string(string.py_object):
+        return len(string.py_object)
+
+    if isinstance(string.py_object, MiniVector) or isinstance(string.py_object, MiniMap) or isinstance(string.py_object, NumericArray):
+        return len(string.py_object)
+
+    raise Exception("TypeError")
+
+def concatenate(l,r):
+    # TODO Apply this to other collection types
+    if is_string(l.py_object) and is_string(r.py_object):
+        # Ropes are made of strs, so mapped strings are read when concatenated
+        l, r = [str(string.py_object) if isinstance(string.py_object, MappedString) else string.py_object for string in (l, r)]
+        return MiniObject(rope_concatenate(l, r))
+
+    raise Exception('TypeError')
+
+def is_integer(arg):
+    return isinstance(arg, int) and not isinstance(arg, bool)
+
+def slice(string, start, end):
+    if not is_string(string.py_object):
+        raise Exception('TypeError')
+
+    py_string = string.py_object
+
+    if is_integer(start.py_object):
+        py_start = start.py_object
+
+    elif start.py_object == None:
+        py_start = 0
+
+    else:
+        raise Exception('TypeError')
+
+    if is_integer(end.py_object):
+        py_end = end.py_object
+
+    elif end.py_object == None:
+        py_end = len(py_string)
+
+    else:
+        raise Exception('TypeError')
+
+    if isinstance(py_string, str):
+        return MiniObject(py_string[py_start:py_end])
+
+    # Ropes and mapped strings are sliced with the same rules as Python strings
+    if py_start < 0:
+        py_start = max(py_start + len(py_string), 0)
+
+    if py_end < 0:
+        py_end = max(py_end + len(py_string), 0)
+
+    py_start = min(py_start, len(py_string))
+    py_end = max(min(py_end, len(py_string)), py_start)
+
+    if isinstance(py_string, MappedString):
+        return MiniObject(py_string.slice(py_start, py_end))
+
+    return MiniObject(rope_slice(py_string, py_start, py_end))
+
+VECTOR_BITS = 5
+VECTOR_WIDTH = 1 << VECTOR_BITS
+VECTOR_MASK = VECTOR_WIDTH - 1
+
+class MiniVector(object):
+    '''An immutable vector stored as a trie of tuples of up to VECTOR_WIDTH
+    items. Indexing walks one tuple per level, and updates copy the tuples on
+    one path and share everything else with the original vector.'''
+    __slots__ = ('count', 'shift', 'root')
+
+    def __init__(self, count, shift, root):
+        self.count = count
+        self.shift = shift
+        self.root = root
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise Exception('IndexError: Index {} is out of range for vector of length {}'.format(index, self.count))
+
+        node = self.root
+        level = self.shift
+
+        while level > 0:
+            node = node[(index >> level) & VECTOR_MASK]
+            level -= VECTOR_BITS
+
+        return node[index & VECTOR_MASK]
+
+    def set(self, index, item):
+        if not 0 <= index < self.count:
+            raise Exception('IndexError: Index {} is out of range for vector of length {}'.format(index, self.count))
+
+        def set_internal(node, level):
+            node = list(node)
+
+            if level == 0:
+                node[index & VECTOR_MASK] = item
+            else:
+                child = (index >> level) & VECTOR_MASK
+                node[child] = set_internal(node[child], level - VECTOR_BITS)
+
+            return tuple(node)
+
+        return MiniVector(self.count, self.shift, set_internal(self.root, self.shift))
+
+    def append(self, item):
+        index = self.count
+        root = self.root
+        shift = self.shift
+
+        # A full trie gets a new root with the old one as its first child
+        if self.count > 0 and self.count == 1 << (shift + VECTOR_BITS):
+            root = (root,)
+            shift += VECTOR_BITS
+
+        def append_internal(node, level):
+            node = list(node)
+
+            if level == 0:
+                node.append(item)
+            else:
+                child = (index >> level) & VECTOR_MASK
+
+                if child < len(node):
+                    node[child] = append_internal(node[child], level - VECTOR_BITS)
+                else:
+                    node.append(append_internal((), level - VECTOR_BITS))
+
+            return tuple(node)
+
+        return MiniVector(self.count + 1, shift, append_internal(root, shift))
+
+    def __iter__(self):
+        stack = [(self.root, self.shift)]
+
+        while stack:
+            node, level = stack.pop()
+
+            if level == 0:
+                for item in node:
+                    yield item
+            else:
+                stack.extend((child, level - VECTOR_BITS) for child in reversed(node))
+
+    def __eq__(self, other):
+        if not isinstance(other, MiniVector) or len(self) != len(other):
+            return False
+
+        return all(eq(l, r) for l, r in zip(self, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(item.py_object for item in self))
+
+    def __repr__(self):
+        return '<vector {}>'.format(', '.join(repr(item) for item in self))
+
+def create_vector(items):
+    'Builds a vector from a Python sequence of MiniObjects in one pass'
+    nodes = [tuple(items[i:i + VECTOR_WIDTH]) for i in range(0, len(items), VECTOR_WIDTH)]
+    shift = 0
+
+    if len(nodes) <= 1:
+        return MiniVector(len(items), 0, nodes[0] if nodes else ())
+
+    while len(nodes) > VECTOR_WIDTH:
+        nodes = [tuple(nodes[i:i + VECTOR_WIDTH]) for i in range(0, len(nodes), VECTOR_WIDTH)]
+        shift += VECTOR_BITS
+
+    return MiniVector(len(items), shift + VECTOR_BITS, tuple(nodes))
+
+def map_key(key):
+    'Returns the Python value that identifies a MiniObject used as a map key'
+    # Environments are keyed by identity, as they are compared everywhere else
+    if isinstance(key, MiniEnvironment):
+        return ('environment', key)
+
+    py_object = key.py_object
+
+    if isinstance(py_object, Rope) or isinstance(py_object, MappedString):
+        py_object = str(py_object)
+
+    # Otherwise true and 1 would be the same key
+    return (isinstance(py_object, bool), py_object)
+
+class HashMapNode(object):
+    '''A node of a hash array mapped trie. Entries are (map key, hash, key, value)
+    tuples or child nodes, stored in the order of their bits in bitmap. A
+    bitmap of None marks a node of entries whose hashes are all equal.'''
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+def bit_count(integer):
+    return bin(integer).count('1')
+
+def hash_map_find(node, k, h):
+    shift = 0
+
+    while node != None:
+        if node.bitmap == None:
+            for entry in node.entries:
+                if entry[0] == k:
+                    return entry
+
+            return None
+
+        bit = 1 << ((h >> shift) & VECTOR_MASK)
+
+        if not node.bitmap & bit:
+            return None
+
+        entry = node.entries[bit_count(node.bitmap & (bit - 1))]
+
+        if isinstance(entry, HashMapNode):
+            node = entry
+            shift += VECTOR_BITS
+
+        elif entry[0] == k:
+            return entry
+
+        else:
+            return None
+
+    return None
+
+def hash_map_pair(l, r, shift):
+    'Returns a node holding two entries with different keys'
+    if shift >= 32:
+        return HashMapNode(None, (l, r))
+
+    l_bits = (l[1] >> shift) & VECTOR_MASK
+    r_bits = (r[1] >> shift) & VECTOR_MASK
+
+    if l_bits == r_bits:
+        return HashMapNode(1 << l_bits, (hash_map_pair(l, r, shift + VECTOR_BITS),))
+
+    if l_bits > r_bits:
+        l, r = r, l
+
+    return HashMapNode((1 << l_bits) | (1 << r_bits), (l, r))
+
+def hash_map_set(node, entry, shift):
+    'Returns a copy of node with entry added and whether its key is new'
+    if node.bitmap == None:
+        entries = tuple(existing for existing in node.entries if existing[0] != entry[0])
+        return HashMapNode(None, entries + (entry,)), len(entries) == len(node.entries)
+
+    bit = 1 << ((entry[1] >> shift) & VECTOR_MASK)
+    index = bit_count(node.bitmap & (bit - 1))
+    entries = list(node.entries)
+
+    if not node.bitmap & bit:
+        entries.insert(index, entry)
+        return HashMapNode(node.bitmap | bit, tuple(entries)), True
+
+    existing = entries[index]
+
+    if isinstance(existing, HashMapNode):
+        entries[index], is_new = hash_map_set(existing, entry, shift + VECTOR_BITS)
+
+    elif existing[0] == entry[0]:
+        entries[index], is_new = entry, False
+
+    else:
+        entries[index], is_new = hash_map_pair(existing, entry, shift + VECTOR_BITS), True
+
+    return HashMapNode(node.bitmap, tuple(entries)), is_new
+
+class MiniMap(object):
+    'An immutable map stored as a hash array mapped trie, so updates share most of their nodes'
+    __slots__ = ('count', 'root')
+
+    def __init__(self, count, root):
+        self.count = count
+        self.root = root
+
+    def __len__(self):
+        return self.count
+
+    def find(self, key):
+        'Returns the (map key, hash, key, value) entry for key, or None'
+        k = map_key(key)
+        return hash_map_find(self.root, k, hash(k) & 0xFFFFFFFF)
+
+    def set(self, key, value):
+        k = map_key(key)
+        root, is_new = hash_map_set(self.root, (k, hash(k) & 0xFFFFFFFF, key, value), 0)
+        return MiniMap(self.count + 1 if is_new else self.count, root)
+
+    def entries(self):
+        stack = [self.root]
+
+        while stack:
+            node = stack.pop()
+
+            for entry in reversed(node.entries):
+                if isinstance(entry, HashMapNode):
+                    stack.append(entry)
+                else:
+                    yield entry
+
+    def __eq__(self, other):
+        if not isinstance(other, MiniMap) or len(self) != len(other):
+            return False
+
+        for k, h, key, value in self.entries():
+            other_entry = hash_map_find(other.root, k, h)
+
+            if other_entry == None or not eq(value, other_entry[3]):
+                return False
+
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(frozenset((k, value.py_object) for k, h, key, value in self.entries()))
+
+    def __repr__(self):
+        return '<map {}>'.format(', '.join('{} {}'.format(repr(key), repr(value)) for k, h, key, value in self.entries()))
+
+EMPTY_MAP = MiniMap(0, HashMapNode(0, ()))
+
+class NumericArray(object):
+    '''A packed array of floats, stored in an array.array.
+    Arithmetic and comparisons on arrays work on all of their elements in one
+    call. Comparisons return masks, arrays of 1.0 where the comparison is true
+    and 0.0 where it is false.'''
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __eq__(self, other):
+        if not isinstance(other, NumericArray) or len(self) != len(other):
+            return False
+
+        return all(l == r for l, r in itertools.izip(self.values, other.values))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(self.values))
+
+    def __repr__(self):
+        return '<array {}>'.format(', '.join(repr(float(value)) for value in self.values))
+
+# The compiler for each type of expression. Other values, such as booleans
+# returned by builtins, evaluate to None.
+EXPRESSION_COMPILERS = {
+    str         : compile_constant,
+    Rope        : compile_constant,
+    MappedString    : compile_constant,
+    int         : compile_constant,
+    long        : compile_constant,
+    float       : compile_constant,
+    MiniVector  : compile_constant,
+    MiniMap     : compile_constant,
+    NumericArray    : compile_constant,
+    MiniSymbol  : compile_constant,
+    MiniPair    : compile_application,
+    Identifier  : compile_identifier,
+}
+
+def check_vector(name, vector):
+    if not isinstance(vector.py_object, MiniVector):
+        raise Exception('TypeError: `{}` expected vector, received {}'.format(name, type(vector.py_object)))
+
+def check_index(name, index):
+    if not is_integer(index.py_object):
+        raise Exception('TypeError: `{}` expected integer index, received {}'.format(name, type(index.py_object)))
+
+def check_map(name, dictionary):
+    if not isinstance(dictionary.py_object, MiniMap):
+        raise Exception('TypeError: `{}` expected map, received {}'.format(name, type(dictionary.py_object)))
+
+def vector(*items):
+    return MiniObject(create_vector(items))
+
+def is_vector(mini_object):
+    return isinstance(mini_object.py_object, MiniVector)
+
+def vector_ref(vector, index):
+    check_vector('vector-ref', vector)
+    check_index('vector-ref', index)
+
+    return vector.py_object[index.py_object]
+
+def vector_set(vector, index, item):
+    check_vector('vector-set', vector)
+    check_index('vector-set', index)
+
+    return MiniObject(vector.py_object.set(index.py_object, item))
+
+def vector_append(vector, item):
+    check_vector('vector-append', vector)
+
+    return MiniObject(vector.py_object.append(item))
+
+def vector_to_cons_list(vector):
+    check_vector('vector->cons-list', vector)
+
+    return create_cons_collection(list(vector.py_object))
+
+def cons_list_to_vector(cons_list):
+    return MiniObject(create_vector(list(cons_collection_to_py_collection(cons_list))))
+
+def _map(*keys_and_values):
+    if len(keys_and_values) % 2 != 0:
+        raise Exception('ArgumentError: `map` expected keys and values in pairs, received {} arguments'.format(len(keys_and_values)))
+
+    result = EMPTY_MAP
+
+    for i in range(0, len(keys_and_values), 2):
+        result = result.set(keys_and_values[i], keys_and_values[i + 1])
+
+    return MiniObject(result)
+
+def is_map(mini_object):
+    return isinstance(mini_object.py_object, MiniMap)
+
+def map_get(dictionary, key):
+    check_map('map-get', dictionary)
+
+    entry = dictionary.py_object.find(key)
+
+    if entry == None:
+        raise Exception('KeyError: Map does not contain key "{}"'.format(key))
+
+    return entry[3]
+
+def map_set(dictionary, key, value):
+    check_map('map-set', dictionary)
+
+    return MiniObject(dictionary.py_object.set(key, value))
+
+def map_has_key(dictionary, key):
+    check_map('map-has-key?', dictionary)
+
+    return dictionary.py_object.find(key) != None
+
+def map_to_association_list(dictionary):
+    check_map('map->association-list', dictionary)
+
+    return create_cons_collection([cons(key, value) for k, h, key, value in dictionary.py_object.entries()])
+
+def association_list_to_map(association_list):
+    result = EMPTY_MAP
+
+    for association in cons_collection_to_py_collection(association_list):
+        result = result.set(car(association), cdr(association))
+
+    return MiniObject(result)
+
+def create_numeric_array(values):
+    'Returns a NumericArray of the numbers in an iterable'
+    return NumericArray(array.array('d', values))
+
+def check_array(name, mini_array):
+    if not isinstance(mini_array.py_object, NumericArray):
+        raise Exception('TypeError: `{}` expected array, received {}'.format(name, type(mini_array.py_object)))
+
+    return mini_array.py_object.values
+
+def array_operation(name, operation, l, r):
+    '''Applies operation to each pair of elements of two arrays of the same
+    length, or to each element of an array and a number'''
+    for operand in (l, r):
+        if not isinstance(operand, NumericArray) and not is_number(operand):
+            raise Exception('TypeError: `{}` expected arrays or numbers, received {}'.format(name, type(operand)))
+
+    if isinstance(l, NumericArray) and isinstance(r, NumericArray) and len(l) != len(r):
+        raise Exception('ArgumentError: `{}` expected arrays of the same length, received {} and {}'.format(name, len(l), len(r)))
+
+    l = l.values if isinstance(l, NumericArray) else itertools.repeat(l)
+    r = r.values if isinstance(r, NumericArray) else itertools.repeat(r)
+
+    return NumericArray(array.array('d', itertools.imap(operation, l, r)))
+
+def _array(*numbers):
+    return MiniObject(cons_list_to_array_values('array', numbers))
+
+def is_array(mini_object):
+    return isinstance(mini_object.py_object, NumericArray)
+
+def cons_list_to_array_values(name, items):
+    numbers = [item.py_object for item in items]
+
+    for number in numbers:
+        if not is_number(number):
+            raise Exception('TypeError: `{}` expected numbers, received {}'.format(name, type(number)))
+
+    return create_numeric_array(numbers)
+
+def cons_list_to_array(cons_list):
+    return MiniObject(cons_list_to_array_values('cons-list->array', cons_collection_to_py_collection(cons_list)))
+
+def array_to_cons_list(mini_array):
+    return create_cons_collection([MiniObject(float(value)) for value in check_array('array->cons-list', mini_array)])
+
+def array_range(start, end):
+    check_index('array-range', start)
+    check_index('array-range', end)
+
+    return MiniObject(NumericArray(array.array('d', xrange(start.py_object, end.py_object))))
+
+def array_ref(mini_array, index):
+    values = check_array('array-ref', mini_array)
+    check_index('array-ref', index)
+
+    return float(values[index.py_object])
+
+def array_sum(mini_array):
+    return sum(check_array('array-sum', mini_array))
+
+def check_not_empty(name, values):
+    if len(values) == 0:
+        raise Exception('ValueError: `{}` expected an array with elements'.format(name))
+
+def array_min(mini_array):
+    values = check_array('array-min', mini_array)
+    check_not_empty('array-min', values)
+
+    return min(values)
+
+def array_max(mini_array):
+    values = check_array('array-max', mini_array)
+    check_not_empty('array-max', values)
+
+    return max(values)
+
+def array_mean(mini_array):
+    values = check_array('array-mean', mini_array)
+    check_not_empty('array-mean', values)
+
+    return array_sum(mini_array) / len(values)
+
+def array_select(mini_array, mask):
+    values = check_array('array-select', mini_array)
+    mask_values = check_array('array-select', mask)
+
+    if len(values) != len(mask_values):
+        raise Exception('ArgumentError: `array-select` expected a mask of the same length, received {} and {}'.format(len(values), len(mask_values)))
+
+    return MiniObject(NumericArray(array.array('d', itertools.compress(values, mask_values))))
+
+def array_comparison(name, operation):
+    def compare(l, r):
+        return MiniObject(array_operation(name, operation, l.py_object, r.py_object))
+
+    return compare
+
+def structural_key(mini_object):
+    '''Returns a hashable Python value which is equal for MiniObjects of equal
+    structure. Pairs, vectors and maps are compared by their contents, other
+    values like map keys, and environments by identity.'''
+    if isinstance(mini_object, MiniEnvironment):
+        return ('environment', mini_object)
+
+    py_object = mini_object.py_object
+
+    if isinstance(py_object, MiniPair):
+        items = []
+
+        while isinstance(py_object, MiniPair):
+            items.append(structural_key(py_object.car))
+            py_object = py_object.cdr.py_object
+
+        return ('pair', tuple(items), structural_key(MiniObject(py_object)) if py_object != None else None)
+
+    if isinstance(py_object, MiniVector):
+        return ('vector', tuple(structural_key(item) for item in py_object))
+
+    if isinstance(py_object, MiniMap):
+        return ('map', frozenset((k, structural_key(value)) for k, h, key, value in py_object.entries()))
+
+    if isinstance(py_object, Identifier):
+        return ('identifier', py_object.symbol_object)
+
+    return map_key(mini_object)
+
+def approximate_size(key):
+    'Returns roughly how many bytes a structural key takes, counting its nested tuples'
+    size = 0
+    stack = [key]
+
+    while stack:
+        item = stack.pop()
+        size += sys.getsizeof(item)
+
+        if isinstance(item, (tuple, frozenset)):
+            stack.extend(item)
+
+    return size
+
+def integer_options(name, options, defaults):
+    '''Returns defaults updated from options, alternating symbols naming keys
+    of defaults and non-negative integers'''
+    if len(options) % 2 != 0:
+        raise Exception('ArgumentError: `{}` expected options in pairs, received {} arguments'.format(name, len(options)))
+
+    result = dict(defaults)
+
+    for i in range(0, len(options), 2):
+        option, value = options[i].py_object, options[i + 1].py_object
+
+        if not isinstance(option, MiniSymbol) or option.string not in result:
+            raise Exception('ArgumentError: `{}` expected one of {}, received {}'.format(
+                name, ', '.join(':' + key for key in sorted(result)), option))
+
+        if not is_integer(value) or value < 0:
+            raise Exception('TypeError: `{}` expected non-negative integer for :{}, received {}'.format(name, option.string, value))
+
+        result[option.string] = value
+
+    return result
+
+MEMOIZE_DEFAULT_MAX_ENTRIES = 1024
+
+class Memoized(object):
+    '''The operative of a memoized applicative. Results are kept in least
+    recently used order, and the oldest are evicted once there are more than
+    max_entries of them or they take more than max_bytes.'''
+
+    def __init__(self, applicative, max_entries, max_bytes):
+        self.applicative = applicative
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.cache = collections.OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, pattern, environment):
+        if isinstance(self.applicative.py_object, MiniWrapper):
+            return structural_key(pattern)
+
+        # An operative receives its arguments unevaluated, so the same
+        # arguments only mean the same thing in the same environment
+        return (structural_key(pattern), environment)
+
+    def __call__(self, pattern, environment):
+        key = self.key(pattern, environment)
+        entry = self.cache.pop(key, None)
+
+        if entry != None:
+            self.hits += 1
+            self.cache[key] = entry
+            return entry[0]
+
+        self.misses += 1
+
+        if isinstance(self.applicative.py_object, MiniWrapper):
+            result = complete(apply_wrapper(self.applicative.py_object, list(cons_collection_to_py_collection(pattern)), environment))
+        else:
+            result = apply(self.applicative, pattern, environment)
+
+        # Recursive calls may have cached the same key while this one ran
+        self.invalidate(key)
+
+        size = approximate_size(key) + approximate_size(structural_key(result)) if self.max_bytes != None else 0
+        self.cache[key] = (result, size)
+        self.bytes += size
+        self.evict()
+
+        return result
+
+    def evict(self):
+        while (self.max_entries != None and len(self.cache) > self.max_entries) or (self.max_bytes != None and self.bytes > self.max_bytes):
+            key, (result, size) = self.cache.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def invalidate(self, key):
+        entry = self.cache.pop(key, None)
+
+        if entry != None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.cache.clear()
+        self.bytes = 0
+
+def check_memoized(name, memoized):
+    py_object = memoized.py_object
+
+    while isinstance(py_object, MiniWrapper):
+        py_object = py_object.operative.py_object
+
+    if not isinstance(py_object, MiniApplicative) or not isinstance(py_object.operative, Memoized):
+        raise Exception('TypeError: `{}` expected memoized applicative, received {}'.format(name, type(memoized.py_object)))
+
+    return py_object.operative
+
+def memoize(applicative, *options):
+    if not isinstance(applicative.py_object, (MiniApplicative, MiniWrapper)):
+        raise Exception('TypeError: `memoize` expected applicative, received {}'.format(type(applicative.py_object)))
+
+    bounds = integer_options('memoize', options, { 'max-entries' : None, 'max-bytes' : None })
+
+    if bounds['max-entries'] == None and bounds['max-bytes'] == None:
+        bounds['max-entries'] = MEMOIZE_DEFAULT_MAX_ENTRIES
+
+    memoized = MiniObject(MiniApplicative(Memoized(applicative, bounds['max-entries'], bounds['max-bytes'])))
+
+    if isinstance(applicative.py_object, MiniWrapper):
+        return wrap(memoized)
+
+    return memoized
+
+def memoize_statistics(memoized):
+    memoized = check_memoized('memoize-statistics', memoized)
+
+    return _map(
+        create_symbol('hits'), create_number(memoized.hits),
+        create_symbol('misses'), create_number(memoized.misses),
+        create_symbol('evictions'), create_number(memoized.evictions),
+        create_symbol('entries'), create_number(len(memoized.cache)),
+        create_symbol('bytes'), create_number(memoized.bytes))
+
+def memoize_invalidate(memoized, *arguments):
+    memoized = check_memoized('memoize-invalidate', memoized)
+
+    if isinstance(memoized.applicative.py_object, MiniWrapper):
+        memoized.invalidate(structural_key(create_cons_collection(arguments)))
+    else:
+        # Without the environment the arguments were evaluated in, every
+        # result for them has to go
+        pattern_key = structural_key(create_cons_collection(arguments))
+
+        for key in [key for key in memoized.cache if key[0] == pattern_key]:
+            memoized.invalidate(key)
+
+def memoize_clear(memoized):
+    check_memoized('memoize-clear', memoized).clear()
+
+def parallel_map(pattern, environment):
+    arguments = list(cons_collection_to_py_collection(pattern))
+
+    if len(arguments) < 2:
+        raise Exception('ArgumentError: `parallel-map` expected a function and a cons-list, received {} arguments'.format(len(arguments)))
+
+    f, xs = arguments[:2]
+
+    if not isinstance(f.py_object, MiniWrapper):
+        raise Exception("TypeError: `parallel-map` expected function, received {}".format(type(f.py_object)))
+
+    items = list(cons_collection_to_py_collection(xs))
+    workers, chunk_size = parallel_options('parallel-map', arguments[2:], len(items))
+
+    chunks = [(f, items[i:i + chunk_size]) for i in range(0, len(items), chunk_size)]
+    return create_cons_collection(run_parallel(parallel_map_chunk, chunks, workers, predefineds_reference(environment)))
+
+PARALLEL_OPTIONS = ['workers', 'chunk-size']
+
+def parallel_options(name, options, item_count):
+    'Returns the worker count and chunk size given by options for item_count items'
+    options = integer_options(name, options, dict((option, 0) for option in PARALLEL_OPTIONS))
+    workers = options['workers'] or parallel_worker_count()
+
+    # By default each worker gets a few chunks, so that workers which finish
+    # early can take over the rest
+    chunk_size = options['chunk-size'] or max(1, item_count // (workers * 4))
+
+    return workers, chunk_size
+
+def parallel_evaluate(pattern, environment):
+    expressions = list(cons_collection_to_py_collection(pattern))
+    options = []
+
+    # Options follow the expressions, and their values are evaluated
+    while len(expressions) >= 2 and isinstance(expressions[-2].py_object, MiniSymbol) \
+            and expressions[-2].py_object.string in PARALLEL_OPTIONS:
+        options[:0] = [expressions[-2], evaluate(expressions[-1], environment)]
+        expressions = expressions[:-2]
+
+    workers, chunk_size = parallel_options('parallel-evaluate', options, len(expressions))
+
+    # The environment is pickled once for each chunk of expressions
+    chunks = [(environment, expressions[i:i + chunk_size]) for i in range(0, len(expressions), chunk_size)]
+    return create_cons_collection(run_parallel(parallel_evaluate_chunk, chunks, workers, predefineds_reference(environment)))
+
+def _assert(pattern, environment):
+    def assert_internal(*arguments):
+        if len(arguments) == 0:
+            raise Exception("ArgumentError: assert expects 1 or more arguments, received none")
+        
+        if len(arguments) == 1:
+            description = 'assertion failed'
+            assertion = arguments
+        
+        else:
+            description = arguments[0].py_object
+            assertion = arguments[1:]
+        
+        if not isinstance(assertion[-1].py_object, bool):
+            raise Exception("TypeError: `assert` expected Boolean assertion but received {} {}".format(type(assertion[-1].py_object), assertion[-1]))
+        
+        if assertion[-1] is TRUE:
+            return None
+        
+        if assertion[-1] is FALSE:
+            raise Exception("AssertionError: {}".format(description))
+        
+        assert False
+
+    # Execute in nested scope
+    return py_to_mini(assert_internal).py_object(pattern, nest(environment))
+
+def throws(pattern, environment):
+    if cons_collection_len(pattern) != 2:
+        raise Exception("throws? expects 2 argument, received {}".format(len(pattern)))
+
+    expression = car(pattern)
+    exception = evaluate(car(cdr(pattern)), environment)
+
+    if not is_string(exception.py_object):
+        raise Exception('throws? expects a string as the second argument')
+
+    try:
+        evaluate(expression, environment)
+        return FALSE
+
+    except Exception as e:
+        if ':' in e.message:
+            exception_type, message = e.message.split(':',1)
+        else:
+            exception_type = e.message
+
+        if exception.py_object == exception_type:
+            return TRUE
+
+        raise
+
+def _not(argument):
+    if not isinstance(argument, Boolean):
+        raise Exception('TypeError: Expected Boolean but received {}'.format(type(argument)))
+
+    if argument == TRUE:
+        return FALSE
+
+    if argument == FALSE:
+        return TRUE
+
+    assert False
+
+def evaluate_expressions(expressions, environment):
+    return complete(evaluate_expressions_in_tail_position(expressions, environment))
+
+def evaluate_expressions_in_tail_position(expressions, environment):
+    'Evaluates all but the last expression, which is returned as a TailCall'
+    if expressions is NIL:
+        return NIL
+
+    while cdr(expressions) is not NIL:
+        evaluate(car(expressions), environment)
+        expressions = cdr(expressions)
+
+    return TailCall(compile_expression(car(expressions)), environment)
+
+def cons_collection_len(cons_collection):
+    result = 0
+
+    while cons_collection is not NIL:
+        result += 1
+        cons_collection = cdr(cons_collection)
+
+    return result
+
+def define(pattern, environment):
+    if cons_collection_len(pattern) < 2:
+        raise Exception('DefineError: `define` expected two arguments, received {}'.format(cons_collection_len(pattern)))
+
+    head = car(pattern)
+    body = cdr(pattern)
+
+    if isinstance(head.py_object, Identifier):
+        identifier = head.py_object.symbol
+
+        if is_defined(head, environment) == TRUE:
+            raise Exception('AlreadyDefinedError: the identifier {} is already defined'.format(identifier))
+    
+        environment[identifier] = name_applicative(evaluate_expressions(body, environment), identifier)
+    
+        return NIL
+    
+    elif isinstance(head.py_object, MiniPair):
+        raise Exception('NotImplementedError: Defining patterns is not yet implemented')
+
+    else:
+        raise Exception("DefineError")
+
+def name_applicative(value, name):
+    'Names the applicative in value after the identifier it is defined as, unless it already has a name'
+    if type(value) is MiniObject:
+        py_object = value.py_object
+
+        while isinstance(py_object, MiniWrapper):
+            py_object = py_object.operative.py_object
+
+        if isinstance(py_object, MiniApplicative) and py_object.name == None:
+            py_object.name = name
+
+    return value
+
+def defined_p(pattern, environment):
+    if cons_collection_len(pattern) != 1:
+        raise Exception("ArgumentError: `defined?` expects 1 argument, received {}".format(len(pattern)))
+
+    if not isinstance(car(pattern).py_object, Identifier):
+        raise Exception("TypeError: Expected Identifier but got {}".format(type(car(pattern).py_object)))
+
+    return is_defined(car(pattern), environment)
+
+def is_defined(identifier, environment):
+    assert isinstance(identifier, MiniObject)
+    assert isinstance(environment, MiniObject)
+
+    if lookup(environment, identifier_to_symbol(identifier)) == None:
+        return FALSE
+
+    return TRUE
+
+def _if(pattern, environment):
+    if not cons_collection_len(pattern) in [2,3]:
+        raise Exception("ArgumentError")
+
+    condition = car(pattern)
+    if_result_true = car(cdr(pattern))
+    if_result_false = car(cdr(cdr(pattern)))
+
+    result = evaluate(condition, environment)
+
+    if result is TRUE:
+        return TailCall(compile_expression(if_result_true), environment)
+    if result is FALSE:
+        return TailCall(compile_expression(if_result_false), environment)
+
+    raise Exception("TypeError: `if` expects boolean, received {}".format(type(result)))
+
+def nest(environment):
+    isinstance(environment,MiniEnvironment)
+
+    return MiniEnvironment(environment)
+
+LEXICAL_ADDRESSING = True
+
+def is_define_form(expression):
+    return (isinstance(expression.py_object, MiniPair)
+        and isinstance(car(expression).py_object, Identifier)
+        and car(expression).py_object.symbol == 'define'
+        and isinstance(cdr(expression).py_object, MiniPair)
+        and isinstance(car(cdr(expression)).py_object, Identifier))
+
+def operative_layout(pattern):
+    'Returns the frame layout for an `operative` pattern, or None if the pattern is malformed'
+    if not isinstance(pattern.py_object, MiniPair) or not isinstance(cdr(pattern).py_object, MiniPair):
+        return None
+
+    argument_binding = car(pattern)
+    calling_environment_identifier = car(cdr(pattern))
+
+    if not isinstance(calling_environment_identifier.py_object, Identifier):
+        return None
+
+    if isinstance(argument_binding.py_object, Identifier):
+        symbols = [identifier_to_symbol(argument_binding)]
+
+    elif is_cons_list(argument_binding) == TRUE:
+        arguments = list(cons_collection_to_py_collection(argument_binding))
+
+        if not all(isinstance(argument.py_object, Identifier) for argument in arguments):
+            return None
+
+        symbols = [identifier_to_symbol(argument) for argument in arguments]
+
+    else:
+        return None
+
+    symbols.append(identifier_to_symbol(calling_environment_identifier))
+
+    # Identifiers defined at the top level of the body get slots as well
+    for expression in cons_collection_to_py_collection(cdr(cdr(pattern))):
+        if is_define_form(expression):
+            symbol = identifier_to_symbol(car(cdr(expression)))
+
+            if symbol not in symbols:
+                symbols.append(symbol)
+
+    return create_frame_layout(symbols)
+
+def resolve_lexical_addresses(expressions, layouts):
+    '''Records the lexical address of each identifier in expressions that one of
+    layouts binds. Nested `operative` forms are resolved with their own layout
+    pushed onto layouts. Addresses are only hints: lookup_address checks the
+    frames at runtime, so expressions evaluated in some other environment fall
+    back to a lookup by name.'''
+    stack = [(expression, layouts) for expression in cons_collection_to_py_collection(expressions)]
+
+    while stack:
+        expression, layouts = stack.pop()
+
+        if isinstance(expression.py_object, Identifier):
+            identifier = expression.py_object
+
+            if identifier.address != None:
+                continue
+
+            key_symbol = identifier.symbol_object
+
+            for depth, layout in enumerate(layouts):
+                if key_symbol in layout.index:
+                    identifier.address = (layouts[:depth + 1], layout.index[key_symbol], key_symbol)
+                    break
+
+        elif isinstance(expression.py_object, MiniPair):
+            head = car(expression)
+            pattern = cdr(expression)
+
+            if isinstance(head.py_object, Identifier) and head.py_object.symbol in ['operative', 'function']:
+                if head.py_object.symbol == 'function' and isinstance(pattern.py_object, MiniPair):
+                    layout = operative_layout(function_operative_pattern(pattern))
+                else:
+                    layout = operative_layout(pattern)
+
+                if layout != None:
+                    pattern.frame_layout = layout
+                    inner_layouts = (layout,) + layouts
+
+                    for inner in cons_collection_to_py_collection(cdr(cdr(pattern))):
+                        stack.append((inner, inner_layouts))
+
+                    continue
+
+            while isinstance(expression.py_object, MiniPair):
+                stack.append((car(expression), layouts))
+                expression = cdr(expression)
+
+            stack.append((expression, layouts))
+
+# This is vau from John N. Shutt's seminal paper
+# https://www.wpi.edu/Pubs/ETD/Available/etd-090110-124904/unrestricted/jshutt.pdf
+# While Greek letters are appropriate for an academic, theoretical context, they make for
+# poor variable names, so this is tentatively named `operative`
+def operative(pattern, defining_environment, code=None):
+    argument_list_identifier = None
+    argument_identifiers = None
+
+    calling_environment_identifier = car(cdr(pattern)).py_object.symbol
+
+    if isinstance(car(pattern).py_object, Identifier):
+        argument_list_identifier = car(pattern).py_object.symbol
+
+        if calling_environment_identifier == argument_list_identifier:
+            raise Exception("ArgumentError: Argument list identifier `{}` may not be the same as calling environment identifier".format(ai))
+
+    elif car(pattern).py_object == None or isinstance(car(pattern).py_object, MiniPair):
+        if not all([isinstance(arg.py_object, Identifier) for arg in cons_collection_to_py_collection(car(pattern))]):
+            raise Exception("ArgumentError: Unexpected {} {}".format(type(arg),arg))
+
+        argument_identifiers = [ai.py_object.symbol for ai in cons_collection_to_py_collection(car(pattern))]
+        
+        existing = set()
+        for ai in argument_identifiers:
+            if ai in existing:
+                raise Exception("ArgumentError: Argument `{}` already defined".format(ai))
+
+            if calling_environment_identifier == ai:
+                raise Exception("ArgumentError: Argument `{}` may not be the same as calling environment identifier".format(ai))
+
+            existing.add(ai)
+
+    else:
+        raise Exception("ArgumentError: `operative` expected identifier or cons-list as first argument, received {}".format(type(car(pattern).py_object)))
+
+    if not isinstance(car(cdr(pattern)).py_object,Identifier):
+        raise Exception("ArgumentError: The second argument to `operative` should be an identifer")
+
+    body = cdr(cdr(pattern))
+
+    # The layout is computed once per pattern, which happens either here or
+    # while resolving an enclosing operative
+    layout = getattr(pattern, 'frame_layout', None)
+
+    if layout == None:
+        layout = operative_layout(pattern)
+        pattern.frame_layout = layout
+
+        if LEXICAL_ADDRESSING:
+            resolve_lexical_addresses(body, (layout,))
+
+    argument_count = 1 if argument_list_identifier != None else len(argument_identifiers)
+    undefined_slots = [None] * (len(layout.symbols) - argument_count - 1)
+
+    # Nothing can refer to the calling environment of a function, so it isn't
+    # kept. Otherwise each call in a tail recursive loop would keep the
+    # environments of all the calls before it alive.
+    keeps_calling_environment = calling_environment_identifier != FUNCTION_CALLING_ENVIRONMENT.py_object.symbol
+
+    def result(calling_pattern, calling_environment):
+        assert (argument_list_identifier == None) != (argument_identifiers == None)
+        if argument_list_identifier != None:
+            slots = [calling_pattern]
+
+        if argument_identifiers != None:
+            if not cons_collection_len(calling_pattern) == len(argument_identifiers):
+                raise Exception("ArgumentError: operative expected {} arguments, received {}".format(len(argument_identifiers),cons_collection_len(calling_pattern)))
+
+            slots = list(cons_collection_to_py_collection(calling_pattern))
+
+        slots.append(calling_environment if keeps_calling_environment else NIL)
+        slots.extend(undefined_slots)
+
+        local_environment = MiniEnvironment(defining_environment, layout, slots)
+
+        # The body is compiled on the first call rather than when the operative is created
+        if applicative.code == None:
+            applicative.code = compile_sequence(body)
+
+        return TailCall(applicative.code, local_environment)
+
+    applicative = MiniApplicative(result)
+    applicative.source = (pattern, defining_environment)
+
+    # Modules generated by ModuleCompiler pass in their own code for the body
+    applicative.code = code
+
+    return MiniObject(applicative)
+
+# Native implementations of the forms that reference-predefineds.mini defines
+# in mini. They keep the semantics of the reference definitions, which can
+# still be loaded instead for conformance testing, see load_predefineds.
+
+# The calling environment slot of the operatives that `function` creates. The
+# name contains a space so that no identifier in a source file can refer to it.
+FUNCTION_CALLING_ENVIRONMENT = MiniObject(Identifier(' calling environment'))
+
+def function_operative_pattern(pattern):
+    'Returns the `operative` pattern equivalent to a `function` pattern'
+    if not isinstance(pattern.py_object, MiniPair):
+        raise Exception("ArgumentError: `function` expected an argument binding")
+
+    return cons(car(pattern), cons(FUNCTION_CALLING_ENVIRONMENT, cdr(pattern)))
+
+def function(pattern, defining_environment):
+    return wrap(operative(function_operative_pattern(pattern), defining_environment))
+
+def cond(pattern, environment):
+    for case in cons_collection_to_py_collection(pattern):
+        result = evaluate(car(case), environment)
+
+        if result is TRUE:
+            return TailCall(compile_expression(car(cdr(case))), environment)
+
+        if result is not FALSE:
+            raise Exception("TypeError: `cond` expects boolean, received {}".format(type(result)))
+
+    return NIL
+
+def check_operand_count(name, pattern, count=2):
+    if cons_collection_len(pattern) != count:
+        raise Exception("ArgumentError: `{}` expected {} arguments, received {}".format(name, count, cons_collection_len(pattern)))
+
+def _and(pattern, environment):
+    check_operand_count('and', pattern)
+    result = evaluate(car(pattern), environment)
+
+    if result is TRUE:
+        return TailCall(compile_expression(car(cdr(pattern))), environment)
+    if result is FALSE:
+        return FALSE
+
+    raise Exception("TypeError: `and` expects boolean, received {}".format(type(result)))
+
+def _or(pattern, environment):
+    check_operand_count('or', pattern)
+    result = evaluate(car(pattern), environment)
+
+    if result is TRUE:
+        return TRUE
+    if result is FALSE:
+        return TailCall(compile_expression(car(cdr(pattern))), environment)
+
+    raise Exception("TypeError: `or` expects boolean, received {}".format(type(result)))
+
+def cons_list_map(pattern, environment):
+    check_operand_count('cons-list-map', pattern)
+    f, xs = cons_collection_to_py_collection(pattern)
+
+    if not isinstance(f.py_object, MiniWrapper):
+        raise Exception("TypeError: `cons-list-map` expected function, received {}".format(type(f.py_object)))
+
+    mapped = []
+
+    for item in cons_collection_to_py_collection(xs):
+        mapped.append(complete(apply_wrapper(f.py_object, [item], environment)))
+
+    return create_cons_collection(mapped)
+
+def cons_list_zip(left, right):
+    zipped = []
+
+    while left is not NIL and right is not NIL:
+        zipped.append(cons(car(left), car(right)))
+        left = cdr(left)
+        right = cdr(right)
+
+    if left is not NIL or right is not NIL:
+        raise Exception("AssertionError: `cons-list-zip` expected cons-lists of the same length")
+
+    return create_cons_collection(zipped)
+
+class MiniPromise(object):
+    '''A value computed the first time it is forced. The thunk that computes
+    it is dropped once it has run, so a forced promise doesn't keep what the
+    value was computed from alive.'''
+    __slots__ = ('thunk', 'value')
+
+    def __init__(self, thunk):
+        self.thunk = thunk
+        self.value = None
+
+    def force(self):
+        if self.thunk != None:
+            self.value = self.thunk()
+            self.thunk = None
+
+        return self.value
+
+    def __repr__(self):
+        return '<promise>' if self.thunk != None else '<promise {}>'.format(repr(self.value))
+
+def delayed(thunk):
+    return MiniObject(MiniPromise(thunk))
+
+def delay(pattern, environment):
+    check_operand_count('delay', pattern, 1)
+    expression = car(pattern)
+
+    return delayed(lambda: evaluate(expression, environment))
+
+def force(value):
+    'Returns the value of a promise, or any other value unchanged'
+    if isinstance(value.py_object, MiniPromise):
+        return value.py_object.force()
+
+    return value
+
+def is_promise(mini_object):
+    return isinstance(mini_object.py_object, MiniPromise)
+
+# A stream is nil or a pair of an item and a promise of the rest of the
+# stream. Forcing a value that isn't a promise returns it, so cons-lists can
+# be used wherever streams are.
+
+def stream_cons(pattern, environment):
+    check_operand_count('stream-cons', pattern)
+    rest = car(cdr(pattern))
+
+    return cons(evaluate(car(pattern), environment), delayed(lambda: evaluate(rest, environment)))
+
+def check_stream(name, stream):
+    if stream is not NIL and not isinstance(stream.py_object, MiniPair):
+        raise Exception('TypeError: `{}` expected stream, received {}'.format(name, type(stream.py_object)))
+
+def stream_cdr(stream):
+    check_stream('stream-cdr', stream)
+
+    return force(cdr(stream))
+
+def check_function(name, f):
+    if not isinstance(f.py_object, MiniWrapper):
+        raise Exception("TypeError: `{}` expected function, received {}".format(name, type(f.py_object)))
+
+def stream_map(pattern, environment):
+    f, stream = cons_collection_to_py_collection(pattern)
+    check_function('stream-map', f)
+
+    return map_stream(f, stream, environment)
+
+def map_stream(f, stream, environment):
+    check_stream('stream-map', stream)
+
+    if stream is NIL:
+        return NIL
+
+    return cons(
+        call_function(f, [car(stream)], environment),
+        delayed(lambda: map_stream(f, stream_cdr(stream), environment)))
+
+def stream_filter(pattern, environment):
+    predicate, stream = cons_collection_to_py_collection(pattern)
+    check_function('stream-filter', predicate)
+
+    return filter_stream(predicate, stream, environment)
+
+def filter_stream(predicate, stream, environment):
+    # Items that don't match are skipped in a loop rather than by forcing
+    # promises inside promises, so long runs of them don't recurse
+    while True:
+        check_stream('stream-filter', stream)
+
+        if stream is NIL:
+            return NIL
+
+        result = call_function(predicate, [car(stream)], environment)
+
+        if result is TRUE:
+            return cons(car(stream), delayed(lambda: filter_stream(predicate, stream_cdr(stream), environment)))
+
+        if result is not FALSE:
+            raise Exception("TypeError: `stream-filter` expected boolean, received {}".format(type(result.py_object)))
+
+        stream = stream_cdr(stream)
+
+def stream_take(count, stream):
+    check_index('stream-take', count)
+    check_stream('stream-take', stream)
+
+    if count.py_object <= 0 or stream is NIL:
+        return NIL
+
+    # The last item taken doesn't force the rest of the stream
+    def rest():
+        if count.py_object == 1:
+            return NIL
+
+        return stream_take(create_number(count.py_object - 1), stream_cdr(stream))
+
+    return cons(car(stream), delayed(rest))
+
+# The functions that consume a whole stream are operatives which evaluate
+# their own arguments, so that the head of the stream isn't kept alive by
+# an argument list while they walk it, and a stream that nothing else refers
+# to is consumed in constant memory.
+
+def stream_fold(pattern, environment):
+    check_operand_count('stream-fold', pattern, 3)
+
+    f = evaluate(car(pattern), environment)
+    check_function('stream-fold', f)
+
+    result = evaluate(car(cdr(pattern)), environment)
+    stream = evaluate(car(cdr(cdr(pattern))), environment)
+
+    while True:
+        check_stream('stream-fold', stream)
+
+        if stream is NIL:
+            return result
+
+        result = call_function(f, [result, car(stream)], environment)
+        stream = stream_cdr(stream)
+
+def stream_to_cons_list(pattern, environment):
+    check_operand_count('stream->cons-list', pattern, 1)
+
+    items = []
+    stream = evaluate(car(pattern), environment)
+
+    while True:
+        check_stream('stream->cons-list', stream)
+
+        if stream is NIL:
+            return create_cons_collection(items)
+
+        items.append(car(stream))
+        stream = stream_cdr(stream)
+
+def file_lines(handle):
+    'Returns a stream of the lines of a file, read as the stream is forced'
+    line = read_line(handle)
+
+    if line == None:
+        return NIL
+
+    return cons(create_string(line), delayed(lambda: file_lines(handle)))
+
+def read_file(filename):
+    assert isinstance(filename, MiniObject)
+
+    def read():
+        with open(str(filename.py_object), 'r') as f:
+            return f.read()
+
+    return without_evaluation_lock(read)
+
+def write_file(filename, string):
+    assert isinstance(filename, MiniObject)
+    assert isinstance(string, MiniObject)
+
+    def write():
+        with open(str(filename.py_object), 'w') as f:
+            write_string(f, string.py_object)
+
+    without_evaluation_lock(write)
+
+def write_string(f, string):
+    # Ropes are written a leaf at a time, and mapped strings a chunk at a time,
+    # rather than flattened
+    if isinstance(string, Rope):
+        for leaf in string.leaves():
+            f.write(leaf)
+
+    elif isinstance(string, MappedString):
+        for chunk in string.chunks():
+            f.write(chunk)
+
+    else:
+        f.write(string)
+
+def map_file(filename):
+    assert isinstance(filename, MiniObject)
+
+    with open(str(filename.py_object), 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+
+        # Empty files can't be mapped
+        if size == 0:
+            return ''
+
+        # The mapping stays open after the file is closed, for as long as
+        # strings from it are used
+        mapping = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    return MiniObject(MappedString(mapping, 0, size))
+
+class MiniFile(object):
+    'A file opened by `open-file`, which is read or written a piece at a time'
+    __slots__ = ('file',)
+
+    def __init__(self, file):
+        self.file = file
+
+    def __repr__(self):
+        return '<file {} {}>'.format(self.file.name, 'closed' if self.file.closed else self.file.mode)
+
+FILE_MODES = {
+    'read'      : 'r',
+    'write'     : 'w',
+    'append'    : 'a',
+}
+
+def check_file(name, handle):
+    if not isinstance(handle.py_object, MiniFile):
+        raise Exception('TypeError: `{}` expected file, received {}'.format(name, type(handle.py_object)))
+
+    if handle.py_object.file.closed:
+        raise Exception('ValueError: `{}` expected open file'.format(name))
+
+    return handle.py_object.file
+
+def open_file(filename, mode=None):
+    if not is_string(filename.py_object):
+        raise Exception('TypeError: `open-file` expected string file name, received {}'.format(type(filename.py_object)))
+
+    mode = create_symbol('read').py_object if mode == None else mode.py_object
+
+    if not isinstance(mode, MiniSymbol) or mode.string not in FILE_MODES:
+        raise Exception('ArgumentError: `open-file` expected :read, :write or :append, received {}'.format(mode))
+
+    return MiniObject(MiniFile(without_evaluation_lock(open, str(filename.py_object), FILE_MODES[mode.string])))
+
+def read_line(handle):
+    'Returns the next line of a file without its newline, or nil at the end of the file'
+    line = without_evaluation_lock(check_file('read-line', handle).readline)
+
+    if line == '':
+        return None
+
+    return line[:-1] if line.endswith('\n') else line
+
+def read_chunk(handle, size):
+    'Returns up to size characters from a file, or nil at the end of the file'
+    check_index('read-chunk', size)
+
+    chunk = without_evaluation_lock(check_file('read-chunk', handle).read, size.py_object)
+
+    if chunk == '':
+        return None
+
+    return chunk
+
+def write_chunk(handle, string):
+    f = check_file('write-chunk', handle)
+
+    if not is_string(string.py_object):
+        raise Exception('TypeError: `write-chunk` expected string, received {}'.format(type(string.py_object)))
+
+    without_evaluation_lock(write_string, f, string.py_object)
+
+def close_file(handle):
+    if not isinstance(handle.py_object, MiniFile):
+        raise Exception('TypeError: `close-file` expected file, received {}'.format(type(handle.py_object)))
+
+    handle.py_object.file.close()
+
+def write_file_chunks(pattern, environment):
+    '''Writes the strings a function returns to a file, calling it with no
+    arguments until it returns nil, so the whole contents never have to be
+    held at once'''
+    filename, next_chunk = cons_collection_to_py_collection(pattern)
+
+    if not isinstance(next_chunk.py_object, MiniWrapper):
+        raise Exception('TypeError: `write-file-chunks` expected function, received {}'.format(type(next_chunk.py_object)))
+
+    with open(str(filename.py_object), 'w') as f:
+        while True:
+            chunk = complete(apply_wrapper(next_chunk.py_object, [], environment))
+
+            if chunk.py_object == None:
+                return NIL
+
+            if not is_string(chunk.py_object):
+                raise Exception('TypeError: `write-file-chunks` expected string chunks, received {}'.format(type(chunk.py_object)))
+
+            without_evaluation_lock(write_string, f, chunk.py_object)
+
+# Work started by `spawn` and the -async builtins runs on a pool of threads,
+# so that waits for files overlap. The interpreter's state isn't locked
+# piece by piece, so mini code runs a thread at a time instead: once anything
+# has been spawned, a thread only runs mini code while it holds
+# EVALUATION_LOCK, and only releases it to wait, for a future or for I/O in
+# a builtin. Work which is awaited before a thread of the pool has started it
+# runs in the awaiting thread, so spawned functions can await each other
+# without every thread of the pool waiting for work queued behind them.
+IO_THREAD_COUNT = 64
+IO_QUEUE = None
+IO_QUEUE_LOCK = threading.Lock()
+FUTURE_CLAIM_LOCK = threading.Lock()
+
+EVALUATION_LOCK = threading.Lock()
+EVALUATION_LOCK_OWNER = threading.local()
+
+def holds_evaluation_lock():
+    return getattr(EVALUATION_LOCK_OWNER, 'held', False)
+
+def acquire_evaluation_lock():
+    EVALUATION_LOCK.acquire()
+    EVALUATION_LOCK_OWNER.held = True
+
+def release_evaluation_lock():
+    'Releases the evaluation lock if this thread holds it, returning whether it did'
+    if not holds_evaluation_lock():
+        return False
+
+    EVALUATION_LOCK_OWNER.held = False
+    EVALUATION_LOCK.release()
+    return True
+
+def with_evaluation_lock(function, *arguments):
+    'Calls function, which runs mini code, holding the evaluation lock'
+    acquired = not holds_evaluation_lock()
+
+    if acquired:
+        acquire_evaluation_lock()
+
+    try:
+        return function(*arguments)
+
+    finally:
+        if acquired:
+            release_evaluation_lock()
+
+def without_evaluation_lock(function, *arguments):
+    '''Calls function, which waits for I/O or for another thread, letting
+    spawned mini code run meanwhile'''
+    released = release_evaluation_lock()
+
+    try:
+        return function(*arguments)
+
+    finally:
+        if released:
+            acquire_evaluation_lock()
+
+class MiniFuture(object):
+    'The eventual result of work running on an I/O thread'
+    __slots__ = ('event', 'value', 'error', 'work')
+
+    def __init__(self, function, arguments):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.work = (function, arguments)
+
+    def claim(self):
+        '''Returns the function and arguments of the work, or None if another
+        thread has already claimed them'''
+        with FUTURE_CLAIM_LOCK:
+            work, self.work = self.work, None
+
+        return work
+
+    def run(self, function, arguments):
+        try:
+            self.value = function(*arguments)
+
+        except Exception:
+            self.error = sys.exc_info()
+
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+
+        # The error is raised with the traceback from the thread it was
+        # raised in
+        if self.error != None:
+            error_type, error, error_traceback = self.error
+            raise error_type, error, error_traceback
+
+        return self.value
+
+    def __repr__(self):
+        return '<future {}>'.format('done' if self.event.is_set() else 'pending')
+
+def run_io_thread():
+    while True:
+        future = IO_QUEUE.get()
+        work = future.claim()
+
+        # Otherwise the work has already run in the thread awaiting it
+        if work != None:
+            future.run(*work)
+
+        IO_QUEUE.task_done()
+
+def submit_io(function, *arguments):
+    '''Calls function with arguments on an I/O thread, returning a future for
+    its result. function is called without the evaluation lock, so work which
+    runs mini code has to take it, see with_evaluation_lock.'''
+    global IO_QUEUE
+
+    # The thread spawning the first work is running mini code, so from now on
+    # it has to hold the lock to keep running it
+    if not holds_evaluation_lock():
+        acquire_evaluation_lock()
+
+    with IO_QUEUE_LOCK:
+        if IO_QUEUE == None:
+            IO_QUEUE = Queue.Queue()
+
+            for _ in range(IO_THREAD_COUNT):
+                thread = threading.Thread(target = run_io_thread)
+
+                # Threads don't keep a program running, wait_for_io waits for
+                # the work they were given instead
+                thread.daemon = True
+                thread.start()
+
+    future = MiniFuture(function, arguments)
+    IO_QUEUE.put(future)
+    return MiniObject(future)
+
+def wait_for_io():
+    'Waits until all the work submitted to the I/O threads, including work submitted meanwhile, is done'
+    if IO_QUEUE != None:
+        without_evaluation_lock(IO_QUEUE.join)
+
+def call_function(f, arguments, environment):
+    return complete(apply_wrapper(f.py_object, arguments, environment))
+
+def spawn(pattern, environment):
+    arguments = list(cons_collection_to_py_collection(pattern))
+
+    if len(arguments) == 0 or not isinstance(arguments[0].py_object, MiniWrapper):
+        raise Exception('TypeError: `spawn` expected function, received {}'.format(
+            type(arguments[0].py_object) if arguments else 'no arguments'))
+
+    return submit_io(with_evaluation_lock, call_function, arguments[0], arguments[1:], environment)
+
+def await_future(future):
+    if not isinstance(future.py_object, MiniFuture):
+        raise Exception('TypeError: `await` expected future, received {}'.format(type(future.py_object)))
+
+    work = future.py_object.claim()
+
+    if work != None:
+        without_evaluation_lock(future.py_object.run, *work)
+
+    return without_evaluation_lock(future.py_object.wait)
+
+def is_future(mini_object):
+    return isinstance(mini_object.py_object, MiniFuture)
+
+def read_file_async(filename):
+    return submit_io(read_file, filename)
+
+def write_file_async(filename, string):
+    return submit_io(write_file, filename, string)
+
+def add(l,r):
+    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
+        l = l.py_object
+        r = r.py_object
+
+        if is_number(l) and is_number(r):
+            return l + r
+
+        if isinstance(l, NumericArray) or isinstance(r, NumericArray):
+            return MiniObject(array_operation('+', operator.add, l, r))
+
+    raise Exception('TypeError')
+
+def subtract(l,r):
+    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
+        l = l.py_object
+        r = r.py_object
+
+        if is_number(l) and is_number(r):
+            return l - r
+
+        if isinstance(l, NumericArray) or isinstance(r, NumericArray):
+            return MiniObject(array_operation('-', operator.sub, l, r))
+
+    raise Exception('TypeError')
+
+def multiply(l,r):
+    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
+        l = l.py_object
+        r = r.py_object
+
+        if is_number(l) and is_number(r):
+            return l * r
+
+        if isinstance(l, NumericArray) or isinstance(r, NumericArray):
+            return MiniObject(array_operation('*', operator.mul, l, r))
+
+    raise Exception('TypeError')
+
+def divide(l,r):
+    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
+        l = l.py_object
+        r = r.py_object
+
+        if is_number(l) and is_number(r):
+            if isinstance(l,int) and isinstance(r,int) and l % r != 0:
+                l = float(l)
+
+            return l / r
+
+        if isinstance(l, NumericArray) or isinstance(r, NumericArray):
+            return MiniObject(array_operation('/', operator.truediv, l, r))
+
+    raise Exception('TypeError')
+
+def idivide(l,r):
+    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
+        l = l.py_object
+        r = r.py_object
+
+        if is_number(l) and is_number(r):
+            return l // r
+
+    raise Exception('TypeError')
+
+def mod(l,r):
+    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
+        l = l.py_object
+        r = r.py_object
+
+        if is_number(l) and is_number(r):
+            return l % r
+
+    raise Exception('TypeError')
+
+def eq(l,r):
+    assert isinstance(l,MiniObject)
+    assert isinstance(r,MiniObject)
+
+    return items_equal(l, r)
+
+def lt(l,r):
+    assert isinstance(l,MiniObject)
+    assert isinstance(r,MiniObject)
+
+    if is_number(l.py_object) and is_number(r.py_object):
+        return l.py_object < r.py_object
+
+    if is_string(l.py_object) and is_string(r.py_object):
+        return str(l.py_object) < str(r.py_object)
+
+    if isinstance(l.py_object,MiniSymbol) and isinstance(r.py_object,MiniSymbol):
+        return l.py_object.ordinal < r.py_object.ordinal
+
+    raise TypeError('`<` expected number or string, received {} and {}'.format(l.py_object, r.py_object))
+
+def gt(l,r):
+    assert isinstance(l,MiniObject)
+    assert isinstance(r,MiniObject)
+
+    if is_number(l.py_object) and is_number(r.py_object):
+        return l.py_object > r.py_object
+
+    if is_string(l.py_object) and is_string(r.py_object):
+        return str(l.py_object) > str(r.py_object)
+
+    if isinstance(l.py_object,MiniSymbol) and isinstance(r.py_object,MiniSymbol):
+        return l.py_object.ordinal > r.py_object.ordinal
+
+    raise TypeError('`>` expected number or string, received {} and {}'.format(l.py_object, r.py_object))
+
+def le(l,r):
+    return lt(l,r) or eq(l,r)
+
+def ge(l,r):
+    return gt(l,r) or eq(l,r)
+
+def cons(l,r):
+    if CONS_TABLE != None:
+        return hash_cons(l,r)
+
+    return MiniPair(l,r)
+
+def car(p):
+    return p.py_object.car
+
+def cdr(p):
+    return p.py_object.cdr
+
+def is_cons_list(mini_object):
+    assert isinstance(mini_object,MiniObject)
+
+    if eq(mini_object,NIL) or isinstance(mini_object.py_object,MiniPair):
+        return TRUE
+
+    return FALSE
+
+# Cons-dicts are persistent AVL trees built from cons cells. Each node is
+# ((key . value) . ((left . right) . height)), and nil is the empty tree.
+
+def cons_dict_left(node):
+    return car(car(cdr(node)))
+
+def cons_dict_right(node):
+    return cdr(car(cdr(node)))
+
+def cons_dict_height(node):
+    if eq(node,NIL):
+        return 0
+
+    return cdr(cdr(node)).py_object
+
+def cons_dict_node(association, left, right):
+    height = 1 + max(cons_dict_height(left), cons_dict_height(right))
+    return cons(association, cons(cons(left, right), MiniObject(height)))
+
+def cons_dict_balance(association, left, right):
+    'Returns a node for association and its subtrees, rotating if their heights differ by more than one'
+    left_height = cons_dict_height(left)
+    right_height = cons_dict_height(right)
+
+    if left_height > right_height + 1:
+        left_left = cons_dict_left(left)
+        left_right = cons_dict_right(left)
+
+        if cons_dict_height(left_left) >= cons_dict_height(left_right):
+            return cons_dict_node(
+                car(left),
+                left_left,
+                cons_dict_node(association, left_right, right))
+
+        return cons_dict_node(
+            car(left_right),
+            cons_dict_node(car(left), left_left, cons_dict_left(left_right)),
+            cons_dict_node(association, cons_dict_right(left_right), right))
+
+    if right_height > left_height + 1:
+        right_left = cons_dict_left(right)
+        right_right = cons_dict_right(right)
+
+        if cons_dict_height(right_right) >= cons_dict_height(right_left):
+            return cons_dict_node(
+                car(right),
+                cons_dict_node(association, left, right_left),
+                right_right)
+
+        return cons_dict_node(
+            car(right_left),
+            cons_dict_node(association, left, cons_dict_left(right_left)),
+            cons_dict_node(car(right), cons_dict_right(right_left), right_right))
+
+    return cons_dict_node(association, left, right)
+
+def cons_dict_set(dictionary,key,value):
+    assert isinstance(dictionary,MiniObject)
+    assert isinstance(key,MiniObject)
+    assert isinstance(value,MiniObject)
+
+    # Walk down to the key, remembering the path so it can be copied back up
+    path = []
+    node = dictionary
+
+    while not eq(node,NIL):
+        current_node_key = car(car(node))
+
+        if lt(key,current_node_key):
+            path.append((node, True))
+            node = cons_dict_left(node)
+
+        elif gt(key,current_node_key):
+            path.append((node, False))
+            node = cons_dict_right(node)
+
+        elif eq(key,current_node_key):
+            break
+
+        else:
+            assert False
+
+    if eq(node,NIL):
+        result = cons_dict_node(cons(key,value), NIL, NIL)
+    else:
+        result = cons(cons(key,value), cdr(node))
+
+    for node, is_left in reversed(path):
+        if is_left:
+            result = cons_dict_balance(car(node), result, cons_dict_right(node))
+        else:
+            result = cons_dict_balance(car(node), cons_dict_left(node), result)
+
+    return result
+
+def compare_keys(l,r):
+    if lt(l,r):
+        return -1
+
+    if gt(l,r):
+        return 1
+
+    return 0
+
+def cons_dict_associations(dictionary):
+    'Yields the (key . value) pairs of dictionary in key order'
+    stack = []
+    node = dictionary
+
+    while stack or not eq(node,NIL):
+        if not eq(node,NIL):
+            stack.append(node)
+            node = cons_dict_left(node)
+        else:
+            node = stack.pop()
+            yield car(node)
+            node = cons_dict_right(node)
+
+def cons_dict_from_sorted_associations(associations):
+    'Builds a balanced cons-dict from a list of (key . value) pairs with distinct, sorted keys'
+    def build(start, end):
+        if start == end:
+            return NIL
+
+        middle = (start + end) // 2
+        return cons_dict_node(associations[middle], build(start, middle), build(middle + 1, end))
+
+    return build(0, len(associations))
+
+def merge_association_list_with_cons_dict(association_list, dictionary):
+    '''Returns dictionary with the pairs of association_list added, later pairs
+    replacing earlier ones. The result is built in one pass rather than by
+    inserting each pair.'''
+    assert isinstance(association_list, MiniObject)
+    assert isinstance(dictionary, MiniObject)
+
+    new_associations = list(cons_collection_to_py_collection(association_list))
+
+    if len(new_associations) == 0:
+        return dictionary
+
+    # sorted is stable, so sorting the reversed pairs puts the last pair for
+    # each key first among the pairs with that key
+    new_associations = sorted(
+        reversed(new_associations),
+        key = cmp_to_key(lambda l, r: compare_keys(car(l), car(r))))
+
+    merged = []
+    existing_associations = cons_dict_associations(dictionary)
+    existing = next(existing_associations, None)
+
+    for association in new_associations:
+        if len(merged) > 0 and compare_keys(car(merged[-1]), car(association)) == 0:
+            continue
+
+        while existing != None and compare_keys(car(existing), car(association)) < 0:
+            merged.append(existing)
+            existing = next(existing_associations, None)
+
+        if existing != None and compare_keys(car(existing), car(association)) == 0:
+            existing = next(existing_associations, None)
+
+        merged.append(association)
+
+    while existing != None:
+        merged.append(existing)
+        existing = next(existing_associations, None)
+
+    return cons_dict_from_sorted_associations(merged)
+
+def cons_dict_find(dictionary,key):
+    'Returns the (key . value) pair for key in dictionary, or None'
+    while not eq(dictionary,NIL):
+        current_node_key = car(car(dictionary))
+
+        if lt(key, current_node_key):
+            dictionary = cons_dict_left(dictionary)
+
+        elif gt(key, current_node_key):
+            dictionary = cons_dict_right(dictionary)
+
+        elif eq(key, current_node_key):
+            return car(dictionary)
+
+        else:
+            assert False
+
+    return None
+
+def cons_dict_get(dictionary,key):
+    assert isinstance(dictionary, MiniObject)
+    assert isinstance(key, MiniObject)
+
+    if isinstance(dictionary, MiniEnvironment):
+        return dictionary.get_binding(key)
+
+    association = cons_dict_find(dictionary, key)
+
+    if association == None:
+        raise Exception('KeyError: Dictionary does not contain key "{}"'.format(key))
+
+    return cdr(association)
+
+def cons_dict_has_key(dictionary,key):
+    assert isinstance(dictionary, MiniObject)
+    assert isinstance(key, MiniObject)
+
+    if isinstance(dictionary, MiniEnvironment):
+        return TRUE if dictionary.has_binding(key) else FALSE
+
+    if cons_dict_find(dictionary, key) == None:
+        return FALSE
+
+    return TRUE
+
+def identifier_to_symbol(identifier):
+    assert isinstance(identifier, MiniObject)
+
+    if not isinstance(identifier.py_object, Identifier):
+        raise Exception('`identifier->symbol` expected identifier, received {}'.format(type(identifier.py_object)))
+
+    return identifier.py_object.symbol_object
+
+def read(string):
+    assert isinstance(string,MiniObject)
+
+    if not is_string(string.py_object):
+        raise Exception("TypeError: `read` expected string, got {}".format(type(string.py_object)))
+
+    result = parse_cached(str(string.py_object))
+
+    assert cdr(result) is NIL
+
+    return car(result)
+
+FOLDABLE_BUILTINS = set([
+    eq, lt, gt, le, ge,
+    add, subtract, multiply, divide, idivide, mod,
+    concatenate, length, slice,
+    _not,
+])
+
+builtins = {
+    # Builtin constants
+    'true'      : TRUE,
+    'false'     : FALSE,
+    'nil'       : NIL,
+
+    # Builtin comparison functions
+    '='             : py_to_mini(eq),
+    '<'             : py_to_mini(lt),
+    '>'             : py_to_mini(gt),
+    '<='            : py_to_mini(le),
+    '>='            : py_to_mini(ge),
+
+    # Builtin conversion functions
+    'identifier->symbol'    : py_to_mini(identifier_to_symbol),
+
+    # Builtin type test functions
+    'cons-list?'    : py_to_mini(is_cons_list),
+    'identifier?'   : py_to_mini(is_identifier),
+
+    # Builtin general functions
+    'evaluate'      : py_to_mini(evaluate_in_tail_position),
+    'evaluate-expressions'  : py_to_mini(evaluate_expressions_in_tail_position),
+    'print'         : py_to_mini(print),
+    'prompt'        : py_to_mini(raw_input),
+    'read-file'     : py_to_mini(read_file),
+    'write-file'    : py_to_mini(write_file),
+    'map-file'      : py_to_mini(map_file),
+    'open-file'     : py_to_mini(open_file),
+    'read-line'     : py_to_mini(read_line),
+    'read-chunk'    : py_to_mini(read_chunk),
+    'write-chunk'   : py_to_mini(write_chunk),
+    'close-file'    : py_to_mini(close_file),
+    'write-file-chunks'     : wrap(MiniObject(MiniApplicative(write_file_chunks))),
+    'read-file-async'       : py_to_mini(read_file_async),
+    'write-file-async'      : py_to_mini(write_file_async),
+    'read'          : py_to_mini(read),
+    'wrap'          : py_to_mini(wrap),
+    'unwrap'        : py_to_mini(unwrap),
+
+    # Builtin number functions
+    '+'             : py_to_mini(add),
+    '-'             : py_to_mini(subtract),
+    '*'             : py_to_mini(multiply),
+    '/'             : py_to_mini(divide),
+    '//'            : py_to_mini(idivide),
+    'mod'           : py_to_mini(mod),
+
+    # Builtin pair functions
+    'cons'          : py_to_mini(cons),
+    'car'           : py_to_mini(car),
+    'cdr'           : py_to_mini(cdr),
+
+    # Builtin cons dictionary functions
+    'cons-dict-set' : py_to_mini(cons_dict_set),
+    'cons-dict-get' : py_to_mini(cons_dict_get),
+    'merge-association-list-with-cons-dict' : py_to_mini(merge_association_list_with_cons_dict),
+
+    # Builtin string functions
+    'concatenate'   : py_to_mini(concatenate),
+    'length'        : py_to_mini(length),
+    'slice'         : py_to_mini(slice),
+
+    # Builtin vector functions
+    'vector'        : py_to_mini(vector),
+    'vector?'       : py_to_mini(is_vector),
+    'vector-ref'    : py_to_mini(vector_ref),
+    'vector-set'    : py_to_mini(vector_set),
+    'vector-append' : py_to_mini(vector_append),
+    'vector->cons-list'     : py_to_mini(vector_to_cons_list),
+    'cons-list->vector'     : py_to_mini(cons_list_to_vector),
+
+    # Builtin map functions
+    'map'           : py_to_mini(_map),
+    'map?'          : py_to_mini(is_map),
+    'map-get'       : py_to_mini(map_get),
+    'map-set'       : py_to_mini(map_set),
+    'map-has-key?'  : py_to_mini(map_has_key),
+    'map->association-list' : py_to_mini(map_to_association_list),
+    'association-list->map' : py_to_mini(association_list_to_map),
+
+    # Builtin array functions
+    'array'         : py_to_mini(_array),
+    'array?'        : py_to_mini(is_array),
+    'array-ref'     : py_to_mini(array_ref),
+    'array-range'   : py_to_mini(array_range),
+    'array-sum'     : py_to_mini(array_sum),
+    'array-min'     : py_to_mini(array_min),
+    'array-max'     : py_to_mini(array_max),
+    'array-mean'    : py_to_mini(array_mean),
+    'array-select'  : py_to_mini(array_select),
+    'array='        : py_to_mini(array_comparison('array=', operator.eq)),
+    'array<'        : py_to_mini(array_comparison('array<', operator.lt)),
+    'array>'        : py_to_mini(array_comparison('array>', operator.gt)),
+    'array<='       : py_to_mini(array_comparison('array<=', operator.le)),
+    'array>='       : py_to_mini(array_comparison('array>=', operator.ge)),
+    'array->cons-list'      : py_to_mini(array_to_cons_list),
+    'cons-list->array'      : py_to_mini(cons_list_to_array),
+
+    # Builtin memoization functions
+    'memoize'               : py_to_mini(memoize),
+    'memoize-statistics'    : py_to_mini(memoize_statistics),
+    'memoize-invalidate'    : py_to_mini(memoize_invalidate),
+    'memoize-clear'         : py_to_mini(memoize_clear),
+
+    # Builtin future functions
+    'spawn'         : wrap(MiniObject(MiniApplicative(spawn))),
+    'await'         : py_to_mini(await_future),
+    'future?'       : py_to_mini(is_future),
+
+    # Builtin lazy evaluation functions
+    'delay'         : MiniObject(MiniApplicative(delay)),
+    'force'         : py_to_mini(force),
+    'promise?'      : py_to_mini(is_promise),
+    'stream-cons'   : MiniObject(MiniApplicative(stream_cons)),
+    'stream-cdr'    : py_to_mini(stream_cdr),
+    'stream-map'    : wrap(MiniObject(MiniApplicative(stream_map))),
+    'stream-filter' : wrap(MiniObject(MiniApplicative(stream_filter))),
+    'stream-take'   : py_to_mini(stream_take),
+    'stream-fold'   : MiniObject(MiniApplicative(stream_fold)),
+    'stream->cons-list'     : MiniObject(MiniApplicative(stream_to_cons_list)),
+    'file-lines'    : py_to_mini(file_lines),
+
+    # Builtin parallel functions
+    'parallel-map'          : wrap(MiniObject(MiniApplicative(parallel_map))),
+    'parallel-evaluate'     : MiniObject(MiniApplicative(parallel_evaluate)),
+
+    # Builtin boolean functions
+    'not'           : py_to_mini(_not),
+
+    # Builtin special forms
+    'assert'    : MiniObject(MiniApplicative(_assert)),
+    'define'    : MiniObject(MiniApplicative(define)),
+    'defined?'  : MiniObject(MiniApplicative(defined_p)),
+    'if'        : MiniObject(MiniApplicative(_if)),
+    'operative' : MiniObject(MiniApplicative(operative)),
+    'throws?'   : MiniObject(MiniApplicative(throws)),
+}
+
+for name, value in builtins.iteritems():
+    name_applicative(value, name)
+
+builtins = dict_to_environment(builtins)
+
+# Loaded on top of the builtins unless the reference definitions in
+# reference-predefineds.mini are requested
+native_predefineds = {
+    'cond'          : MiniObject(MiniApplicative(cond)),
+    'and'           : MiniObject(MiniApplicative(_and)),
+    'or'            : MiniObject(MiniApplicative(_or)),
+    'function'      : MiniObject(MiniApplicative(function)),
+    'cons-list-map' : wrap(MiniObject(MiniApplicative(cons_list_map))),
+    'cons-list-zip' : py_to_mini(cons_list_zip),
+}
+
+for name, value in native_predefineds.iteritems():
+    name_applicative(value, name)
+
+# The Profiler that is recording, if any. Applications, and the loops that
+# run tail calls, check this before anything else, which is all profiling
+# costs while it is disabled.
+PROFILER = None
+
+class ProfileRecord(object):
+    'The calls recorded for one named applicative'
+    __slots__ = ('name', 'calls', 'inclusive', 'exclusive', 'active', 'call_sites')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+
+        # The number of entries for this record on the profiler's stack
+        self.active = 0
+
+        # Counts the calls from each call site with a known source span
+        self.call_sites = {}
+
+class ProfileEntry(object):
+    'A call that the profiler has seen start but not end'
+    __slots__ = ('record', 'start', 'child_time', 'nested', 'path')
+
+    def __init__(self, record, start, nested, path):
+        self.record = record
+        self.start = start
+        self.child_time = 0.0
+
+        # Recursive calls are already included in the outermost call's time
+        self.nested = nested
+
+        # The names of the entries from the bottom of the stack up, for
+        # collapsed stack output
+        self.path = path
+
+class ProfiledTailCall(TailCall):
+    '''A TailCall into the body of a profiled applicative. The loop that runs it
+    ends the entry of the applicative whose body returned it, so tail calls
+    replace each other on the profiler's stack rather than nesting.'''
+    __slots__ = ('entry',)
+
+    def __init__(self, code, environment, entry):
+        super(ProfiledTailCall, self).__init__(code, environment)
+        self.entry = entry
+
+def applicative_name(applicative):
+    'Returns the name an applicative is profiled under, or None if it is not profiled'
+    py_object = applicative.py_object
+
+    if isinstance(py_object, MiniWrapper):
+        while isinstance(py_object, MiniWrapper):
+            py_object = py_object.operative.py_object
+
+        return py_object.name or '<anonymous>'
+
+    # The builtin special forms, such as `if`, are counted as part of the
+    # applicative that uses them
+    if isinstance(py_object, MiniApplicative) and py_object.source != None:
+        return py_object.name or '<anonymous>'
+
+    return None
+
+def execute_profiled(code, environment):
+    return complete_profiled(code(environment))
+
+def complete_profiled(result):
+    entry = None
+
+    try:
+        while isinstance(result, TailCall):
+            if type(result) is ProfiledTailCall:
+                if entry != None:
+                    PROFILER.hand_off(entry, result.entry)
+
+                entry = result.entry
+
+            result = result.code(result.environment)
+
+    except:
+        if entry != None and PROFILER != None:
+            PROFILER.unwind(entry)
+
+        raise
+
+    if entry != None and PROFILER != None:
+        PROFILER.exit(entry)
+
+    return result
+
+class Profiler(object):
+    '''Records the number of calls to each named builtin and operative, the
+    time spent in them including and excluding the applicatives they call, and
+    where they were called from. Call sites are only known for code parsed
+    while source spans are recorded. Only one profiler can be enabled at a
+    time, for example:
+
+        profiler = Profiler()
+
+        with profiler:
+            evaluate_expressions(expressions, environment)
+
+        print(profiler.report(sort_by = 'inclusive'))
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.records = {}
+        self.entries = []
+
+        # The exclusive time spent in each collapsed stack
+        self.stacks = {}
+
+    def enable(self):
+        global PROFILER
+
+        if PROFILER != None:
+            raise Exception('ProfilerError: Another profiler is already enabled')
+
+        PROFILER = self
+
+    def disable(self):
+        global PROFILER
+
+        if self.entries:
+            self.unwind(self.entries[0])
+
+        PROFILER = None
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.disable()
+
+    def apply(self, applicative, expression, environment):
+        'Applies applicative to the arguments of expression, recording the call unless it is a special form'
+        name = applicative_name(applicative)
+        py_applicative = applicative.py_object
+
+        if name == None:
+            if not isinstance(py_applicative, MiniApplicative):
+                raise Exception("Expected applicative, got {}".format(py_applicative))
+
+            return py_applicative(cdr(expression), environment)
+
+        if isinstance(py_applicative, MiniWrapper):
+            # The arguments are evaluated before the call is entered, so that
+            # the time spent evaluating them is counted for the caller
+            arguments = [execute(compile_expression(argument), environment)
+                for argument in cons_collection_to_py_collection(cdr(expression))]
+
+        entry = self.enter(name, expression)
+
+        try:
+            if isinstance(py_applicative, MiniWrapper):
+                result = apply_wrapper(py_applicative, arguments, environment)
+            else:
+                result = py_applicative(cdr(expression), environment)
+
+        except:
+            self.unwind(entry)
+            raise
+
+        if isinstance(result, TailCall):
+            return ProfiledTailCall(result.code, result.environment, entry)
+
+        self.exit(entry)
+        return result
+
+    def enter(self, name, expression):
+        if name not in self.records:
+            self.records[name] = ProfileRecord(name)
+
+        record = self.records[name]
+        record.calls += 1
+
+        span = source_span(car(expression))
+
+        if span != None:
+            record.call_sites[span] = record.call_sites.get(span, 0) + 1
+
+        path = self.entries[-1].path + ';' + name if self.entries else name
+        entry = ProfileEntry(record, self.clock(), record.active > 0, path)
+
+        record.active += 1
+        self.entries.append(entry)
+        return entry
+
+    def exit(self, entry):
+        now = self.clock()
+
+        index = len(self.entries) - 1
+
+        while self.entries[index] is not entry:
+            index -= 1
+
+        del self.entries[index]
+
+        inclusive = now - entry.start
+        exclusive = inclusive - entry.child_time
+
+        if index > 0:
+            self.entries[index - 1].child_time += inclusive
+
+        record = entry.record
+        record.active -= 1
+        record.exclusive += exclusive
+
+        if not entry.nested:
+            record.inclusive += inclusive
+
+        self.stacks[entry.path] = self.stacks.get(entry.path, 0.0) + exclusive
+
+    def hand_off(self, entry, next_entry):
+        'Ends entry, whose body made a tail call to next_entry, so that next_entry takes its place'
+        self.exit(entry)
+
+        index = self.entries.index(next_entry)
+        name = next_entry.record.name
+
+        next_entry.start = self.clock()
+        next_entry.path = self.entries[index - 1].path + ';' + name if index > 0 else name
+        next_entry.nested = next_entry.record.active > 1
+
+    def unwind(self, entry):
+        'Ends entry and every entry above it, when an exception is raised through them'
+        while entry in self.entries:
+            self.exit(self.entries[-1])
+
+    def report(self, sort_by='exclusive', limit=None):
+        'Returns a table of the records, sorted by calls, inclusive, exclusive or name'
+        if sort_by not in ['calls', 'inclusive', 'exclusive', 'name']:
+            raise Exception('ValueError: Cannot sort profile by {}'.format(sort_by))
+
+        records = sorted(self.records.itervalues(),
+            key = lambda record: getattr(record, sort_by),
+            reverse = sort_by != 'name')
+
+        lines = ['{:>10} {:>12} {:>12}  {}'.format('calls', 'inclusive', 'exclusive', 'name (call sites)')]
+
+        for record in records[:limit]:
+            call_sites = sorted(record.call_sites.iteritems(), key = lambda (span, calls): -calls)
+            call_sites = ', '.join('{}-{} x{}'.format(start, end, calls) for (start, end), calls in call_sites[:3])
+
+            lines.append('{:>10} {:>12.6f} {:>12.6f}  {}{}'.format(
+                record.calls,
+                record.inclusive,
+                record.exclusive,
+                record.name,
+                ' ({})'.format(call_sites) if call_sites else ''))
+
+        return '\n'.join(lines)
+
+    def collapsed_stacks(self):
+        'Returns the exclusive time in each stack, in microseconds, in the input format of flamegraph.pl'
+        return '\n'.join('{} {}'.format(path, int(round(seconds * 1000000)))
+            for path, seconds in sorted(self.stacks.iteritems()))
+
+class CompiledBuiltins(object):
+    '''The builtins that a module generated by ModuleCompiler refers to by
+    name. check returns them in a list, with None in place of each one that
+    could be shadowed in an environment, so that generated code only has to
+    look them up once per call rather than once per use.'''
+    def __init__(self, names):
+        self.symbols = [create_symbol(name) for name in names]
+        self.values = [builtins.get_local(symbol) for symbol in self.symbols]
+        self.none = [None] * len(names)
+        self.unshadowed = self.none
+        self.generation = None
+
+    def check(self, environment):
+        if type(environment) is not MiniEnvironment or environment.root is not builtins:
+            return self.none
+
+        # Shadowing a builtin, or rebinding one, changes the generation
+        if self.generation != BUILTINS_GENERATION:
+            self.unshadowed = [value if unshadowed_builtin(symbol) is value else None
+                for symbol, value in zip(self.symbols, self.values)]
+            self.generation = BUILTINS_GENERATION
+
+        return self.unshadowed
+
+# Python expressions generated by ModuleCompiler whose values can't be changed
+# by the statements evaluating later arguments
+STABLE_VALUE = re.compile(r'^(t\d+|_K\[\d+\]|NIL|TRUE|FALSE|None)$')
+
+class ModuleScope(object):
+    'The frames that the code of one generated function runs in'
+    def __init__(self, layout_name, layout, parent, wrapper_names):
+        self.layout_name = layout_name
+        self.layout = layout
+        self.parent = parent
+
+        # Identifiers this scope defines as functions at the top level
+        self.wrapper_names = wrapper_names
+
+        self.temporary_count = 0
+        self.uses_slots = False
+        self.uses_builtins = False
+
+    def temporary(self):
+        self.temporary_count += 1
+        return 't{}'.format(self.temporary_count - 1)
+
+    def binding_scope(self, identifier):
+        'Returns the innermost scope whose frames have a slot for identifier, or None'
+        scope = self
+
+        while scope != None:
+            if scope.layout != None and identifier.symbol_object in scope.layout.index:
+                return scope
+
+            scope = scope.parent
+
+        return None
+
+class ModuleCompiler(object):
+    """Translates a mini program into the source of a Python module.
+
+    Applications whose head is known when compiling are expanded into
+    Python statements: `if`, `define` and `operative`, the native
+    `function`, `cond`, `and` and `or`, calls to builtins, and calls to
+    functions the program or the predefineds define. Each expansion checks
+    at runtime that the head still evaluates to what it was compiled for,
+    and otherwise, like every other application, is evaluated by the
+    interpreter. Arguments are only compiled for heads known to be wrappers,
+    since the arguments of an operative might not be expressions at all.
+    The parsed program is rebuilt as module constants so operatives still
+    receive the same cons cells."""
+    def __init__(self, predefineds):
+        self.predefineds = predefineds
+        self.constants = []
+        self.constant_indices = {}
+        self.function_patterns = []
+        self.layouts = []
+        self.functions = []
+        self.builtin_names = []
+
+    def constant(self, node):
+        'Returns a Python expression for the module constant holding node'
+        if id(node) in self.constant_indices:
+            return '_K[{}]'.format(self.constant_indices[id(node)])
+
+        if node is NIL:
+            return 'NIL'
+
+        if node is TRUE:
+            return 'TRUE'
+
+        if node is FALSE:
+            return 'FALSE'
+
+        if isinstance(node.py_object, MiniPair):
+            # Define the rest of a list before the list itself, without
+            # recursing down the whole list
+            spine = []
+            rest = node
+
+            while isinstance(rest.py_object, MiniPair) and not id(rest) in self.constant_indices:
+                spine.append(rest)
+                rest = cdr(rest)
+
+            for pair in reversed(spine[1:]):
+                self.constant(pair)
+
+            definition = '_mini.cons({}, {})'.format(self.constant(car(node)), self.constant(cdr(node)))
+
+        elif isinstance(node.py_object, Identifier):
+            definition = '_mini.MiniObject(_mini.Identifier({!r}))'.format(node.py_object.symbol)
+
+        elif isinstance(node.py_object, MiniSymbol):
+            definition = '_mini.create_symbol({!r})'.format(node.py_object.string)
+
+        elif isinstance(node.py_object, str) or is_number(node.py_object):
+            definition = '_mini.MiniObject({!r})'.format(node.py_object)
+
+        else:
+            raise Exception('CompileError: Cannot compile constant {}'.format(node))
+
+        # Kept alive so that ids stay unique while compiling
+        self.constant_indices[id(node)] = len(self.constants)
+        self.constants.append((node, definition))
+        return '_K[{}]'.format(self.constant_indices[id(node)])
+
+    def builtin_index(self, name):
+        if name not in self.builtin_names:
+            self.builtin_names.append(name)
+
+        return self.builtin_names.index(name)
+
+    def head_kind(self, head, scope):
+        '''Returns what the identifier head is known to evaluate to: a builtin,
+        one of the native special forms, a wrapper or None if it isn't known'''
+        identifier = head.py_object
+
+        while scope != None:
+            if identifier.symbol in scope.wrapper_names:
+                return 'wrapper'
+
+            if scope.layout != None and identifier.symbol_object in scope.layout.index:
+                return None
+
+            scope = scope.parent
+
+        if builtins.get_local(identifier.symbol_object) != None:
+            return 'builtin'
+
+        value = lookup(self.predefineds, identifier.symbol_object)
+
+        for name in ['function', 'cond', 'and', 'or']:
+            if value is native_predefineds[name]:
+                return name
+
+        if value != None and isinstance(value.py_object, MiniWrapper):
+            return 'wrapper'
+
+        return None
+
+    def builtin_call(self, node, scope):
+        '''Returns the Python function of the builtin node calls, if it can be
+        called directly with arguments which are all Python expressions, or None'''
+        head = car(node)
+        pattern = cdr(node)
+
+        if not isinstance(head.py_object, Identifier) or is_cons_list(pattern) != TRUE \
+                or self.head_kind(head, scope) != 'builtin':
+            return None
+
+        value = builtins.get_local(head.py_object.symbol_object)
+
+        if not isinstance(value.py_object, MiniWrapper):
+            return None
+
+        operative = value.py_object.operative.py_object
+
+        # Calls with the wrong number of arguments take the general path, which
+        # raises the error
+        if not isinstance(operative, MiniApplicative) or operative.builtin == None \
+                or (operative.arity != None and operative.arity != cons_collection_len(pattern)):
+            return None
+
+        for argument in cons_collection_to_py_collection(pattern):
+            if isinstance(argument.py_object, MiniPair) and self.builtin_call(argument, scope) == None:
+                return None
+
+        return operative.builtin
+
+    def identifier(self, node, scope):
+        'Returns a Python expression looking up an identifier'
+        identifier = node.py_object
+        fallback = '_mini.lookup_identifier(environment, {}.py_object)'.format(self.constant(node))
+        binding_scope = scope.binding_scope(identifier)
+
+        if binding_scope is scope:
+            scope.uses_slots = True
+            return '(slots[{}] or {})'.format(scope.layout.index[identifier.symbol_object], fallback)
+
+        if binding_scope == None and builtins.get_local(identifier.symbol_object) != None:
+            scope.uses_builtins = True
+            return '(b[{}] or {})'.format(self.builtin_index(identifier.symbol), fallback)
+
+        return fallback
+
+    def interpreted(self, node, tail):
+        'Returns a Python expression evaluating node with the interpreter'
+        if tail:
+            return '_mini.compile_expression({})(environment)'.format(self.constant(node))
+
+        return '_mini.execute(_mini.compile_expression({}), environment)'.format(self.constant(node))
+
+    def value(self, node, scope, lines, indent):
+        '''Appends the statements that evaluate node to lines, and returns a
+        Python expression for its value to use after them'''
+        if node is TRUE or node is FALSE:
+            return self.constant(node)
+
+        if isinstance(node.py_object, Identifier):
+            return self.identifier(node, scope)
 
-def defined_p(pattern, environment):
-    if cons_collection_len(pattern) != 1:
-        raise Exception("ArgumentError: `defined?` expects 1 argument, received {}".format(len(pattern)))
+        if not isinstance(node.py_object, MiniPair):
+            if isinstance(node.py_object, str) or is_number(node.py_object) or isinstance(node.py_object, MiniSymbol):
+                return self.constant(node)
 
-    if not isinstance(car(pattern).py_object, Identifier):
-        raise Exception("TypeError: Expected Identifier but got {}".format(type(car(pattern).py_object)))
+            return 'None'
 
-    return is_defined(car(pattern), environment)
+        expression = self.call_expression(node, scope)
 
-def is_defined(identifier, environment):
-    assert isinstance(identifier, MiniObject)
-    assert isinstance(environment, MiniObject)
+        if expression != None:
+            return expression
 
-    identifier_symbol = identifier_to_symbol(identifier)
-    parent_symbol = create_symbol('__parent__')
+        temporary = scope.temporary()
+        self.application(node, scope, lines, indent, temporary)
+        return temporary
 
-    while True:
-        if cons_dict_has_key(environment, identifier_symbol) == TRUE:
-            return TRUE
+    def emit(self, node, scope, lines, indent, target):
+        '''Appends the statements that evaluate node to lines, ending by
+        returning its result if target is None, or assigning its value to the
+        variable target otherwise'''
+        if isinstance(node.py_object, MiniPair):
+            expression = self.call_expression(node, scope)
 
-        elif cons_dict_has_key(environment, parent_symbol) == TRUE:
-            environment = cons_dict_get(environment, parent_symbol)
+            if expression == None:
+                return self.application(node, scope, lines, indent, target)
 
         else:
-            return FALSE
+            expression = self.value(node, scope, lines, indent)
 
-def _if(pattern, environment):
-    if not cons_collection_len(pattern) in [2,3]:
-        raise Exception("ArgumentError")
+        self.store(expression, lines, indent, target)
 
-    condition = car(pattern)
-    if_result_true = car(cdr(pattern))
-    if_result_false = car(cdr(cdr(pattern)))
+    def store(self, expression, lines, indent, target):
+        if target == None:
+            lines.append('{}return {}'.format(indent, expression))
+        else:
+            lines.append('{}{} = {}'.format(indent, target, expression))
+
+    def arguments(self, pattern, scope, indent):
+        '''Returns the statements that evaluate the arguments in pattern, and
+        Python expressions for their values. Values that a later argument's
+        statements could change are kept in temporaries.'''
+        lines = []
+        values = []
+
+        for argument in cons_collection_to_py_collection(pattern):
+            argument_lines = []
+            value = self.value(argument, scope, argument_lines, indent)
+
+            if argument_lines:
+                for i, previous in enumerate(values):
+                    if not STABLE_VALUE.match(previous):
+                        temporary = scope.temporary()
+                        lines.append('{}{} = {}'.format(indent, temporary, previous))
+                        values[i] = temporary
+
+            lines.extend(argument_lines)
+            values.append(value)
+
+        return lines, values
+
+    def call_expression(self, node, scope):
+        '''Returns a Python expression calling the builtin at the head of node,
+        or None if node isn't such a call'''
+        if self.builtin_call(node, scope) == None:
+            return None
 
-    result = evaluate(condition, environment)
+        scope.uses_builtins = True
+        index = self.builtin_index(car(node).py_object.symbol)
+        argument_lines, values = self.arguments(cdr(node), scope, '')
+        assert not argument_lines
+
+        return '(_mini.convert_result(_F{}({})) if b[{}] is not None else {})'.format(
+            index, ', '.join(values), index, self.interpreted(node, False))
+
+    def application(self, node, scope, lines, indent, target):
+        'Appends the statements evaluating an application to lines, see emit'
+        head = car(node)
+        pattern = cdr(node)
+        kind = self.head_kind(head, scope) if isinstance(head.py_object, Identifier) else None
+        inner = indent + '    '
+
+        if kind == 'builtin':
+            scope.uses_builtins = True
+            name = head.py_object.symbol
+            guard = '{}if b[{}] is not None:'.format(indent, self.builtin_index(name))
+            value = builtins.get_local(head.py_object.symbol_object)
+
+            if name == 'if' and cons_collection_len(pattern) == 3:
+                lines.append(guard)
+                self.conditional(car(pattern), [('TRUE', car(cdr(pattern))), ('FALSE', car(cdr(cdr(pattern))))],
+                    'if', scope, lines, inner, target)
+
+            elif name == 'define' and cons_collection_len(pattern) >= 2 and isinstance(car(pattern).py_object, Identifier):
+                lines.append(guard)
+                self.define(car(pattern), cdr(pattern), scope, lines, inner)
+                self.store('NIL', lines, inner, target)
+
+            elif name == 'operative' and operative_layout(pattern) != None:
+                lines.append(guard)
+                self.store('_mini.operative({}, environment, {})'.format(
+                    self.constant(pattern),
+                    self.operative_body(self.constant(pattern), pattern, scope)), lines, inner, target)
+
+            elif isinstance(value.py_object, MiniWrapper) and is_cons_list(pattern) == TRUE:
+                lines.append(guard)
+                operative = value.py_object.operative.py_object
+
+                if isinstance(operative, MiniApplicative) and operative.builtin != None \
+                        and (operative.arity == None or operative.arity == cons_collection_len(pattern)):
+                    argument_lines, values = self.arguments(pattern, scope, inner)
+                    lines.extend(argument_lines)
+                    self.store('_mini.convert_result(_F{}({}))'.format(self.builtin_index(name), ', '.join(values)),
+                        lines, inner, target)
+
+                else:
+                    self.wrapper_call('b[{}].py_object'.format(self.builtin_index(name)), pattern, scope, lines, inner, target)
+
+            else:
+                return self.store(self.interpreted(node, target == None), lines, indent, target)
+
+        elif kind == 'function' and isinstance(pattern.py_object, MiniPair) \
+                and operative_layout(function_operative_pattern(pattern)) != None:
+            # The operative pattern is built once when the module is loaded,
+            # like compile_function builds it once per expression
+            function_pattern = '_P[{}]'.format(len(self.function_patterns))
+            self.function_patterns.append(self.constant(pattern))
+
+            lines.append('{}if {} is _FUNCTION:'.format(indent, self.identifier(head, scope)))
+            self.store('_mini.wrap(_mini.operative({}, environment, {}))'.format(
+                function_pattern,
+                self.operative_body(function_pattern, function_operative_pattern(pattern), scope)), lines, inner, target)
+
+        elif kind == 'cond' and is_cons_list(pattern) == TRUE and all(
+                isinstance(case.py_object, MiniPair) and isinstance(cdr(case).py_object, MiniPair)
+                for case in cons_collection_to_py_collection(pattern)):
+            lines.append('{}if {} is _COND:'.format(indent, self.identifier(head, scope)))
+            self.conditional(None, [(car(case), car(cdr(case))) for case in cons_collection_to_py_collection(pattern)],
+                'cond', scope, lines, inner, target)
+
+        elif kind in ['and', 'or'] and cons_collection_len(pattern) == 2:
+            # `and` evaluates to its right operand if the left one is true,
+            # and `or` if the left one is false
+            if kind == 'and':
+                cases = [('TRUE', car(cdr(pattern))), ('FALSE', FALSE)]
+            else:
+                cases = [('FALSE', car(cdr(pattern))), ('TRUE', TRUE)]
+
+            lines.append('{}if {} is _{}:'.format(indent, self.identifier(head, scope), kind.upper()))
+            self.conditional(car(pattern), cases, kind, scope, lines, inner, target)
+
+        elif kind == 'wrapper' and is_cons_list(pattern) == TRUE:
+            function = scope.temporary()
+            lines.append('{}{} = {}.py_object'.format(indent, function, self.identifier(head, scope)))
+            lines.append('{}if type({}) is MiniWrapper:'.format(indent, function))
+            self.wrapper_call(function, pattern, scope, lines, inner, target)
 
-    if result is TRUE:
-        return evaluate(if_result_true, environment)
-    if result is FALSE:
-        return evaluate(if_result_false, environment)
+        else:
+            return self.store(self.interpreted(node, target == None), lines, indent, target)
 
-    raise Exception("TypeError: `if` expects boolean, received {}".format(type(result)))
+        # Heads which turn out to be something else at runtime are applied by
+        # the interpreter
+        if target == None:
+            self.store(self.interpreted(node, True), lines, indent, target)
+        else:
+            lines.append('{}else:'.format(indent))
+            self.store(self.interpreted(node, False), lines, inner, target)
 
-def nest(environment):
-    isinstance(environment,MiniEnvironment)
+    def wrapper_call(self, wrapper, pattern, scope, lines, indent, target):
+        argument_lines, values = self.arguments(pattern, scope, indent)
+        lines.extend(argument_lines)
+        call = '_mini.apply_wrapper({}, [{}], environment)'.format(wrapper, ', '.join(values))
+
+        # Calls in tail position return their TailCall to the caller's loop
+        self.store(call if target == None else '_mini.complete({})'.format(call), lines, indent, target)
+
+    def conditional(self, condition, cases, name, scope, lines, indent, target):
+        '''Appends the statements of `if`, `and` or `or`, which evaluate the
+        result of the case matching the value of condition, and of `cond`
+        when condition is None, where each case is a condition and a result'''
+        if condition != None:
+            value = scope.temporary()
+            lines.append('{}{} = {}'.format(indent, value, self.value(condition, scope, lines, indent)))
+
+            for i, (case_value, result) in enumerate(cases):
+                lines.append('{}{} {} is {}:'.format(indent, 'elif' if i else 'if', value, case_value))
+                self.emit(result, scope, lines, indent + '    ', target)
+
+            lines.append('{}else:'.format(indent))
+            lines.append('{}    raise Exception("TypeError: `{}` expects boolean, received {{}}".format(type({})))'.format(indent, name, value))
+            return
+
+        # Each case is only evaluated if the ones before it were false
+        for case_condition, result in cases:
+            value = scope.temporary()
+            lines.append('{}{} = {}'.format(indent, value, self.value(case_condition, scope, lines, indent)))
+            lines.append('{}if {} is TRUE:'.format(indent, value))
+            self.emit(result, scope, lines, indent + '    ', target)
+            lines.append('{}{} {} is not FALSE:'.format(indent, 'if' if target == None else 'elif', value))
+            lines.append('{}    raise Exception("TypeError: `cond` expects boolean, received {{}}".format(type({})))'.format(indent, value))
+
+            if target != None:
+                lines.append('{}else:'.format(indent))
+                indent += '    '
+
+        self.store('NIL', lines, indent, target)
+
+    def define(self, identifier, body, scope, lines, indent):
+        key_symbol = '{}.py_object.symbol_object'.format(self.constant(identifier))
+        name = identifier.py_object.symbol
+
+        lines.extend([
+            '{}if _mini.lookup(environment, {}) != None:'.format(indent, key_symbol),
+            '{}    raise Exception({!r})'.format(indent, 'AlreadyDefinedError: the identifier {} is already defined'.format(name)),
+        ])
+
+        expressions = list(cons_collection_to_py_collection(body))
+
+        for expression in expressions[:-1]:
+            self.emit(expression, scope, lines, indent, scope.temporary())
+
+        value = self.value(expressions[-1], scope, lines, indent)
+        lines.append('{}environment.set_binding({}, _mini.name_applicative({}, {!r}))'.format(indent, key_symbol, value, name))
+
+    def operative_body(self, pattern_name, pattern, parent):
+        'Returns the name of a function evaluating the body of an `operative` pattern in its frames'
+        layout_name = '_L[{}]'.format(len(self.layouts))
+        self.layouts.append(pattern_name)
+
+        body = cdr(cdr(pattern))
+        scope = ModuleScope(layout_name, operative_layout(pattern), parent, defined_wrapper_names(body))
+        return self.add_function(scope, body)
+
+    def sequence(self, expressions, scope, lines):
+        'Appends the statements of a function body evaluating expressions and returning the last'
+        expressions = list(cons_collection_to_py_collection(expressions))
+
+        if len(expressions) == 0:
+            lines.append('    return NIL')
+            return
+
+        for expression in expressions[:-1]:
+            self.emit(expression, scope, lines, '    ', scope.temporary())
+
+        self.emit(expressions[-1], scope, lines, '    ', None)
+
+    def add_function(self, scope, body):
+        # The name is reserved before the body is compiled, since the body may
+        # add functions of its own
+        name = '_f{}'.format(len(self.functions))
+        self.functions.append(None)
+
+        body_lines = []
+        self.sequence(body, scope, body_lines)
+
+        lines = ['def {}(environment):'.format(name)]
+
+        if scope.uses_slots:
+            lines.append('    slots = environment.slots if type(environment) is MiniEnvironment and environment.layout is {} else {!r}'.format(
+                scope.layout_name, (None,) * len(scope.layout.symbols)))
+
+        if scope.uses_builtins:
+            lines.append('    b = _BUILTINS.check(environment)')
+
+        self.functions[int(name[2:])] = lines + body_lines
+        return name
+
+    def compile_program(self, program, source_filename):
+        '''Returns the source of a Python module which runs the parsed program.
+        source_filename is relative to the directory of the module, and is
+        what `__file__` refers to when the module is run directly.'''
+        self.program_scope = ModuleScope(None, None, None, defined_wrapper_names(program))
+        run_name = self.add_function(self.program_scope, program)
+
+        lines = [
+            '# Compiled from {} by `mini.py --compile`'.format(os.path.basename(source_filename)),
+            'from __future__ import print_function',
+            '',
+            'import os.path',
+            'import sys',
+            '',
+            'import mini as _mini',
+            'from mini import MiniEnvironment, MiniWrapper, NIL, TRUE, FALSE',
+            '',
+            "_FUNCTION = _mini.native_predefineds['function']",
+            "_COND = _mini.native_predefineds['cond']",
+            "_AND = _mini.native_predefineds['and']",
+            "_OR = _mini.native_predefineds['or']",
+            '',
+            '_BUILTINS = _mini.CompiledBuiltins({!r})'.format(self.builtin_names),
+        ]
+
+        # The Python functions of the builtins the program calls directly
+        for index, name in enumerate(self.builtin_names):
+            value = builtins.get_local(create_symbol(name))
+
+            if isinstance(value.py_object, MiniWrapper) and isinstance(value.py_object.operative.py_object, MiniApplicative) \
+                    and value.py_object.operative.py_object.builtin != None:
+                lines.append('_F{} = _BUILTINS.values[{}].py_object.operative.py_object.builtin'.format(index, index))
+
+        lines.extend([
+            '',
+            '_K = [None] * {}'.format(len(self.constants)),
+        ])
+        lines.extend('_K[{}] = {}'.format(i, definition) for i, (node, definition) in enumerate(self.constants))
+        lines.append('_P = [{}]'.format(', '.join('_mini.function_operative_pattern({})'.format(pattern) for pattern in self.function_patterns)))
+        lines.append('_L = [{}]'.format(', '.join('_mini.operative_layout({})'.format(pattern) for pattern in self.layouts)))
+
+        for function_lines in self.functions:
+            lines.append('')
+            lines.extend(function_lines)
+
+        lines.extend([
+            '',
+            'def run(environment):',
+            '    return _mini.execute({}, environment)'.format(run_name),
+            '',
+            "if __name__ == '__main__':",
+            '    _mini.run_compiled(run, os.path.join(os.path.dirname(os.path.realpath(__file__)), {!r}), sys.argv[1:])'.format(source_filename),
+            '',
+        ])
+
+        return '\n'.join(lines)
+
+def defined_wrapper_names(expressions):
+    'Returns the identifiers that the top level of expressions defines as functions'
+    names = set()
+
+    for expression in cons_collection_to_py_collection(expressions):
+        if is_define_form(expression) and cons_collection_len(expression) == 3:
+            value = car(cdr(cdr(expression)))
+
+            if isinstance(value.py_object, MiniPair) and isinstance(car(value).py_object, Identifier) \
+                    and car(value).py_object.symbol in ['function', 'wrap']:
+                names.add(car(cdr(expression)).py_object.symbol)
+
+    return names
+
+def compile_to_python(source, source_filename):
+    'Returns the source of a Python module which runs the mini program in source'
+    return ModuleCompiler(load_predefineds()).compile_program(parse_all(source), source_filename)
+
+# The environment built from the predefineds is pickled into an image next to
+# predefineds.mini, so that later runs can load it instead of parsing and
+# evaluating the predefineds again. Builtins and symbols are pickled by name,
+# and operatives by their pattern and defining environment.
+PREDEFINEDS_IMAGES = True
+
+def predefineds_image_key(filenames):
+    '''Identifies the versions of the files an image is built from, so that
+    images of older versions are ignored. Like .pyc files, this compares sizes
+    and modification times, which is much cheaper than hashing mini.py.'''
+    key = [sys.version]
+
+    for filename in filenames + [os.path.splitext(os.path.realpath(__file__))[0] + '.py']:
+        status = os.stat(filename)
+        key.append((os.path.basename(filename), status.st_size, status.st_mtime))
+
+    return key
+
+def builtin_persistent_ids():
+    'Returns a list of the objects that make up the builtins, with the persistent ids they are pickled as'
+    result = [(('builtins',), builtins)]
+
+    named_objects = [('builtin', key_symbol.py_object.string, value) for key_symbol, value in builtins.bindings.iteritems()]
+    named_objects.extend(('native', name, value) for name, value in native_predefineds.iteritems())
+
+    for kind, name, value in named_objects:
+        for depth, part in enumerate(builtin_parts(value)):
+            result.append(((kind, name, depth), part))
 
-    result = MiniEnvironment()
-    result['__parent__'] = environment
     return result
 
-# This is vau from John N. Shutt's seminal paper
-# https://www.wpi.edu/Pubs/ETD/Available/etd-090110-124904/unrestricted/jshutt.pdf
-# While Greek letters are appropriate for an academic, theoretical context, they make for
-# poor variable names, so this is tentatively named `operative`
-def operative(pattern, defining_environment):
-    argument_list_identifier = None
-    argument_identifiers = None
+def builtin_parts(value):
+    'Yields a builtin value and the wrappers and applicatives inside it, outermost first'
+    yield value
 
-    calling_environment_identifier = car(cdr(pattern)).py_object.symbol
+    while isinstance(value.py_object, MiniWrapper) or isinstance(value.py_object, MiniApplicative):
+        yield value.py_object
 
-    if isinstance(car(pattern).py_object, Identifier):
-        argument_list_identifier = car(pattern).py_object.symbol
+        if not isinstance(value.py_object, MiniWrapper):
+            return
 
-        if calling_environment_identifier == argument_list_identifier:
-            raise Exception("ArgumentError: Argument list identifier `{}` may not be the same as calling environment identifier".format(ai))
+        value = value.py_object.operative
+        yield value
 
-    elif car(pattern).py_object == None or isinstance(car(pattern).py_object, MiniPair):
-        if not all([isinstance(arg.py_object, Identifier) for arg in cons_collection_to_py_collection(car(pattern))]):
-            raise Exception("ArgumentError: Unexpected {} {}".format(type(arg),arg))
+def find_global(module_name, name):
+    # Classes and functions from mini.py are found in this module whether the
+    # image was written by mini.py run as __main__ or imported as mini
+    if module_name in ['__main__', 'mini']:
+        return globals()[name]
 
-        argument_identifiers = [ai.py_object.symbol for ai in cons_collection_to_py_collection(car(pattern))]
-        
-        existing = set()
-        for ai in argument_identifiers:
-            if ai in existing:
-                raise Exception("ArgumentError: Argument `{}` already defined".format(ai))
+    __import__(module_name)
+    return getattr(sys.modules[module_name], name)
 
-            if calling_environment_identifier == ai:
-                raise Exception("ArgumentError: Argument `{}` may not be the same as calling environment identifier".format(ai))
+def create_pickler(f, persistent_objects):
+    '''Returns a pickler which writes the (persistent id, object) pairs in
+    persistent_objects, and symbols, as references to the objects of the
+    process that unpickles them'''
+    persistent_ids = dict((id(obj), persistent_id) for persistent_id, obj in persistent_objects)
 
-            existing.add(ai)
+    def persistent_id(obj):
+        if id(obj) in persistent_ids:
+            return persistent_ids[id(obj)]
 
-    else:
-        raise Exception("ArgumentError: `operative` expected identifier or cons-list as first argument, received {}".format(type(car(pattern).py_object)))
+        if type(obj) is MiniObject and type(obj.py_object) is MiniSymbol:
+            return ('symbol', obj.py_object.string)
 
-    if not isinstance(car(cdr(pattern)).py_object,Identifier):
-        raise Exception("ArgumentError: The second argument to `operative` should be an identifer")
+        return None
 
-    def result(calling_pattern, calling_environment):
-        local_environment = nest(defining_environment)
+    pickler = cPickle.Pickler(f, 2)
+    pickler.persistent_id = persistent_id
+    return pickler
 
-        assert (argument_list_identifier == None) != (argument_identifiers == None)
-        if argument_list_identifier != None:
-            local_environment[argument_list_identifier] = calling_pattern
+def create_unpickler(f, persistent_objects):
+    'Returns an unpickler for what a pickler from create_pickler with the same persistent objects wrote'
+    persistent_objects = dict(persistent_objects)
 
-        if argument_identifiers != None:
-            if not cons_collection_len(calling_pattern) == len(argument_identifiers):
-                raise Exception("ArgumentError: operative expected {} arguments, received {}".format(len(argument_identifiers),len(calling_pattern)))
+    def persistent_load(persistent_id):
+        if persistent_id[0] == 'symbol':
+            return create_symbol(persistent_id[1])
 
-            calling_pattern = list(cons_collection_to_py_collection(calling_pattern))
+        return persistent_objects[persistent_id]
 
-            for i in range(len(argument_identifiers)):
-                local_environment[argument_identifiers[i]] = calling_pattern[i]
+    unpickler = cPickle.Unpickler(f)
+    unpickler.persistent_load = persistent_load
+    unpickler.find_global = find_global
+    return unpickler
 
-        local_environment[calling_environment_identifier] = calling_environment
+def save_predefineds_image(image_filename, key, predefineds):
+    symbol_strings = sorted(SYMBOLS, key = lambda string: SYMBOLS[string].py_object.ordinal)
 
-        return evaluate_expressions(cdr(cdr(pattern)), local_environment)
+    # The image is written under a temporary name and then renamed, so that
+    # runs starting at the same time never see a partly written image
+    temporary_filename = '{}.{}'.format(image_filename, os.getpid())
 
-    return MiniObject(MiniApplicative(result))
+    with open(temporary_filename, 'wb') as f:
+        pickler = create_pickler(f, builtin_persistent_ids())
+        pickler.dump(key)
+        pickler.dump(symbol_strings)
+        pickler.dump(predefineds)
 
-def read_file(filename):
-    assert isinstance(filename, MiniObject)
+    os.rename(temporary_filename, image_filename)
 
-    with open(filename.py_object, 'r') as f:
-        return f.read()
+def load_predefineds_image(image_filename, key):
+    'Returns the environment pickled in an image, or None if there is no up to date image'
+    if not os.path.exists(image_filename):
+        return None
 
-def write_file(filename, string):
-    assert isinstance(filename, MiniObject)
-    assert isinstance(string, MiniObject)
+    with open(image_filename, 'rb') as f:
+        unpickler = create_unpickler(f, builtin_persistent_ids())
 
-    with open(filename.py_object, 'w') as f:
-        f.write(string.py_object)
+        try:
+            if unpickler.load() != key:
+                return None
 
-def add(l,r):
-    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
-        l = l.py_object
-        r = r.py_object
+            # Cons-dicts in the image are ordered by symbol ordinal, so the
+            # symbols have to be interned in the order they were numbered
+            # in. They are checked first, so that a rejected image doesn't
+            # intern any.
+            symbol_strings = unpickler.load()
+            ordinals = symbol_ordinals(symbol_strings)
 
-        if is_number(l) and is_number(r):
-            return l + r
+            if ordinals != sorted(ordinals):
+                return None
 
-    raise Excepion('TypeError')
+            create_symbols(symbol_strings)
+            return unpickler.load()
 
-def subtract(l,r):
-    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
-        l = l.py_object
-        r = r.py_object
+        # A damaged image is treated like a missing one
+        except Exception:
+            return None
 
-        if is_number(l) and is_number(r):
-            return l - r
+# The environments load_predefineds last returned, by whether they are the
+# reference predefineds. Values sent to parallel workers refer to these
+# rather than copying them, and each worker has its own.
+PREDEFINEDS_ENVIRONMENTS = {}
 
-    raise Excepion('TypeError')
+def predefineds_reference(environment):
+    'Returns whether environment is nested in the reference predefineds'
+    while isinstance(environment, MiniEnvironment):
+        for reference, predefineds in PREDEFINEDS_ENVIRONMENTS.iteritems():
+            if environment is predefineds:
+                return reference
 
-def multiply(l,r):
-    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
-        l = l.py_object
-        r = r.py_object
+        environment = environment.parent
 
-        if is_number(l) and is_number(r):
-            return l * r
+    return False
 
-    raise Excepion('TypeError')
+def parallel_persistent_objects():
+    result = builtin_persistent_ids()
+    result.extend((('predefineds', reference), predefineds) for reference, predefineds in PREDEFINEDS_ENVIRONMENTS.iteritems())
+    return result
 
-def divide(l,r):
-    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
-        l = l.py_object
-        r = r.py_object
+def serialize(obj):
+    'Pickles MiniObjects to send between processes, sending builtins, predefineds and symbols by name'
+    f = cStringIO.StringIO()
 
-        if is_number(l) and is_number(r):
-            if isinstance(l,int) and isinstance(r,int) and l % r != 0:
-                l = float(l)
+    try:
+        create_pickler(f, parallel_persistent_objects()).dump(obj)
 
-            return l / r
+    except (cPickle.PicklingError, TypeError) as e:
+        raise Exception('SerializationError: {}'.format(e))
 
-    raise Excepion('TypeError')
+    return f.getvalue()
 
-def idivide(l,r):
-    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
-        l = l.py_object
-        r = r.py_object
+def deserialize(data):
+    return create_unpickler(cStringIO.StringIO(data), parallel_persistent_objects()).load()
 
-        if is_number(l) and is_number(r):
-            return l // r
+# Pools of worker processes by worker count and predefineds, kept for later
+# calls since starting workers takes much longer than most calls
+PARALLEL_POOLS = {}
 
-    raise Excepion('TypeError')
+def parallel_worker_count():
+    import multiprocessing
+    return multiprocessing.cpu_count()
 
-def mod(l,r):
-    if isinstance(l, MiniObject) and isinstance(r, MiniObject):
-        l = l.py_object
-        r = r.py_object
+def initialize_parallel_worker(reference):
+    load_predefineds(reference)
 
-        if is_number(l) and is_number(r):
-            return l % r
+def parallel_pool(workers, reference):
+    # multiprocessing is only imported once it is used, since importing it
+    # takes about as long as starting mini.py
+    import multiprocessing
 
-    raise Excepion('TypeError')
+    key = (workers, reference)
 
-def eq(l,r):
-    assert isinstance(l,MiniObject)
-    assert isinstance(r,MiniObject)
+    if key not in PARALLEL_POOLS:
+        PARALLEL_POOLS[key] = multiprocessing.Pool(workers, initialize_parallel_worker, (reference,))
 
-    return l.py_object == r.py_object
+    return PARALLEL_POOLS[key]
 
-def lt(l,r):
-    assert isinstance(l,MiniObject)
-    assert isinstance(r,MiniObject)
+def run_parallel(run_chunk, chunks, workers, reference):
+    '''Runs run_chunk on each chunk in a pool of worker processes, returning
+    the concatenated lists of values they return'''
+    import multiprocessing
 
-    if is_number(l.py_object) and is_number(r.py_object):
-        return l.py_object < r.py_object
+    data = [(reference, serialize(chunk)) for chunk in chunks]
 
-    if isinstance(l.py_object,str) and isinstance(r.py_object,str):
-        return l.py_object < r.py_object
+    # The workers of a pool can't start processes of their own, so parallel
+    # calls made in a worker, such as one running a test case, run in it
+    if multiprocessing.current_process().daemon:
+        results = map(run_chunk, data)
+        return [value for result in results for value in deserialize(result)]
 
-    if isinstance(l.py_object,MiniSymbol) and isinstance(r.py_object,MiniSymbol):
-        return l.py_object.string < r.py_object.string
+    pool = parallel_pool(workers, reference)
 
-    raise TypeError('`<` expected number or string, received {} and {}'.format(l.py_object, r.py_object))
+    # Waiting with a timeout lets KeyboardInterrupt through, which waiting
+    # without one doesn't in Python 2
+    results = without_evaluation_lock(pool.map_async(run_chunk, data, chunksize = 1).get, sys.maxint)
 
-def gt(l,r):
-    assert isinstance(l,MiniObject)
-    assert isinstance(r,MiniObject)
+    return [value for result in results for value in deserialize(result)]
 
-    if is_number(l.py_object) and is_number(r.py_object):
-        return l.py_object > r.py_object
+def parallel_map_chunk(arguments):
+    reference, data = arguments
+    f, items = deserialize(data)
+    environment = PREDEFINEDS_ENVIRONMENTS[reference]
 
-    if isinstance(l.py_object,str) and isinstance(r.py_object,str):
-        return l.py_object > r.py_object
+    return serialize([complete(apply_wrapper(f.py_object, [item], environment)) for item in items])
 
-    if isinstance(l.py_object,MiniSymbol) and isinstance(r.py_object,MiniSymbol):
-        return l.py_object.string > r.py_object.string
+def parallel_evaluate_chunk(arguments):
+    reference, data = arguments
+    environment, expressions = deserialize(data)
 
-    raise TypeError('`>` expected number or string, received {} and {}'.format(l.py_object, r.py_object))
+    return serialize([evaluate(expression, environment) for expression in expressions])
 
-def le(l,r):
-    return lt(l,r) or eq(l,r)
+# The test runner treats each top-level form of a test file as a case, except
+# definitions, which the cases after them may use. Each worker evaluates the
+# definitions once per file, and runs each case in an environment nested in
+# the one they were defined in, so that cases don't see each other's
+# definitions.
+TEST_ENVIRONMENTS = {}
+TEST_REPORT_SLOWEST = 10
 
-def ge(l,r):
-    return gt(l,r) or eq(l,r)
+def test_cases(expressions):
+    'Returns the top-level definitions and the cases in a list of expressions'
+    definitions = []
+    cases = []
 
-def cons(l,r):
-    return MiniObject(MiniPair(l,r))
+    for expression in cons_collection_to_py_collection(expressions):
+        if is_define_form(expression):
+            definitions.append(expression)
 
-def car(p):
-    return p.py_object.car
+        else:
+            cases.append(expression)
 
-def cdr(p):
-    return p.py_object.cdr
+    return definitions, cases
 
-def is_cons_list(mini_object):
-    assert isinstance(mini_object,MiniObject)
+def test_case_description(case, index):
+    'Returns the description of an `assert`, or the number of another case'
+    if isinstance(case.py_object, MiniPair) and isinstance(car(case).py_object, Identifier) \
+            and car(case).py_object.symbol == 'assert' and isinstance(cdr(case).py_object, MiniPair) \
+            and is_string(car(cdr(case)).py_object) and cdr(cdr(case)) is not NIL:
+        return str(car(cdr(case)).py_object)
 
-    if eq(mini_object,NIL) or isinstance(mini_object.py_object,MiniPair):
-        return TRUE
+    return 'case {}'.format(index + 1)
 
-    return FALSE
+def test_file_environment(filename, reference):
+    'Returns the environment with the definitions of a test file, and its cases'
+    if filename not in TEST_ENVIRONMENTS:
+        with open(filename, 'r') as f:
+            definitions, cases = test_cases(parse_cached(f.read()))
 
-def cons_dict_set(dictionary,key,value):
-    assert isinstance(dictionary,MiniObject)
-    assert isinstance(key,MiniObject)
-    assert isinstance(value,MiniObject)
+        environment = create_file_environment(PREDEFINEDS_ENVIRONMENTS[reference], filename, [])
+        evaluate_expressions(create_cons_collection(definitions), environment)
+        TEST_ENVIRONMENTS[filename] = (environment, cases)
 
-    if eq(dictionary,NIL):
-        return cons(cons(key,value),cons(NIL,NIL))
+    return TEST_ENVIRONMENTS[filename]
 
-    current_node_key = car(car(dictionary))
+def describe_error(error):
+    if type(error) is Exception:
+        return str(error)
 
-    if lt(key,current_node_key):
-        return cons(
-            car(dictionary),
-            cons(
-                cons_dict_set(car(cdr(dictionary)), key, value),
-                cdr(cdr(dictionary))))
+    return '{}: {}'.format(type(error).__name__, error)
 
-    if gt(key,current_node_key):
-        return cons(
-            car(dictionary),
-            cons(
-                car(cdr(dictionary)),
-                cons_dict_set(cdr(cdr(dictionary)), key, value)))
+def run_test_case(arguments):
+    'Runs a case in a worker, returning its error or None, and its wall time'
+    reference, filename, index = arguments
+    start = time.time()
 
-    if eq(key,current_node_key):
-        return cons(cons(key,value), cdr(dictionary))
+    try:
+        environment, cases = test_file_environment(filename, reference)
+        evaluate(cases[index], nest(environment))
+        error = None
 
-    assert False
+    except Exception as e:
+        error = describe_error(e)
 
-def cons_dict_get(dictionary,key):
-    assert isinstance(dictionary, MiniObject)
-    assert isinstance(key, MiniObject)
+    return error, time.time() - start
 
-    if eq(dictionary,NIL):
-        raise Exception('KeyError: Dictionary does not contain key "{}"'.format(key))
+def run_tests(filename, workers, reference):
+    '''Runs the cases of a test file in a pool of worker processes and prints
+    the result and wall time of each, then the slowest. Returns whether they
+    all passed.'''
+    with open(filename, 'r') as f:
+        _, cases = test_cases(parse_cached(f.read()))
 
-    current_node_key = car(car(dictionary))
+    filename = os.path.realpath(filename)
+    pool = parallel_pool(workers, reference)
+    start = time.time()
 
-    if lt(key, current_node_key):
-        return cons_dict_get(car(cdr(dictionary)), key)
+    # Cases are sent one at a time, so that slow cases don't hold up a
+    # whole chunk of others
+    results = pool.map_async(run_test_case,
+        [(reference, filename, index) for index in range(len(cases))],
+        chunksize = 1).get(sys.maxint)
 
-    if gt(key, current_node_key):
-        return cons_dict_get(cdr(cdr(dictionary)), key)
+    seconds = time.time() - start
+    descriptions = [test_case_description(case, index) for index, case in enumerate(cases)]
+    failed = 0
 
-    if eq(key, current_node_key):
-        return cdr(car(dictionary))
+    for description, (error, case_seconds) in zip(descriptions, results):
+        print('{:<4} {:8.4f}s  {}'.format('ok' if error == None else 'FAIL', case_seconds, description))
 
-def cons_dict_has_key(dictionary,key):
-    assert isinstance(dictionary, MiniObject)
-    assert isinstance(key, MiniObject)
+        if error != None:
+            failed += 1
+            print('                {}'.format(error))
 
-    if eq(dictionary,NIL):
-        return FALSE
+    print()
+    print('{} passed, {} failed in {:.2f} seconds with {} workers'.format(len(cases) - failed, failed, seconds, workers))
 
-    current_node_key = car(car(dictionary))
+    slowest = sorted(zip(descriptions, results), key = lambda (description, (error, case_seconds)): -case_seconds)
+    print()
+    print('Slowest cases:')
 
-    if lt(key, current_node_key):
-        return cons_dict_has_key(car(cdr(dictionary)), key)
+    for description, (error, case_seconds) in slowest[:TEST_REPORT_SLOWEST]:
+        print('     {:8.4f}s  {}'.format(case_seconds, description))
 
-    if gt(key, current_node_key):
-        return cons_dict_has_key(cdr(cdr(dictionary)), key)
+    return failed == 0
 
-    if eq(key, current_node_key):
-        return TRUE
+def load_predefineds(reference=False):
+    '''Returns an environment with the builtins and the definitions from
+    predefineds.mini. If reference is true, the forms in native_predefineds are
+    defined by reference-predefineds.mini instead.'''
+    directory = os.path.dirname(os.path.realpath(__file__))
+    predefineds_filenames = [os.path.join(directory, 'predefineds.mini')]
+    image_filename = os.path.join(directory, 'predefineds.image')
 
-def identifier_to_symbol(identifier):
-    assert isinstance(identifier, MiniObject)
+    if reference:
+        predefineds_filenames.insert(0, os.path.join(directory, 'reference-predefineds.mini'))
+        image_filename = os.path.join(directory, 'reference-predefineds.image')
 
-    if not isinstance(identifier.py_object, Identifier):
-        raise Exception('`identifier->symbol` expected identifier, received {}'.format(type(identifier.py_object)))
+    if PREDEFINEDS_IMAGES:
+        key = predefineds_image_key(predefineds_filenames)
+        predefineds = load_predefineds_image(image_filename, key)
 
-    return create_symbol(identifier.py_object.symbol)
+        if predefineds != None:
+            PREDEFINEDS_ENVIRONMENTS[reference] = predefineds
+            return predefineds
 
-def read(string):
-    assert isinstance(string,MiniObject)
+    predefineds = nest(builtins)
+    succeeded = True
 
-    if not isinstance(string.py_object,str):
-        raise Exception("TypeError: `read` expected string, got {}".format(type(strin.py_object)))
+    if not reference:
+        for name, value in native_predefineds.iteritems():
+            predefineds[name] = value
 
-    result =  parse_all(string.py_object)
+    for predefineds_filename in predefineds_filenames:
+        with open(predefineds_filename, 'r') as predefineds_file:
+            predefineds_source = predefineds_file.read()
 
-    assert cdr(result) == NIL
+            try:
+                evaluate_expressions(parse_all(predefineds_source), predefineds)
 
-    return car(result)
+            except:
+                traceback.print_exc()
+                succeeded = False
 
-builtins = {
-    # Builtin constants
-    'true'      : TRUE,
-    'false'     : FALSE,
-    'nil'       : NIL,
+    if PREDEFINEDS_IMAGES and succeeded:
+        try:
+            save_predefineds_image(image_filename, key, predefineds)
 
-    # Builtin comparison functions
-    '='             : py_to_mini(eq),
-    '<'             : py_to_mini(lt),
-    '>'             : py_to_mini(gt),
-    '<='            : py_to_mini(le),
-    '>='            : py_to_mini(ge),
+        # Running without an image is only slower, for example when the
+        # directory isn't writable
+        except (IOError, OSError, cPickle.PicklingError):
+            pass
 
-    # Builtin conversion functions
-    'identifier->symbol'    : py_to_mini(identifier_to_symbol),
+    PREDEFINEDS_ENVIRONMENTS[reference] = predefineds
+    return predefineds
 
-    # Builtin type test functions
-    'cons-list?'    : py_to_mini(is_cons_list),
-    'identifier?'   : py_to_mini(is_identifier),
+def create_file_environment(predefineds, filename, arguments):
+    environment = nest(predefineds)
+    environment['__file__'] = MiniObject(os.path.join(os.path.realpath(filename)))
+    environment['__arguments__'] = create_cons_collection(map(MiniObject,arguments))
+    return environment
 
-    # Builtin general functions
-    'evaluate'      : py_to_mini(evaluate),
-    'evaluate-expressions'  : py_to_mini(evaluate_expressions),
-    'print'         : py_to_mini(print),
-    'prompt'        : py_to_mini(raw_input),
-    'read-file'     : py_to_mini(read_file),
-    'write-file'    : py_to_mini(write_file),
-    'read'          : py_to_mini(read),
-    'wrap'          : py_to_mini(wrap),
-    'unwrap'        : py_to_mini(unwrap),
+def run_compiled(run, filename, arguments):
+    'Runs the `run` function of a compiled module the way a source file is run'
+    environment = create_file_environment(load_predefineds(), filename, arguments)
 
-    # Builtin number functions
-    '+'             : py_to_mini(add),
-    '-'             : py_to_mini(subtract),
-    '*'             : py_to_mini(multiply),
-    '/'             : py_to_mini(divide),
-    '//'            : py_to_mini(idivide),
-    'mod'           : py_to_mini(mod),
+    try:
+        print(run(environment))
+        wait_for_io()
 
-    # Builtin pair functions
-    'cons'          : py_to_mini(cons),
-    'car'           : py_to_mini(car),
-    'cdr'           : py_to_mini(cdr),
+    except:
+        traceback.print_exc()
 
-    # Builtin cons dictionary functions
-    'cons-dict-set' : py_to_mini(cons_dict_set),
-    'cons-dict-get' : py_to_mini(cons_dict_get),
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
 
-    # Builtin string functions
-    'concatenate'   : py_to_mini(concatenate),
-    'length'        : py_to_mini(length),
-    'slice'         : py_to_mini(slice),
+    reference = False
+    profiler = None
+    profile_stacks_filename = None
+    mode = None
+    workers = None
+    test_usage = 'Usage: mini.py --test [--workers count] test-file-name.mini'
 
-    # Builtin boolean functions
-    'not'           : py_to_mini(_not),
+    # Flags come before the file name, in any order. Arguments after the file
+    # name are the program's own.
+    while len(arguments) > 0 and arguments[0].startswith('--'):
+        flag = arguments.pop(0)
 
-    # Builtin special forms
-    'assert'    : MiniObject(MiniApplicative(_assert)),
-    'define'    : MiniObject(MiniApplicative(define)),
-    'defined?'  : MiniObject(MiniApplicative(defined_p)),
-    'if'        : MiniObject(MiniApplicative(_if)),
-    'operative' : MiniObject(MiniApplicative(operative)),
-    'throws?'   : MiniObject(MiniApplicative(throws)),
-}
+        if flag == '--debug':
+            SOURCE_SPANS = {}
 
-builtins = dict_to_environment(builtins)
+        elif flag == '--reference-predefineds':
+            reference = True
 
-if __name__ == '__main__':
-    import os.path
-    import sys
+        elif flag == '--hash-cons':
+            set_hash_consing(True)
 
-    arguments = sys.argv[1:]
+        elif flag == '--profile':
+            profiler = profiler or Profiler()
 
-    predefineds = nest(builtins)
-    predefineds_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'predefineds.mini')
+        elif flag == '--profile-stacks' and len(arguments) > 0:
+            profiler = profiler or Profiler()
+            profile_stacks_filename = arguments.pop(0)
 
-    with open(predefineds_filename, 'r') as predefineds_file:
-        predefineds_source = predefineds_file.read()
+        elif flag in ['--compile', '--test']:
+            mode = flag
 
-        try:
-            evaluate_expressions(parse_all(predefineds_source), predefineds)
+        elif flag == '--workers':
+            if len(arguments) == 0 or not arguments[0].isdigit() or int(arguments[0]) == 0:
+                sys.exit(test_usage)
 
-        except:
-            traceback.print_exc()
+            workers = int(arguments.pop(0))
+
+        else:
+            sys.exit('Usage: mini.py [--debug] [--reference-predefineds] [--hash-cons] [--profile] [--profile-stacks output-file-name] [source-file-name.mini [argument ...]]')
+
+    if profiler != None:
+        # Source spans give the call sites in the report
+        SOURCE_SPANS = {}
+
+    if mode == '--compile':
+        if not len(arguments) in [1,2]:
+            sys.exit('Usage: mini.py --compile source-file-name.mini [output-file-name.py]')
+
+        filename = arguments[0]
+        output_filename = arguments[1] if len(arguments) == 2 else os.path.splitext(filename)[0] + '.py'
+
+        with open(filename,'r') as f:
+            source = f.read()
+
+        # The module finds the source relative to itself, wherever it is run from
+        with open(output_filename,'w') as f:
+            f.write(compile_to_python(source, os.path.relpath(filename, os.path.dirname(os.path.abspath(output_filename)))))
+
+        sys.exit()
+
+    if mode == '--test':
+        if len(arguments) != 1:
+            sys.exit(test_usage)
+
+        sys.exit(0 if run_tests(arguments[0], workers or parallel_worker_count(), reference) else 1)
+
+    predefineds = load_predefineds(reference)
 
     if len(arguments) == 0:
         environment = nest(predefineds)
@@ -907,15 +5186,28 @@ if __name__ == '__main__':
         filename = arguments[0]
         arguments = arguments[1:]
 
-        environment = nest(predefineds)
-        environment['__file__'] = MiniObject(os.path.join(os.path.realpath(filename)))
-        environment['__arguments__'] = create_cons_collection(map(MiniObject,arguments))
+        environment = create_file_environment(predefineds, filename, arguments)
         
         with open(filename,'r') as f:
             source = f.read()
 
         try:
-            print(evaluate_expressions(parse_all(source), environment))
+            if profiler != None:
+                profiler.enable()
+
+            print(evaluate_expressions(parse_cached(source), environment))
+
+            # Spawned work that was never awaited, such as writes, still
+            # finishes before the program exits
+            wait_for_io()
 
         except:
             traceback.print_exc()
+
+        if profiler != None:
+            profiler.disable()
+            print(profiler.report(), file=sys.stderr)
+
+            if profile_stacks_filename != None:
+                with open(profile_stacks_filename, 'w') as f:
+                    f.write(profiler.collapsed_stacks() + '\n')
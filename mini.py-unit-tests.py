@@ -0,0 +1,392 @@
+'''Tests of the parts of mini.py that mini code can't reach: the profiler,
+the command line modes and the files that mini.py caches between runs.
+
+Usage: python mini.py-unit-tests.py
+'''
+
+from __future__ import print_function
+
+import gc
+import hashlib
+import imp
+import itertools
+import os
+import os.path
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+MINI_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+
+sys.path.insert(0, MINI_DIRECTORY)
+import mini
+
+def evaluate(source, environment=None):
+    if environment == None:
+        environment = mini.nest(mini.load_predefineds())
+
+    return mini.evaluate_expressions(mini.parse_all(source), environment)
+
+class ProfilerTests(unittest.TestCase):
+    SOURCE = '''
+        (define double (function (n) (* n 2)))
+        (define loop (function (n total)
+            (if (= n 0) total (loop (- n 1) (+ total (double n))))))
+        (loop 3 0)
+    '''
+
+    def profile(self, source):
+        ticks = itertools.count()
+        profiler = mini.Profiler(clock = lambda: float(next(ticks)))
+        environment = mini.nest(mini.load_predefineds())
+
+        with profiler:
+            result = evaluate(source, environment)
+
+        return profiler, result
+
+    def test_counts_calls(self):
+        profiler, result = self.profile(self.SOURCE)
+
+        self.assertEqual(result.py_object, 12)
+        self.assertEqual(profiler.records['loop'].calls, 4)
+        self.assertEqual(profiler.records['double'].calls, 3)
+        self.assertEqual(profiler.records['*'].calls, 3)
+        self.assertEqual(profiler.records['='].calls, 4)
+
+        # Special forms are counted as part of the applicative that uses them
+        self.assertNotIn('if', profiler.records)
+
+    def test_collapsed_stacks(self):
+        profiler, result = self.profile(self.SOURCE)
+
+        stacks = dict(line.rsplit(' ', 1) for line in profiler.collapsed_stacks().split('\n'))
+
+        # Tail calls replace each other rather than nesting
+        self.assertEqual(sorted(stacks), ['loop', 'loop;+', 'loop;-', 'loop;=', 'loop;double', 'loop;double;*'])
+
+        total = sum(int(microseconds) for microseconds in stacks.itervalues())
+        self.assertEqual(total, int(round(profiler.records['loop'].inclusive * 1000000)))
+
+    def test_disable_stops_recording(self):
+        profiler, result = self.profile(self.SOURCE)
+        evaluate(self.SOURCE)
+
+        self.assertEqual(profiler.records['loop'].calls, 4)
+        self.assertEqual(mini.PROFILER, None)
+
+    def test_only_one_profiler_is_enabled(self):
+        with mini.Profiler():
+            self.assertRaises(Exception, mini.Profiler().enable)
+
+class TailCallTests(unittest.TestCase):
+    def test_tail_loops_run_in_constant_memory(self):
+        def live_environments():
+            gc.collect()
+            return sum(1 for o in gc.get_objects() if isinstance(o, mini.MiniEnvironment))
+
+        counts = []
+
+        for iterations in [100, 10000]:
+            environment = mini.nest(mini.load_predefineds())
+            environment['live-environments'] = mini.py_to_mini(live_environments)
+
+            counts.append(evaluate('''
+                (define loop (function (n)
+                    (if (= n 0) (live-environments) (loop (- n 1)))))
+                (loop {})
+            '''.format(iterations), environment).py_object)
+
+        # Each call's frame is released when it makes its tail call
+        self.assertEqual(counts[0], counts[1])
+
+class PredefinedsImageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_filename = os.path.join(self.directory, 'predefineds.image')
+        self.predefineds = mini.load_predefineds()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_loads_a_saved_image(self):
+        mini.save_predefineds_image(self.image_filename, ['key'], self.predefineds)
+        predefineds = mini.load_predefineds_image(self.image_filename, ['key'])
+
+        self.assertEqual(evaluate('(cons-list-map (function (n) (* n 2)) (cons-list 1 2))', mini.nest(predefineds)),
+            evaluate('(cons-list 2 4)'))
+
+    def test_rejects_a_stale_key(self):
+        mini.save_predefineds_image(self.image_filename, ['old key'], self.predefineds)
+
+        self.assertEqual(mini.load_predefineds_image(self.image_filename, ['new key']), None)
+
+    def test_ignores_a_damaged_image(self):
+        mini.save_predefineds_image(self.image_filename, ['key'], self.predefineds)
+
+        with open(self.image_filename, 'rb') as f:
+            image = f.read()
+
+        with open(self.image_filename, 'wb') as f:
+            f.write(image[:len(image) // 2])
+
+        self.assertEqual(mini.load_predefineds_image(self.image_filename, ['key']), None)
+
+    def test_rejected_symbols_are_not_interned(self):
+        # The new symbol would be numbered after `car`, which the image
+        # numbered it before
+        with open(self.image_filename, 'wb') as f:
+            pickler = mini.create_pickler(f, mini.builtin_persistent_ids())
+            pickler.dump(['key'])
+            pickler.dump(['symbol-only-in-image', 'car'])
+            pickler.dump(self.predefineds)
+
+        self.assertEqual(mini.load_predefineds_image(self.image_filename, ['key']), None)
+        self.assertNotIn('symbol-only-in-image', mini.SYMBOLS)
+
+class ParseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = mini.PARSE_CACHE_DIRECTORY
+        mini.PARSE_CACHE_DIRECTORY = self.directory
+
+    def tearDown(self):
+        mini.PARSE_CACHE_DIRECTORY = self.cache_directory
+        shutil.rmtree(self.directory)
+
+    def long_source(self, expression):
+        return expression * (mini.PARSE_CACHE_MINIMUM_LENGTH // len(expression) + 1)
+
+    def cache_filename(self, source):
+        return os.path.join(self.directory, hashlib.sha1(source).hexdigest() + '.minic')
+
+    def test_caches_long_sources(self):
+        source = self.long_source('(define x (+ 1 "one"))\n')
+
+        self.assertEqual(repr(mini.parse_cached(source)), repr(mini.parse_all(source)))
+        self.assertTrue(os.path.exists(self.cache_filename(source)))
+
+        # Later parses read the tokens from the cache file
+        other_source = self.long_source('(- 2 3)\n')
+        mini.parse_cached(other_source)
+        shutil.copyfile(self.cache_filename(other_source), self.cache_filename(source))
+
+        self.assertEqual(repr(mini.parse_cached(source)), repr(mini.parse_all(other_source)))
+
+    def test_does_not_cache_short_sources(self):
+        mini.parse_cached('(+ 1 2)')
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_replaces_a_damaged_cache_file(self):
+        source = self.long_source('(cons 1 2)\n')
+        mini.parse_cached(source)
+
+        with open(self.cache_filename(source), 'wb') as f:
+            f.write('damaged')
+
+        self.assertEqual(repr(mini.parse_cached(source)), repr(mini.parse_all(source)))
+        self.assertEqual(repr(mini.parse_cached(source)), repr(mini.parse_all(source)))
+
+class TestRunnerTests(unittest.TestCase):
+    SOURCE = '''
+        (define double (function (n) (* n 2)))
+        (assert "double doubles" (= (double 2) 4))
+        (assert "double fails" (= (double 2) 5))
+        (car nil)
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'tests.mini')
+
+        with open(self.filename, 'w') as f:
+            f.write(self.SOURCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cases(self):
+        definitions, cases = mini.test_cases(mini.parse_all(self.SOURCE))
+
+        self.assertEqual(len(definitions), 1)
+        self.assertEqual([mini.test_case_description(case, index) for index, case in enumerate(cases)],
+            ['double doubles', 'double fails', 'case 3'])
+
+    def test_run_test_case(self):
+        mini.load_predefineds()
+        results = [mini.run_test_case((False, self.filename, index)) for index in range(3)]
+
+        self.assertEqual([error for error, seconds in results][:2], [None, 'AssertionError: double fails'])
+        self.assertNotEqual(results[2][0], None)
+
+    def test_failures_set_the_exit_status(self):
+        status, output = run_mini('--test', '--workers', '2', self.filename)
+
+        self.assertEqual(status, 1)
+        self.assertIn('1 passed, 2 failed', output)
+        self.assertEqual([line.split()[0] for line in output.split('\n')[:3]], ['ok', 'FAIL', 'AssertionError:'])
+
+def run_mini(*arguments):
+    'Runs mini.py in a new process, returning its exit status and output'
+    process = subprocess.Popen([sys.executable, os.path.join(MINI_DIRECTORY, 'mini.py')] + list(arguments),
+        stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+
+    output = process.communicate()[0]
+    return process.returncode, output
+
+class CommandLineTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, filename, source):
+        path = os.path.join(self.directory, filename)
+
+        with open(path, 'w') as f:
+            f.write(source)
+
+        return path
+
+    def test_flags_in_any_order(self):
+        path = self.write('program.mini', '(+ 1 2)')
+
+        for flags in [['--profile', '--hash-cons'], ['--hash-cons', '--profile']]:
+            status, output = run_mini(*(flags + [path]))
+
+            self.assertEqual(status, 0)
+            self.assertTrue(output.startswith('3\n'))
+            self.assertIn('inclusive', output)
+
+    def test_unknown_flag(self):
+        status, output = run_mini('--no-such-flag', self.write('program.mini', '(+ 1 2)'))
+
+        self.assertEqual(status, 1)
+        self.assertTrue(output.startswith('Usage: '))
+
+    def test_test_workers_usage(self):
+        path = self.write('tests.mini', '(assert "passes" true)')
+
+        for arguments in [['--workers', path], ['--workers', 'two', path], ['--workers', '0', path]]:
+            status, output = run_mini(*(['--test'] + arguments))
+
+            self.assertEqual(status, 1)
+            self.assertTrue(output.startswith('Usage: mini.py --test'))
+
+    COMPILED_SOURCE = '''
+        (define square (function (n) (* n n)))
+        (print (square 4))
+        (concatenate "a" "b")
+    '''
+
+    def test_compiled_module_runs_like_the_source(self):
+        path = self.write('program.mini', '(print __file__)' + self.COMPILED_SOURCE)
+        os.mkdir(os.path.join(self.directory, 'build'))
+        output_path = os.path.join(self.directory, 'build', 'compiled.py')
+
+        self.assertEqual(run_mini('--compile', path, output_path), (0, ''))
+
+        # The module imports mini from the Python path, and finds the source
+        # relative to itself rather than by an absolute path
+        with open(output_path) as compiled_file:
+            compiled = compiled_file.read()
+
+        self.assertNotIn(MINI_DIRECTORY, compiled)
+        self.assertNotIn(self.directory, compiled)
+
+        environment = dict(os.environ, PYTHONPATH = MINI_DIRECTORY)
+        process = subprocess.Popen([sys.executable, output_path], cwd = os.path.dirname(self.directory),
+            env = environment, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+
+        expected = '{}\n16\nab\n'.format(os.path.realpath(path))
+        self.assertEqual(process.communicate()[0], expected)
+        self.assertEqual(run_mini(path), (0, expected))
+
+    def test_compiled_module_run_function(self):
+        path = self.write('program.mini', self.COMPILED_SOURCE)
+
+        self.assertEqual(run_mini('--compile', path), (0, ''))
+
+        module = imp.load_source('compiled_program', os.path.join(self.directory, 'program.py'))
+        environment = mini.create_file_environment(mini.load_predefineds(), path, [])
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+        try:
+            self.assertEqual(module.run(environment).py_object, 'ab')
+            self.assertEqual(sys.stdout.getvalue(), '16\n')
+
+        finally:
+            sys.stdout = stdout
+
+    def compile_module(self, source):
+        'Compiles source into a module in the test directory, and imports it'
+        path = self.write('compiled_{}.py'.format(len(os.listdir(self.directory))),
+            mini.compile_to_python(source, 'program.mini'))
+
+        return imp.load_source(os.path.splitext(os.path.basename(path))[0], path)
+
+    def test_compiled_functions_run_compiled_bodies(self):
+        module = self.compile_module('(define square (function (n) (* n n)))')
+        environment = mini.nest(mini.load_predefineds())
+        module.run(environment)
+
+        body = environment['square'].py_object.operative.py_object.code
+        self.assertEqual(body.__module__, module.__name__)
+
+    def test_compiled_define_names_functions(self):
+        module = self.compile_module('(define square (function (n) (* n n)))')
+        environment = mini.nest(mini.load_predefineds())
+        module.run(environment)
+
+        self.assertEqual(environment['square'].py_object.operative.py_object.name, 'square')
+
+    def test_compiled_module_is_faster_than_interpreting(self):
+        source = '''
+            (define fib (function (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))))
+            (fib 17)
+        '''
+        module = self.compile_module(source)
+        program = mini.parse_all(source)
+
+        def best_time(run):
+            times = []
+
+            for repetition in range(5):
+                environment = mini.nest(mini.load_predefineds())
+                start = time.time()
+                run(environment)
+                times.append(time.time() - start)
+
+            return min(times)
+
+        self.assertLess(
+            best_time(module.run),
+            best_time(lambda environment: mini.evaluate_expressions(program, environment)))
+
+    def test_compiled_native_special_forms(self):
+        module = self.compile_module('''
+            (define sign (function (n) (cond ((< n 0) -1) ((= n 0) 0) (true 1))))
+            (cons-list (sign -5) (sign 0) (sign 5) (and true false) (and true true) (or false true) (or false false) (cond))
+        ''')
+
+        self.assertEqual(repr(module.run(mini.nest(mini.load_predefineds()))), repr(evaluate('(cons-list -1 0 1 false true true false nil)')))
+
+        module = self.compile_module('(and 1 true)')
+        self.assertRaises(Exception, module.run, mini.nest(mini.load_predefineds()))
+
+    def test_compile_usage(self):
+        status, output = run_mini('--compile')
+
+        self.assertEqual(status, 1)
+        self.assertTrue(output.startswith('Usage: mini.py --compile'))
+
+if __name__ == '__main__':
+    unittest.main()